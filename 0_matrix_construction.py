@@ -1,13 +1,94 @@
 import agpredict as ap   
+import logger
 import sys
 import os
 import subprocess
 import argparse
+import multiprocessing
+import resource
+import time
+
+def prepare(image, memory, done):
+    # Runs in its own process; memory caps the private memory of the product in GB
+    if memory:
+        limit = int(float(memory)*1024**3)
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+    image.prepare()
+    done.put((image.dataset, image.observations, image.filelist))
+
+def run(images, processes, memory):
+    # Prepares the products, up to processes of them at the same time
+    if processes <= 1:
+        for image in images:
+            image.prepare()
+        return
+    done = multiprocessing.Queue()
+    pending = list(images)
+    running = []
+    failed = []
+    results = []
+    while pending or running:
+        while pending and len(running) < processes:
+            p = multiprocessing.Process(target = prepare, args = (pending[0], memory, done), name = pending[0].dataset)
+            p.start()
+            print "Started", p.name, "in process", p.pid
+            running.append(p)
+            pending.pop(0)
+        time.sleep(5)
+        while not done.empty():
+            results.append(done.get())
+        for p in [p for p in running if not p.is_alive()]:
+            p.join()
+            running.remove(p)
+            print "Finished", p.name, "with exit code", p.exitcode
+            if p.exitcode != 0:
+                failed.append(p.name)
+    if failed:
+        raise SystemExit("Matrix construction failed for %s" % ', '.join(failed))
+    # copy what the workers learned during download back onto the parent's images
+    byName = dict((image.dataset, image) for image in images)
+    while not done.empty():
+        results.append(done.get())
+    for dataset, observations, filelist in results:
+        byName[dataset].observations = observations
+        byName[dataset].filelist = filelist
 
 my_args = sys.argv
 print "Running script:", sys.argv[0]
 a = sys.argv[1:]
 print "Arguments passed to script:", my_args
+options = {}
+for x in [x for x in a if x.startswith('--')]:
+    key, _, value = x[2:].partition('=')
+    options[key] = value or True
+a = [x for x in a if not x.startswith('--')]
+# --events=path records the timing and memory of every stage, in every process, as JSON lines
+if 'events' in options:
+    logger.init_eventfile(options['events'])
+imageOptions = {'memmap': 'memmap' in options,
+                'ingest': options.get('ingest', 'gdal'),
+                'workers': int(options.get('workers', 1)),
+                'cache': options.get('cache'),
+                'composite': options.get('composite', 'first'),
+                'downloadWorkers': int(options.get('downloadWorkers', 8)),
+                'verifyCache': 'verifyCache' in options,
+                'legacyMatrix': 'legacyMatrix' in options,
+                'gridLag': int(options.get('gridLag', 150)),
+                'window': int(options['window']) if 'window' in options else None,
+                'compact': 'compact' in options,
+                'regionMask': options.get('regionMask'),
+                'resume': 'resume' in options,
+                'verifyStages': 'verifyStages' in options}
+# --qaRule=strict applies to every product, --qaRule=MOD13Q1:strict,MOD11A2:modland to some
+qaRules = dict(r.split(':') if ':' in r else ('', r) for r in str(options.get('qaRule', 'legacy')).split(','))
+
+def productOptions(dataset):
+    product = dict(imageOptions)
+    product['qaRule'] = qaRules.get(dataset.split('.')[0], qaRules.get('', 'legacy'))
+    return product
+
+processes = int(options.get('processes', 1))
+memory = options.get('memory')
 spectral = a[0]
 directory = a[1]
 username = a[2]
@@ -17,40 +98,47 @@ today = a[5]
 enddate = a[6]
 referenceImage = a[7]
 
+if not os.path.exists(directory):
+    os.mkdir(directory)
+
+# --update appends the dates after the last one of an earlier run to its column store; they are staged in an update directory
+stage = '/update' if 'update' in options else ''
+
 if spectral == '0':
-    mod11 = ap.MOD11A2(directory = directory, username = username, password = password, dataset = 'MOD11A2.005', subset = '1 1 0 0 0 0 0 0 0 0 0 0',
-    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage)
+    if stage:
+        imageOptions['update'] = directory + '/finalMatrix'
+    mod11 = ap.MOD11A2(directory = directory + stage, username = username, password = password, dataset = 'MOD11A2.005', subset = '1 1 0 0 0 0 0 0 0 0 0 0',
+    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage, **productOptions('MOD11A2.005'))
 
-    mod13 = ap.MOD13Q1(directory = directory, username = username, password = password, dataset = 'MOD13Q1.005', subset = '1 1 1 0 0 0 0 0 0 0 0 1',
-    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage)
+    mod13 = ap.MOD13Q1(directory = directory + stage, username = username, password = password, dataset = 'MOD13Q1.005', subset = '1 1 1 0 0 0 0 0 0 0 0 1',
+    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage, **productOptions('MOD13Q1.005'))
 
-    mod15 = ap.MOD15A2(directory = directory, username = username, password = password, dataset = 'MOD15A2.005', subset = '1 1 1 0 0 0',
-    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage)
+    mod15 = ap.MOD15A2(directory = directory + stage, username = username, password = password, dataset = 'MOD15A2.005', subset = '1 1 1 0 0 0',
+    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage, **productOptions('MOD15A2.005'))
 
-    mod17 = ap.MOD17A2(directory = directory, username = username, password = password, dataset = 'MOD17A2.005', subset = '1 1 1 0 0 0 0 0 0 0 0 0',
-    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage)
+    mod17 = ap.MOD17A2(directory = directory + stage, username = username, password = password, dataset = 'MOD17A2.005', subset = '1 1 1 0 0 0 0 0 0 0 0 0',
+    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage, **productOptions('MOD17A2.005'))
     
-    mod11.prepare()
-    mod13.prepare()
-    mod15.prepare()
-    mod17.prepare()
+    run([mod11, mod13, mod15, mod17], processes, memory)
     mod17.finalMatrix()
     
     
 if spectral == '1':
-    if not os.path.exists(directory):
-        os.mkdir(directory)
     if not os.path.exists(directory + '/spectral'):
         os.mkdir(directory + '/spectral')
-    mod09 = ap.MOD09A1(directory = directory + '/spectral', username = username, password = password, dataset = 'MOD09A1.005', subset = '1 1 1 1 1 1 1 0 0 0 0 1 0',
-    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage)
+    if stage:
+        imageOptions['update'] = directory + '/spectral/finalMatrix'
+    mod09 = ap.MOD09A1(directory = directory + '/spectral' + stage, username = username, password = password, dataset = 'MOD09A1.005', subset = '1 1 1 1 1 1 1 0 0 0 0 1 0',
+    tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage, **productOptions('MOD09A1.005'))
     
-    mod09.prepare()
-    if os.path.isfile(directory + '/MOD13Q1.005.npy'):
-        subprocess.call(['cp', directory + 'MOD13Q1.npy', directory + 'MOD13Q1.txt', directory + '/spectral'])
+    if os.path.isfile(directory + stage + '/MOD13Q1.005.npy'):
+        if not os.path.exists(directory + '/spectral' + stage):
+            os.mkdir(directory + '/spectral' + stage)
+        subprocess.call(['cp', directory + stage + '/MOD13Q1.005.npy', directory + stage + '/MOD13Q1.005.txt', directory + '/spectral' + stage])
+        run([mod09], processes, memory)
     else:
-        mod13 = ap.MOD13Q1(directory = directory + '/spectral', username = username, password = password, dataset = 'MOD13Q1.005', subset = '1 0 1 0 0 0 0 0 0 0 0 1',
-        tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage)
-        mod13.prepare()
+        mod13 = ap.MOD13Q1(directory = directory + '/spectral' + stage, username = username, password = password, dataset = 'MOD13Q1.005', subset = '1 0 1 0 0 0 0 0 0 0 0 1',
+        tiles = tiles, today = today, enddate = enddate, referenceImage = referenceImage, **productOptions('MOD13Q1.005'))
+        run([mod09, mod13], processes, memory)
     
     mod09.finalMatrix()
@@ -1,163 +1,279 @@
 from __future__ import division
 import numpy as np
+import os
+import shutil
 import sys
+import tempfile
+import logger
+import reorder
+import lagfeatures
+import split
+import tableio
+from colstore import ColumnStore
 
 my_args = sys.argv
 print "Running script:", sys.argv[0]
 my_args = sys.argv[1:]
 print "Arguments passed to script:", my_args
+# --gridLag=N renumbers the autocorrelation grid of a column store in blocks of N pixels
+# --lags=1,2,3 adds the lags 2 and 3 of the predictors and of EVI to their lag 1 (the default)
+# --rolling=3,6 adds the means of the 3 and 6 intervals before, --seasonal=23 the difference of the lag from a year before
+# --seed=N chooses another training split, the same seed gives the same split (0 by default)
+# --block=N processes N pixels at a time from a memory-mapped matrix and appends them to the output, so memory is bounded by N
+options = {}
+for x in [x for x in my_args if x.startswith('--')]:
+  key, _, value = x[2:].partition('=')
+  options[key] = value or True
+my_args = [x for x in my_args if not x.startswith('--')]
 load_data_fp = my_args[0]
 save_data_fp = my_args[1]
-intervals = int(my_args[2]) # 253 for SL and 230 for BL
-years = intervals/23
-
-print "Data loading..."
-dat = np.load(load_data_fp + 'finalMatrix.npy')
-
-print "Column names:"
-coln = open(load_data_fp + "columnNames.txt").read()
-coln = coln.replace('Pixel Reliability', 'PixelReliability')
-coln = coln.split()
-# Variables to + '_lag'
-lags = ['GWP', 'LST', 'NDVI', 'FPAR', 'LAI', 'GP', 'PSN', 'nino34']
-
-if (len(my_args)>2):
-  print "Data loading for extra file..."
-  load_extra_file = my_args[2]
-  landuse = np.load(load_extra_file)
-  assert dat.shape[0] == len(landuse)
-  dat = np.c_[dat, landuse]
-  coln.append("landuse")
-
-print coln
-
-print "Data shape is ", dat.shape
-
-print "Unique ID creation..."
-meta = open(load_data_fp + "MOD13Q1.005/metadata_MOD13Q1.005.txt").read()
-
-s = 'self.rows'
-loc = meta.index(s)+len(s + ':  ')
-first_blank_space = meta[loc:len(meta)].index(' ')
-nrow = int(meta[loc:loc+first_blank_space])
-
-s = 'self.columns'
-loc = meta.index(s)+len(s + ':  ')
-first_blank_space = meta[loc:len(meta)].index(' ')
-ncol = int(meta[loc:loc+first_blank_space])
-
-uniq_id = np.tile(range(1, nrow*ncol+1), intervals)
-len(np.unique(uniq_id))
-assert dat.shape[0] == len(uniq_id)
-dat = np.c_[dat, uniq_id]
-
-coln.append("uniq_id")
-print coln
-
-# Time variable:
-time_ind = coln.index("timeID") # col num for time
-np.unique(dat[:,time_ind])
-print "Head and tail of time:", dat[:100,time_ind], dat[-100:,time_ind]
-
-print "Reshaping data so that unique ID is primary sorting variable and timeID is secondary..."
-ind = np.lexsort((dat[:,time_ind], dat[:,-1]))
-dat = dat[ind]
-
-print "Adding time_period variable after we have re-ordered into time sequencing..."
-# add a variable that indicates the time period of the year
-# in R:
-# time_period <- rep(as.factor(rep(1:23, 11)), nrow(d)/length(as.factor(rep(1:23, 11))))
-# stopifnot(length(time_period) == nrow(d))
-time_for_one_pixel = np.tile(range(1,24), years)
-time_period = np.tile(time_for_one_pixel, dat.shape[0]/len(time_for_one_pixel))
-assert len(time_period) == dat.shape[0]
-dat = np.c_[dat, time_period]
-coln.append("time_period")
-print "New column names:", coln
-
-if 'SL' in coln:
-  print "Using the SL indicator variable to subset out all the non-SL pixels..."
-  #  1 == Sri Lanka and 0 == ocean
-  np.unique(dat[:,coln.index("SL")])
-  dat = dat[dat[:, coln.index("SL")]==1]
-
-if 'landuse' in coln:
-  print "Using the landuse indicator variable to subset out all the pixels missing landuse..."
-  print "Data shape before dropping", dat.shape
-  dat = dat[dat[:, coln.index("landuse")] != -9999]
-  print "Data shape after dropping", dat.shape
-
-print "Turn into pandas DataFrame for lagging and saving."
-import pandas as pd
-assert len(coln)==dat.shape[1]
-df = pd.DataFrame(dat, columns = coln) # dat is a numpy 2d array
-print "Created the pandas DataFrame."
-
-print "Lagging predictor variables..."
-df.GWP = df.GWP.shift(1) # Gridded world population 
-df.LST = df.LST.shift(1) # Land surface temperature
-df.NDVI = df.NDVI.shift(1) # Vegetation Index
-df.FPAR = df.FPAR.shift(1) # Fraction of photosynthetically active radiation
-df.LAI = df.LAI.shift(1) # Leaf area index
-df.GP = df.GP.shift(1) # Gross primary productivity
-df.PSN = df.PSN.shift(1)  # Net photosynthesis
-df.nino34 = df.nino34.shift(1)  # El Nino
-df['EVI_lag'] = df.EVI.shift(1) # lag of outcome variable
-print "Lagged all the predictor variables."
-# In h2o, in next py script, I drop all time period 1 because they have no lagged predictors
-
-coln = df.columns
-new = [var + '_lag' if var in lags else var for var in coln]
-assert len(df.columns) == len(new)
-df.columns = new
-
-print "Spliting into training and validation sets..."
-# #######################################################################
-# # In R:
-# prop_train <- 0.85
-# grid_options <- unique(d$gridding) # length(grid_options) == 78
-# training_grids <- sample(grid_options, round(length(grid_options)*prop_train), replace = FALSE)
-# testing_grids <- grid_options[!(grid_options %in% training_grids)]
-# 
-# # make sure it worked out well:
-# stopifnot(sum(length(training_grids), length(testing_grids)) == length(grid_options))
-# stopifnot(!any(training_grids %in% testing_grids) &
-#             !any(testing_grids %in% training_grids))
-# 
-# # create vector allocating every obs to training or testing:
-# training <- d$gridding %in% training_grids
-# stopifnot(sum(!training) + sum(training) == nrow(d))
-# training <- as.numeric(training) # TRUE to 1 and FALSE to 0
-# In Python:
-prop_train = 0.80
-grid_options = np.unique(df['autocorrelationGrid'])
-
-training_grids = np.random.choice(a = grid_options, size = round(len(grid_options)*prop_train), replace=False)
-testing_grids = grid_options[np.array([x not in training_grids for x in grid_options])]
-assert sum([len(training_grids), len(testing_grids)]) == len(grid_options)
-assert all([x not in training_grids for x in testing_grids])
-assert all([x not in testing_grids for x in training_grids])
-# create vector allocating every obs to training or testing:
-training = np.array([x in training_grids for x in df['autocorrelationGrid']])
-
-while(not (round(sum(training)/len(training), 2) == prop_train or round(sum(training)/len(training), 2) == prop_train + 0.01 or round(sum(training)/len(training), 2) == prop_train - 0.01)):
-  print "Proportion assigned to training data:", sum(training)/len(training)
-  print "Trying to assign data to training in a way that gives us the correct proportion..."
-  training_grids = np.random.choice(a = grid_options, size = round(len(grid_options)*prop_train), replace=False)
-  testing_grids = grid_options[np.array([x not in training_grids for x in grid_options])]
-  assert sum([len(training_grids), len(testing_grids)]) == len(grid_options)
-  assert all([x not in training_grids for x in testing_grids])
-  assert all([x not in testing_grids for x in training_grids])
-  # create vector allocating every obs to training or testing:
-  training = np.array([x in training_grids for x in df['autocorrelationGrid']])
-
-print "Proportion assigned to training data:", sum(training)/len(training)
-assert len(training) == df.shape[0]
-df['training'] = training
-
-# Save to csv to then load into h2o:
-print "Starting to save to csv format..."
-df.to_csv(save_data_fp, header=True, index=False)
+intervals = int(my_args[-1]) # 253 for SL and 230 for BL, after the optional extra file
+block = int(options['block']) if 'block' in options else None
+
+spillDir = []
+def spill(name, shape, dtype):
+  # temporary memory-mapped array next to the output, removed at the end
+  if not spillDir:
+    spillDir.append(tempfile.mkdtemp(prefix = 'pre_process', dir = os.path.dirname(os.path.abspath(save_data_fp))))
+  return np.lib.format.open_memmap(os.path.join(spillDir[0], name), mode = 'w+', shape = shape, dtype = dtype)
+
+# a Feather file cannot be appended to, so --block with a .feather output fails here, before the matrix is read
+writer = tableio.FrameWriter(save_data_fp) if block else None
+
+try:
+  logger.step('load')
+  print "Data loading..."
+  if os.path.isdir(load_data_fp + 'finalMatrix'):
+    # Column store written by 0_matrix_construction.py: every data and virtual column goes into the output, so all of them are read
+    store = ColumnStore(load_data_fp + 'finalMatrix', gridLag = int(options['gridLag']) if 'gridLag' in options else None)
+    coln = store.names(('data', 'virtual'))
+    if block:
+      # copied one chunk of intervals at a time to a memory-mapped matrix, which the blocks of pixels are read from
+      dat = spill('finalMatrix.npy', (store.periods*store.pixels, len(coln)), float)
+      for start, stop in store.manifest['chunks']:
+        dat[start*store.pixels:stop*store.pixels] = store.read(coln, start, stop)
+    else:
+      dat = store.read(coln)
+    nrow, ncol = store.shape
+    # positions on the raster of the pixels the store holds (all of them unless it was built with a regionMask)
+    pixelIndex = store.pixelIndex
+    coln = [c.replace('Pixel Reliability', 'PixelReliability') for c in coln]
+    latitude, longitude = store.pixel('latitude'), store.pixel('longitude')
+  else:
+    store = None
+    dat = np.load(load_data_fp + 'finalMatrix.npy', mmap_mode = 'r' if block else None)
+    coln = open(load_data_fp + "columnNames.txt").read()
+    coln = coln.replace('Pixel Reliability', 'PixelReliability')
+    coln = coln.split()
+    meta = open(load_data_fp + "MOD13Q1.005/metadata_MOD13Q1.005.txt").read()
+
+    s = 'self.rows'
+    loc = meta.index(s)+len(s + ':  ')
+    first_blank_space = meta[loc:len(meta)].index(' ')
+    nrow = int(meta[loc:loc+first_blank_space])
+
+    s = 'self.columns'
+    loc = meta.index(s)+len(s + ':  ')
+    first_blank_space = meta[loc:len(meta)].index(' ')
+    ncol = int(meta[loc:loc+first_blank_space])
+    pixelIndex = np.arange(nrow*ncol)
+    if os.path.isfile(load_data_fp + 'coordinates.npz') and 'pixelIndex' in np.load(load_data_fp + 'coordinates.npz').files:
+      pixelIndex = np.load(load_data_fp + 'coordinates.npz')['pixelIndex']
+    if 'latitude' in coln and 'longitude' in coln:
+      # a matrix built before coordinates.npz already holds latitude and longitude as columns
+      latitude = longitude = None
+    elif os.path.isfile(load_data_fp + 'coordinates.npz'):
+      coords = np.load(load_data_fp + 'coordinates.npz')
+      latitude, longitude = coords['latitude'], coords['longitude']
+    else:
+      raise IOError('%s has neither latitude and longitude columns nor a coordinates.npz. Please rebuild it with 0_matrix_construction.py' % load_data_fp)
+
+  print "Column names:"
+  # Variables to + '_lag'
+  lags = ['GWP', 'LST', 'NDVI', 'FPAR', 'LAI', 'GP', 'PSN', 'nino34']
+
+  landuse = None
+  if (len(my_args)>3):
+    print "Data loading for extra file..."
+    load_extra_file = my_args[2]
+    landuse = np.load(load_extra_file, mmap_mode = 'r' if block else None)
+    if len(landuse) == nrow*ncol*intervals and len(pixelIndex) < nrow*ncol:
+      # landuse covers the whole raster, keep the pixels of the region
+      if block:
+        full, landuse = landuse, spill('landuse.npy', (intervals*len(pixelIndex),), landuse.dtype)
+        for t in range(intervals):
+          landuse[t*len(pixelIndex):(t + 1)*len(pixelIndex)] = full[t*nrow*ncol + pixelIndex]
+        del full
+      else:
+        landuse = landuse.reshape((intervals, nrow*ncol))[:, pixelIndex].ravel()
+    assert dat.shape[0] == len(landuse)
+
+  print coln
+
+  print "Data shape is ", dat.shape
+  pixels = dat.shape[0]//intervals
+  block = min(block or pixels, pixels)
+
+  # Time variable:
+  time_ind = coln.index("timeID") # col num for time
+  print "Head and tail of time:", dat[:100,time_ind], dat[-100:,time_ind]
+
+  logger.step('count')
+  print "Counting the rows that are kept in every autocorrelation grid, to split into training and validation sets..."
+  # Reads the matrix in the order it is stored, block*intervals rows at a time.  The rows of the pixels outside Sri Lanka
+  # (SL == 0 is ocean) and without a landuse are dropped.  Also records the range of the categorical columns over the
+  # rows that are kept, so that every block stores them in the same integer type.
+  assert dat.shape[0] == pixels*intervals
+  ranges = {}
+  grids, counts = [], []
+  for a in range(0, dat.shape[0], block*intervals):
+    b = min(dat.shape[0], a + block*intervals)
+    # The matrix is time-major with the same pixels in every interval, so reordering it is a transpose, not a sort
+    assert (dat[a:b, time_ind] == np.arange(a, b)//pixels + 1).all(), "Rows must be time-major: timeID 1 for every pixel, then 2, ..."
+    keep = np.ones(b - a, dtype = bool)
+    if 'SL' in coln:
+      #  1 == Sri Lanka and 0 == ocean
+      keep &= dat[a:b, coln.index("SL")]==1
+    if landuse is not None:
+      keep &= landuse[a:b] != -9999
+    rows = a + np.flatnonzero(keep)
+    values = {'timeID': rows//pixels + 1, 'time_period': rows//pixels % 23 + 1, 'uniq_id': pixelIndex[rows % pixels] + 1,
+              'autocorrelationGrid': dat[a:b, coln.index('autocorrelationGrid')][keep].astype(np.int64)}
+    if landuse is not None:
+      values['landuse'] = landuse[a:b][keep]
+    for c, v in values.items():
+      if len(v):
+        lo, hi = ranges.get(c, (v.min(), v.max()))
+        ranges[c] = (min(lo, v.min()), max(hi, v.max()))
+    g, n = np.unique(values['autocorrelationGrid'], return_counts = True)
+    grids.append(g)
+    counts.append(n)
+  grids, position = np.unique(np.concatenate(grids), return_inverse = True)
+  counts = np.bincount(position, weights = np.concatenate(counts), minlength = len(grids)).astype(np.int64)
+  print "Rows kept:", counts.sum(), "of", dat.shape[0]
+
+  logger.step('split')
+  print "Spliting into training and validation sets..."
+  # #######################################################################
+  # # In R:
+  # prop_train <- 0.85
+  # grid_options <- unique(d$gridding) # length(grid_options) == 78
+  # training_grids <- sample(grid_options, round(length(grid_options)*prop_train), replace = FALSE)
+  # testing_grids <- grid_options[!(grid_options %in% training_grids)]
+  # 
+  # # make sure it worked out well:
+  # stopifnot(sum(length(training_grids), length(testing_grids)) == length(grid_options))
+  # stopifnot(!any(training_grids %in% testing_grids) &
+  #             !any(testing_grids %in% training_grids))
+  # 
+  # # create vector allocating every obs to training or testing:
+  # training <- d$gridding %in% training_grids
+  # stopifnot(sum(!training) + sum(training) == nrow(d))
+  # training <- as.numeric(training) # TRUE to 1 and FALSE to 0
+  # In Python:
+  prop_train = 0.80
+  # whole grids, chosen in one attempt to put prop_train of the rows in the training data
+  chosen = split.chooseTraining(counts, prop_train, seed = int(options.get('seed', 0)))
+  training_grids = grids[chosen]
+  print "Assigned", len(training_grids), "grids to training."
+  print "Proportion assigned to training data:", counts[chosen].sum()/counts.sum()
+
+  print "Storing the categorical columns in the smallest integer type that holds them..."
+  dtypes = {}
+  for c, (lo, hi) in ranges.items():
+    dtypes[c] = [t for t in [np.int8, np.int16, np.int32, np.int64] if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max][0]
+
+  steps = lambda key, default: [int(k) for k in str(options.get(key, default)).split(',') if k]
+  lagged = [var for var in lags if var in coln]
+  import pandas as pd
+
+  def preprocess(dat, landuse, first):
+
+    """
+    Returns the DataFrame of the rows that are kept of the pixels first,
+    first + 1, ..., given their pixel-major rows dat (float, changed in place)
+    and landuse.
+    """
+
+    with logger.span('lag', first = first):
+      # Before the rows are dropped, so that every pixel has all its intervals: the lag 1 of the predictors
+      # replaces them (renamed to _lag below) and EVI, the outcome, keeps its column and gets EVI_lag
+      extraNames, extra = lagfeatures.features(dat.reshape((dat.shape[0]//intervals, intervals, dat.shape[1])), coln, ['EVI'] + lagged,
+                                               lags = steps('lags', '1'), rolling = steps('rolling', ''), seasonal = steps('seasonal', ''), replace = lagged)
+      # In h2o, in next py script, I drop all time period 1 because they have no lagged predictors
+
+    with logger.span('filter', first = first):
+      keep = np.ones(dat.shape[0], dtype = bool)
+      if 'SL' in coln:
+        keep &= dat[:, coln.index("SL")]==1
+      if landuse is not None:
+        keep &= landuse != -9999
+      rows = np.flatnonzero(keep)
+      del keep
+      if len(rows) < dat.shape[0]:
+        dat = reorder.compactRows(dat, rows)
+        if landuse is not None:
+          landuse = landuse[rows]
+        extra = reorder.compactRows(extra, rows)
+
+    with logger.span('dataframe', first = first):
+      # time_period indicates the time period of the year
+      # in R:
+      # time_period <- rep(as.factor(rep(1:23, 11)), nrow(d)/length(as.factor(rep(1:23, 11))))
+      # stopifnot(length(time_period) == nrow(d))
+      pixel = first + reorder.pixelPositions(rows, intervals)
+      assert len(coln)==dat.shape[1]
+      df = pd.DataFrame(dat, columns = coln) # dat is a numpy 2d array
+      if landuse is not None:
+        df['landuse'] = landuse
+      df['uniq_id'] = pixelIndex[pixel] + 1
+      df['time_period'] = reorder.timePeriods(rows, intervals)
+      if latitude is not None:
+        df['latitude'] = latitude[pixel]
+        df['longitude'] = longitude[pixel]
+      for j, name in enumerate(extraNames):
+        df[name] = extra[:, j]
+      for c in ['timeID', 'time_period', 'uniq_id', 'landuse', 'autocorrelationGrid']:
+        if c in df.columns and c in dtypes:
+          df[c] = df[c].astype(dtypes[c])
+      df.columns = [var + '_lag' if var in lags else var for var in df.columns]
+      df['training'] = split.trainingMask(df['autocorrelationGrid'].values, training_grids)
+    return df
+
+  if block < pixels:
+    logger.step('blocks', block = block)
+    print "Pre-processing", pixels, "pixels", block, "at a time, appending them to", save_data_fp, "..."
+    for first in range(0, pixels, block):
+      last = min(pixels, first + block)
+      df = preprocess(reorder.pixelBlock(dat, intervals, first, last, out = np.empty(((last - first)*intervals, dat.shape[1]))),
+                      reorder.pixelBlock(landuse, intervals, first, last) if landuse is not None else None, first)
+      with logger.span('save', first = first):
+        writer.write(df)
+      print "Pixels", first, "to", last, "of", pixels, "written,", writer.rows, "rows so far."
+      del df
+    writer.close()
+  else:
+    logger.step('sort')
+    print "Reshaping data so that unique ID is primary sorting variable and timeID is secondary..."
+    dat = reorder.pixelMajor(dat, intervals, out = np.empty(dat.shape)) # float, for the missing lags
+    if landuse is not None:
+      landuse = reorder.pixelMajor(landuse, intervals)
+
+    logger.step('preprocess')
+    print "Lagging predictor variables within every pixel, dropping the rows outside Sri Lanka or without landuse and adding uniq_id, time_period, latitude, longitude and training..."
+    df = preprocess(dat, landuse, 0)
+    del dat, landuse
+    print "Data shape after dropping", df.shape
+    print "Column names:", list(df.columns)
+
+    logger.step('save')
+    # Save to csv (or .parquet/.feather, see tableio.py) to then load into h2o:
+    print "Starting to save to", tableio.tableFormat(save_data_fp), "format..."
+    tableio.writeFrame(df, save_data_fp)
+finally:
+  # also when the processing fails, the spilled copies are as large as the matrix
+  for d in spillDir:
+    shutil.rmtree(d, ignore_errors = True)
 print "Done with saving. You can now move to step 2 of the modeling process: processing data for direct input to modeling functions."
 
 # Send email
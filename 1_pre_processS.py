@@ -1,111 +1,170 @@
 from __future__ import division
 import numpy as np
-# Fetch command line arguments
+import os
 import sys
+import logger
+import reorder
+import lagfeatures
+import split
+import tableio
+from colstore import ColumnStore
+# Fetch command line arguments
 my_args = sys.argv
 print "Running script:", sys.argv[0]
 my_args = sys.argv[1:]
 print "Arguments passed to script:", my_args
+# --gridLag=N renumbers the autocorrelation grid of a column store in blocks of N pixels
+# --lags=1,2,3 adds the lags 2 and 3 of the predictors and of EVI to their lag 1 (the default)
+# --rolling=3,6 adds the means of the 3 and 6 intervals before, --seasonal=23 the difference of the lag from a year before
+# --seed=N chooses another training split, the same seed gives the same split (0 by default)
+options = {}
+for x in [x for x in my_args if x.startswith('--')]:
+  key, _, value = x[2:].partition('=')
+  options[key] = value or True
+my_args = [x for x in my_args if not x.startswith('--')]
 load_data_fp = my_args[0]
 save_data_fp = my_args[1]
 old_data_fp = my_args[2] # "None"
 intervals = int(my_args[3]) # 253 for SL and 230 for BL
-years = intervals/23
 
+logger.step('load')
 print "Data loading..."
-dat = np.load(load_data_fp + 'finalMatrix.npy')
+if os.path.isdir(load_data_fp + 'finalMatrix'):
+  # Column store written by 0_matrix_construction.py; NDVI is dropped for spectral data so it is not read
+  store = ColumnStore(load_data_fp + 'finalMatrix', gridLag = int(options['gridLag']) if 'gridLag' in options else None)
+  coln = [c for c in store.names(('data', 'virtual')) if c != 'NDVI']
+  dat = store.read(coln)
+  nrow, ncol = store.shape
+  # positions on the raster of the pixels the store holds (all of them unless it was built with a regionMask)
+  pixelIndex = store.pixelIndex
+  coln = [c.replace('Pixel Reliability', 'PixelReliability').replace('LULC', 'landuse') for c in coln]
+else:
+  store = None
+  dat = np.load(load_data_fp + 'finalMatrix.npy')
+  coln = open(load_data_fp + "columnNames.txt").read()
+  coln = coln.replace('Pixel Reliability', 'PixelReliability')
+  coln = coln.replace('LULC', 'landuse')
+  coln = coln.split()
+  meta = open(load_data_fp + "MOD13Q1.005/metadata_MOD13Q1.005.txt").read()
+  s = 'self.rows'
+  loc = meta.index(s)+len(s + ':  ')
+  first_blank_space = meta[loc:len(meta)].index(' ')
+  nrow = int(meta[loc:loc+first_blank_space])
+  s = 'self.columns'
+  loc = meta.index(s)+len(s + ':  ')
+  first_blank_space = meta[loc:len(meta)].index(' ')
+  ncol = int(meta[loc:loc+first_blank_space])
+  pixelIndex = np.arange(nrow*ncol)
+  if os.path.isfile(load_data_fp + 'coordinates.npz') and 'pixelIndex' in np.load(load_data_fp + 'coordinates.npz').files:
+    pixelIndex = np.load(load_data_fp + 'coordinates.npz')['pixelIndex']
 
 print "Column names:"
-coln = open(load_data_fp + "columnNames.txt").read()
-coln = coln.replace('Pixel Reliability', 'PixelReliability')
-coln = coln.replace('LULC', 'landuse')
-coln = coln.split()
 # Variables to + '_lag'
 lags = ["GWP","B1","B2","B3","B4","B5","B6","B7", "nino34"]
 
+landuse = None
 if (len(my_args)>4):
   print "Data loading for extra file..."
   load_extra_file = my_args[4]
   landuse = np.load(load_extra_file)
+  if len(landuse) == nrow*ncol*intervals and len(pixelIndex) < nrow*ncol:
+    # landuse covers the whole raster, keep the pixels of the region
+    landuse = landuse.reshape((intervals, nrow*ncol))[:, pixelIndex].ravel()
   assert dat.shape[0] == len(landuse)
-  dat = np.c_[dat, landuse]
-  coln.append("landuse")
 
 print coln
 
 print "Data shape is ", dat.shape # 15 columns by 253 observations x images that are 1927 rows and 1082 columns
 
-print "Unique ID creation..."
-meta = open(load_data_fp + "MOD13Q1.005/metadata_MOD13Q1.005.txt").read()
-s = 'self.rows'
-loc = meta.index(s)+len(s + ':  ')
-first_blank_space = meta[loc:len(meta)].index(' ')
-nrow = int(meta[loc:loc+first_blank_space])
-s = 'self.columns'
-loc = meta.index(s)+len(s + ':  ')
-first_blank_space = meta[loc:len(meta)].index(' ')
-ncol = int(meta[loc:loc+first_blank_space])
-uniq_id = np.tile(range(1, nrow*ncol+1), intervals)
-len(np.unique(uniq_id))
-assert dat.shape[0] == len(uniq_id)
-dat = np.c_[dat, uniq_id]
-
-coln.append("uniq_id")
-print coln
-
 # Time variable:
 time_ind = coln.index("timeID") # col num for time
-np.unique(dat[:,time_ind])
 print "Head and tail of time:", dat[:100,time_ind], dat[-100:,time_ind]
 
+logger.step('sort')
 print "Reshaping data so that unique ID is primary sorting variable and timeID is secondary..."
-ind = np.lexsort((dat[:,time_ind], dat[:,-1]))
-dat = dat[ind]
-
-print "Adding time_period variable after we have re-ordered into time sequencing..."
-# add a variable that indicates the time period of the year
-# in R:
-# time_period <- rep(as.factor(rep(1:23, 11)), nrow(d)/length(as.factor(rep(1:23, 11))))
-# stopifnot(length(time_period) == nrow(d))
-time_for_one_pixel = np.tile(range(1,24), years)
-time_period = np.tile(time_for_one_pixel, dat.shape[0]/len(time_for_one_pixel))
-assert len(time_period) == dat.shape[0]
-dat = np.c_[dat, time_period]
-coln.append("time_period")
-print "New column names:", coln
+# The matrix is time-major with the same pixels in every interval, so this is a transpose, not a sort
+assert reorder.isTimeMajor(dat[:,time_ind], intervals), "Rows must be time-major: timeID 1 for every pixel, then 2, ..."
+dat = reorder.pixelMajor(dat, intervals, out = np.empty(dat.shape)) # float, for the missing lags
+if landuse is not None:
+  landuse = reorder.pixelMajor(landuse, intervals)
+
+logger.step('lag')
+print "Lagging predictor variables within every pixel..."
+# Before the rows are dropped, so that every pixel has all its intervals: the lag 1 of the predictors
+# replaces them (renamed to _lag below) and EVI, the outcome, keeps its column and gets EVI_lag
+steps = lambda key, default: [int(k) for k in str(options.get(key, default)).split(',') if k]
+lagged = [var for var in lags if var in coln]
+extraNames, extra = lagfeatures.features(dat.reshape((dat.shape[0]//intervals, intervals, dat.shape[1])), coln, ['EVI'] + lagged,
+                                         lags = steps('lags', '1'), rolling = steps('rolling', ''), seasonal = steps('seasonal', ''), replace = lagged)
+print "Lagged all the predictor variables, adding", extraNames
+# In h2o, in next py script, I drop all time period 1 because they have no lagged predictors
 
+logger.step('filter')
+keep = np.ones(dat.shape[0], dtype = bool)
 if 'SL' in coln:
   print "Using the SL indicator variable to subset out all the non-SL pixels..."
   #  1 == Sri Lanka and 0 == ocean
-  np.unique(dat[:,coln.index("SL")])
-  dat = dat[dat[:, coln.index("SL")]==1]
-  
-if 'landuse' in coln:
+  keep &= dat[:, coln.index("SL")]==1
+
+if landuse is not None:
   print "Using the landuse indicator variable to subset out all the pixels missing landuse..."
   print "Data shape before dropping", dat.shape
-  dat = dat[dat[:, coln.index("landuse")] != -9999]
-  print "Data shape after dropping", dat.shape
+  keep &= landuse != -9999
+rows = np.flatnonzero(keep)
+del keep
+if len(rows) < dat.shape[0]:
+  dat = dat[rows]
+  if landuse is not None:
+    landuse = landuse[rows]
+  extra = extra[rows]
+print "Data shape after dropping", dat.shape
+
+print "Unique ID and time_period variables from the pixel and interval of every row..."
+# time_period indicates the time period of the year
+# in R:
+# time_period <- rep(as.factor(rep(1:23, 11)), nrow(d)/length(as.factor(rep(1:23, 11))))
+# stopifnot(length(time_period) == nrow(d))
+pixel = reorder.pixelPositions(rows, intervals)
+uniq_id = pixelIndex[pixel] + 1
+time_period = reorder.timePeriods(rows, intervals)
+del rows
+
+print "Adding latitude and longitude of the remaining pixels from the per-pixel coordinate grid..."
+if store is None and 'latitude' in coln and 'longitude' in coln:
+  # a matrix built before coordinates.npz already holds latitude and longitude as columns
+  latitude = longitude = None
+elif store is None:
+  if not os.path.isfile(load_data_fp + 'coordinates.npz'):
+    raise IOError('%s has neither latitude and longitude columns nor a coordinates.npz. Please rebuild it with 0_matrix_construction.py' % load_data_fp)
+  coords = np.load(load_data_fp + 'coordinates.npz')
+  latitude, longitude = coords['latitude'][pixel], coords['longitude'][pixel]
+else:
+  latitude, longitude = store.pixel('latitude')[pixel], store.pixel('longitude')[pixel]
+del pixel
 
+logger.step('dataframe')
 print "Turn into pandas DataFrame for lagging and saving."
 import pandas as pd
 assert len(coln)==dat.shape[1]
 df = pd.DataFrame(dat, columns = coln) # dat is a numpy 2d array
+del dat
+if landuse is not None:
+  df['landuse'] = landuse
+df['uniq_id'] = uniq_id
+df['time_period'] = time_period
+if latitude is not None:
+  df['latitude'] = latitude
+  df['longitude'] = longitude
+for j, name in enumerate(extraNames):
+  df[name] = extra[:, j]
+del extra
 print "Created the pandas DataFrame."
+print "Column names:", list(df.columns)
 
-print "Lagging predictor variables..."
-df.GWP = df.GWP.shift(1) # Gridded world population 
-df.B1 = df.B1.shift(1)
-df.B2 = df.B2.shift(1)
-df.B3 = df.B3.shift(1)
-df.B4 = df.B4.shift(1)
-df.B5 = df.B5.shift(1)
-df.B6 = df.B6.shift(1)
-df.B7 = df.B7.shift(1)
-df.nino34 = df.nino34.shift(1)  # El Nino
-df['EVI_lag'] = df.EVI.shift(1) # lag of outcome variable
-print "Lagged all the predictor variables."
-print "Data shape is ", df.shape
-# In h2o, in next py script, I drop all time period 1 because they have no lagged predictors
+print "Storing the categorical columns in the smallest integer type that holds them..."
+for c in ['timeID', 'time_period', 'uniq_id', 'landuse', 'autocorrelationGrid']:
+  if c in df.columns:
+    df[c] = df[c].astype([t for t in [np.int8, np.int16, np.int32, np.int64] if np.iinfo(t).min <= df[c].min() and df[c].max() <= np.iinfo(t).max][0])
 
 coln = df.columns
 new = [var + '_lag' if var in lags else var for var in coln]
@@ -113,42 +172,27 @@ assert len(df.columns) == len(new)
 df.columns = new
 
 # Drop NDVI column for spectral data:
-df.drop('NDVI', axis=1, inplace=True)
+if 'NDVI' in df.columns:
+  df.drop('NDVI', axis=1, inplace=True)
 
+logger.step('split')
 print "Spliting into training and validation sets..."
 if(old_data_fp != "None"):
-  data = pd.read_csv(old_data_fp)
+  data = tableio.readFrame(old_data_fp, columns = ['training'])
   df['training'] = data['training']
 else:
   prop_train = 0.80
-  grid_options = np.unique(df['autocorrelationGrid'])
-  
-  training_grids = np.random.choice(a = grid_options, size = round(len(grid_options)*prop_train), replace=False)
-  testing_grids = grid_options[np.array([x not in training_grids for x in grid_options])]
-  assert sum([len(training_grids), len(testing_grids)]) == len(grid_options)
-  assert all([x not in training_grids for x in testing_grids])
-  assert all([x not in testing_grids for x in training_grids])
-  # create vector allocating every obs to training or testing:
-  training = np.array([x in training_grids for x in df['autocorrelationGrid']])
-  
-  while(not (round(sum(training)/len(training), 2) == prop_train or round(sum(training)/len(training), 2) == prop_train + 0.01 or round(sum(training)/len(training), 2) == prop_train - 0.01)):
-    print "Proportion assigned to training data:", sum(training)/len(training)
-    print "Trying to assign data to training in a way that gives us the correct proportion..."
-    training_grids = np.random.choice(a = grid_options, size = round(len(grid_options)*prop_train), replace=False)
-    testing_grids = grid_options[np.array([x not in training_grids for x in grid_options])]
-    assert sum([len(training_grids), len(testing_grids)]) == len(grid_options)
-    assert all([x not in training_grids for x in testing_grids])
-    assert all([x not in testing_grids for x in training_grids])
-    # create vector allocating every obs to training or testing:
-    training = np.array([x in training_grids for x in df['autocorrelationGrid']])
-  
-  print "Proportion assigned to training data:", sum(training)/len(training)
+  # whole grids, chosen in one attempt to put prop_train of the rows in the training data
+  training, training_grids = split.split(df['autocorrelationGrid'].values, prop_train, seed = int(options.get('seed', 0)))
+  print "Assigned", len(training_grids), "grids to training."
+  print "Proportion assigned to training data:", training.mean()
   assert len(training) == df.shape[0]
   df['training'] = training 
 
-# Save to csv to then load into h2o:
-print "Starting to save to csv format..."
-df.to_csv(save_data_fp, header=True, index=False)
+logger.step('save')
+# Save to csv (or .parquet/.feather, see tableio.py) to then load into h2o:
+print "Starting to save to", tableio.tableFormat(save_data_fp), "format..."
+tableio.writeFrame(df, save_data_fp)
 print "Done with saving. You can now move to step 2 of the modeling process: processing data for direct input to modeling functions."
 
 # Send email
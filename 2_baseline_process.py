@@ -1,5 +1,7 @@
 # Fetch command line arguments
 import sys
+import logger
+import tableio
 my_args = sys.argv
 print "Running script:", sys.argv[0]
 my_args = sys.argv[1:]
@@ -11,11 +13,13 @@ import numpy as np
 import pandas as pd
 
 #######################################################################
+logger.step('load')
 print "Importing data..."
-data = pd.read_csv(load_data_fp)
+data = tableio.readFrame(load_data_fp)
 print "Data shape:", data.shape
 
 #######################################################################
+logger.step('clean')
 print "Dropping all time period 1 because they have no lagged predictors..."
 ind = data["timeID"] != 1
 data = data[ind]
@@ -28,7 +32,8 @@ print "Dropping rows where the outcome, EVI, is NA..."
 data = data[data['EVI'].notnull()]
 print "Data shape:", data.shape
 
-data.to_csv(save_data_fp, header=True, index=False)
+logger.step('save')
+tableio.writeFrame(data, save_data_fp)
 
 # Send email
 email = False
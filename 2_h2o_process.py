@@ -1,5 +1,7 @@
 # Fetch command line arguments
 import sys
+import logger
+import tableio
 my_args = sys.argv
 print "Running script:", sys.argv[0]
 my_args = sys.argv[1:]
@@ -8,13 +10,15 @@ load_data_fp = my_args[0]
 save_data_fp = my_args[1]
 
 #######################################################################
+logger.step('h2o')
 print "Initializing h2o..."
 import h2o
 h2o.init(min_mem_size = 200, max_mem_size = 210)
 
 #######################################################################
+logger.step('load')
 print "Importing data..."
-data = h2o.import_file(path = load_data_fp)
+data = tableio.importFrame(load_data_fp)
 
 #######################################################################
 ## summarize data
@@ -23,6 +27,7 @@ data.dim
 data.head()
 
 #######################################################################
+logger.step('factor')
 print "Making 'time_period' and 'landuse' a factor..."
 data['time_period'] = data['time_period'].asfactor()
 data['time_period'].isfactor()
@@ -30,6 +35,7 @@ data['landuse'] = data['landuse'].asfactor()
 print data['landuse'].unique()
 
 #######################################################################
+logger.step('clean')
 print "Dropping all time period 1 because they have no lagged predictors..."
 ind = data["timeID"] != 1
 data = data[ind] # Gett ERRORS here that the Java heap does not have enough memory, unless you 
@@ -84,7 +90,8 @@ data['nino34_lag'] = nino34_lag
 # h2o.remove([LST_lag, NDVI_lag, EVI_lag, EVI, PixelReliability, FPAR_lag, LAI_lag, GP_lag, PSN_lag, nino34_lag])
 # del LST_lag, NDVI_lag, EVI_lag, EVI, PixelReliability, FPAR_lag, LAI_lag, GP_lag, PSN_lag, nino34_lag
 
-h2o.export_file(frame = data, path = save_data_fp, force=True)
+logger.step('save')
+tableio.exportFrame(data, save_data_fp)
 
 # Send email
 email = False
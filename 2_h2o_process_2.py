@@ -1,5 +1,8 @@
 from __future__ import division
 import sys, time, csv, h2o
+import logger
+import split
+import tableio
 import numpy as np
 import pandas as pd
 
@@ -8,6 +11,12 @@ my_args = sys.argv
 print "Running script:", sys.argv[0]
 my_args = sys.argv[1:]
 print "Arguments passed to script:", my_args
+# --seed=N chooses another split of the training data, the same seed gives the same split (0 by default)
+options = {}
+for x in [x for x in my_args if x.startswith('--')]:
+  key, _, value = x[2:].partition('=')
+  options[key] = value or True
+my_args = [x for x in my_args if not x.startswith('--')]
 load_data_fp = my_args[0]
 save_training_data_fp = my_args[1]
 save_holdout_data_fp = my_args[2]
@@ -16,16 +25,18 @@ if (len(my_args)>3):
   print "Saving the vector of training indices because you passed in an argument for a file path to save it."
   save_training_ind_fp = my_args[3]
 
+logger.step('load')
 print "Pre-processing the data..."
 testing = False
 prop_train = 0.80 # This is from 1_pre_process.py
 
 h2o.init(min_mem_size=200, max_mem_size = 210)
-data = h2o.import_file(path = load_data_fp)
+data = tableio.importFrame(load_data_fp)
 
 data.describe()
 
 #######################################################################
+logger.step('clean')
 print "Setting values of the PixelReliability column to use it for the weights_column in modeling"
 PixelReliability = data['PixelReliability']
 PixelReliability[PixelReliability==2] = 9999 # this is snow, so set it to NA
@@ -64,6 +75,7 @@ print data.dim
 data = data[ind] 
 print data.dim
 
+logger.step('split')
 print "Dividing into training and holdout with 'autocorrelationGrid' column..."
 print data.dim
 train_index = data['training']
@@ -71,7 +83,7 @@ d = data[train_index]
 print d.dim
 print "Proportion of data in training data", d.dim[0]/data.dim[0]
 # assert round(d.dim[0]/data.dim[0], 2) == prop_train or round(d.dim[0]/data.dim[0], 2) == prop_train + .01 or round(d.dim[0]/data.dim[0], 2) == prop_train - .01
-hold_index = train_index != 'True'
+hold_index = tableio.falseRows(train_index)
 holdout = data[hold_index]
 assert holdout.dim[0] + d.dim[0] == data.dim[0]
 
@@ -84,56 +96,34 @@ if (len(my_args)>3):
   prop_train = 0.80
   autocor = d['autocorrelationGrid']
   print "autocor", autocor
-  grid_options = autocor.unique()
-  print "Grid options", grid_options
-  grid_options_l = h2o.as_list(grid_options, use_pandas=False)
-  grid_options = np.squeeze(grid_options_l)
-  # drop col name:
-  grid_options = grid_options[1:]
-  
   # convert autocor to a python list from h2o, lists are too large so have to do this in two pieces
-  autocor1 = h2o.as_list(autocor[0:autocor.dim[0]/2,:,], use_pandas=False)
-  autocor2 = h2o.as_list(autocor[len(autocor1):autocor.dim[0]+1,:,], use_pandas=False)
-  autocor_l = autocor1 + autocor2
-  autocor = np.squeeze(autocor_l)
-  # drop col name:
-  autocor = autocor[1:]
+  # every piece starts with the column name, which is dropped, so the second piece starts at row half, not len(autocor1)
+  half = autocor.dim[0]//2
+  autocor1 = h2o.as_list(autocor[0:half,:,], use_pandas=False)[1:]
+  autocor2 = h2o.as_list(autocor[half:autocor.dim[0],:,], use_pandas=False)[1:]
+  autocor = np.array(autocor1 + autocor2).reshape(-1).astype(float)
+  assert len(autocor) == d.dim[0]
   print "autocor head:", autocor[:25]
   print "autocor length:", len(autocor)
   print "data rows:", d.dim[0]
   
-  training_grids = np.random.choice(a = grid_options, size = len(grid_options)*prop_train, replace=False)
-  testing_grids = np.array(grid_options[np.array([x not in training_grids for x in grid_options])])
-  assert sum([len(training_grids), len(testing_grids)]) == len(grid_options)
-  assert all([x not in training_grids for x in testing_grids])
-  assert all([x not in testing_grids for x in training_grids])
-  # create vector allocating every obs to training or testing:
-  training = np.array([x in training_grids for x in autocor])
-  print "Proportion of data in training", sum(training)/len(training), "and prop_train =", prop_train
-  
-  while(not(round(sum(training)/len(training), 2) == prop_train or round(sum(training)/len(training), 2) == prop_train + 0.01 or round(sum(training)/len(training), 2) == prop_train - 0.01 or round(sum(training)/len(training), 2) == prop_train - 0.02 or round(sum(training)/len(training), 2) == prop_train + 0.02)):
-    print "Trying to assign data to training in a way that gives us the correct proportion..."
-    training_grids = np.random.choice(a = grid_options, size = round(len(grid_options)*prop_train), replace=False)
-    testing_grids = np.array(grid_options[np.array([x not in training_grids for x in grid_options])])
-    assert sum([len(training_grids), len(testing_grids)]) == len(grid_options)
-    assert all([x not in training_grids for x in testing_grids])
-    assert all([x not in testing_grids for x in training_grids])
-    # create vector allocating every obs to training or testing:
-    training = np.array([x in training_grids for x in autocor])
-    print "Proportion of data in training", sum(training)/len(training), "and prop_train =", prop_train
+  # whole grids, chosen in one attempt to put prop_train of the rows in the training data
+  training, training_grids = split.split(autocor, prop_train, seed = int(options.get('seed', 0)), tolerance = 0.02)
+  print "Assigned", len(training_grids), "grids to training."
+  print "Proportion of data in training", training.mean(), "and prop_train =", prop_train
 
   # assert round(sum(training)/len(training), 2) == prop_train or round(sum(training)/len(training), 2) == prop_train + 1 or round(sum(training)/len(training), 2) == prop_train - 1
   print "len(training):", len(training) 
   print "d.dim[0]:", d.dim[0]
   #assert len(training) == d.dim[0]
-  # Save to csv to then load into h2o later:
-  print "Starting to save to csv format..."
-  training = pd.DataFrame(training)
-  training.to_csv(save_training_ind_fp, header=False, index=False)
+  # Save to csv (or .parquet/.feather, see tableio.py) to then load into h2o later:
+  print "Starting to save to", tableio.tableFormat(save_training_ind_fp), "format..."
+  tableio.writeFrame(pd.DataFrame({'training': training}), save_training_ind_fp, header=False)
   print "Done with saving training and testing sets for training data."
 
-h2o.export_file(frame = d, path = save_training_data_fp, force=True)
-h2o.export_file(frame = holdout, path = save_holdout_data_fp, force=True)
+logger.step('save')
+tableio.exportFrame(d, save_training_data_fp)
+tableio.exportFrame(holdout, save_holdout_data_fp)
 
 # Send email
 email = False
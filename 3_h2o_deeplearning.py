@@ -1,5 +1,6 @@
 from __future__ import division
 import csv, time, sys, pickle, h2o
+import logger
 from hyperopt import fmin, tpe, hp, STATUS_OK, STATUS_FAIL, Trials
 
 my_args = sys.argv
@@ -16,6 +17,7 @@ predictors = my_args[3:]
 
 evals = 45
 
+logger.step('load')
 print "Loading in data..."
 h2o.init(min_mem_size_GB = 225, max_mem_size_GB = 230)
 d = h2o.import_frame(path = load_data_fp)
@@ -48,6 +50,7 @@ print "Training data now has",train.nrow(),"rows."
 h2o.remove([test_index, train_index, d])
 del test_index, train_index, d
 
+@logger.timed()
 def split_fit_predict_dl(h1, h2, h3, hdr1, hdr2, hdr3, rho, epsilon):
   print "Trying h1, h2, h3, hdr1, hdr2, hdr3, rho, epsilon values of:", h1, h2, h3, hdr1, hdr2, hdr3, rho, epsilon
   dl = h2o.deeplearning(x = train[predictors],
@@ -122,6 +125,7 @@ def run_all_dl(csvfile = saving_fp,
           with open('output/dltrials.pkl', 'w') as output:
             pickle.dump(trials, output, -1)
 
+logger.step('search')
 run_all_dl()
 
 # Send email
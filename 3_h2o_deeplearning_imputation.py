@@ -1,5 +1,7 @@
 from __future__ import division
 import sys, time, csv, h2o
+import logger
+import tableio
 import pandas as pd
 import numpy as np
 
@@ -18,8 +20,9 @@ predictors = arg[5:]
 # But to keep this scripts code simple I impute anything with 'lag' in the var name.
 to_impute = [var for var in predictors if 'lag' in var]
 
+logger.step('load')
 h2o.init(min_mem_size_GB=200, max_mem_size_GB = 225)
-d = h2o.import_frame(path = load_data_fp)
+d = tableio.importFrame(load_data_fp)
 #######################################################################
 print "Making 'time_period' a factor..."
 d['time_period'] = d['time_period'].asfactor()
@@ -27,6 +30,7 @@ assert d['time_period'].isfactor()
 print d.levels(col='time_period')
 d.describe()
 
+@logger.timed()
 def impute_data(method = "mean", 
                 to_impute = to_impute,
                 predictors = predictors):
@@ -50,7 +54,7 @@ def impute_data(method = "mean",
       d.impute(predictor, method='mean', by = ['time_period'], inplace = True)
       print "Done imputing", predictor
     print "Saving the final mean imputed data to disk..."
-    h2o.export_file(frame = d, path =saving_meanImputed_fp, force=True)
+    tableio.exportFrame(d, saving_meanImputed_fp)
   
   if method == "model":
     # sequentially impute 'newdata', not 'data', so the order of the predictor variables in the loop does not matter
@@ -80,15 +84,15 @@ def impute_data(method = "mean",
       newdata[predictor] = tofillin
     
     print "Saving the final model-imputed data to disk..."
-    h2o.export_file(frame = d, path =saving_modelImputed_fp, force=True)
+    tableio.exportFrame(d, saving_modelImputed_fp)
 
 def compare_frames(d1 = saving_meanImputed_fp, 
                   d2 = saving_modelImputed_fp,
                   imputed = to_impute):
   print "Comparing the resulting two matrices..."
   # Load the saved frames back in
-  meanI  = h2o.import_file(path = d1)
-  modelI = h2o.import_file(path = d2)
+  meanI  = tableio.importFrame(d1)
+  modelI = tableio.importFrame(d2)
   
   meanIquantiles = h2o.as_list(meanI[imputed].quantile(prob=[0.01,0.1,0.25,0.333,0.5,0.667,0.75,0.9,0.99]))
   modelIquantiles = h2o.as_list(modelI[imputed].quantile(prob=[0.01,0.1,0.25,0.333,0.5,0.667,0.75,0.9,0.99]))
@@ -103,6 +107,7 @@ def compare_frames(d1 = saving_meanImputed_fp,
   modelIcolmin = [v.min() for v in modelI[imputed]]
   # TODO save all this in a csv file
 
+logger.step('impute')
 impute_data("mean")
 impute_data("model")
 # compare_frames()
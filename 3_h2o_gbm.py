@@ -1,5 +1,7 @@
 from __future__ import division
 import csv, time, sys, pickle, h2o
+import logger
+import tableio
 from hyperopt import fmin, tpe, hp, STATUS_OK, STATUS_FAIL, Trials
 
 my_args = sys.argv
@@ -16,12 +18,13 @@ predictors = my_args[3:]
 
 evals = 35
 
+logger.step('load')
 print "Loading in data..."
 print "Not imputing missing predictor data because GBM can handle missing values."
 
 h2o.init(min_mem_size=230, max_mem_size = 240)
-d = h2o.import_file(path = load_data_fp)
-train_index = h2o.import_file(path = load_train_ind_fp)
+d = tableio.importFrame(load_data_fp)
+train_index = tableio.importFrame(load_train_ind_fp)
 assert train_index.dim[0] == d.dim[0]
 
 #######################################################################
@@ -42,7 +45,7 @@ d.describe()
 d['train_index'] = train_index
 train = d[d['train_index']]
 
-test_index = d['train_index'] != 'True'
+test_index = tableio.falseRows(d['train_index'])
 test = d[test_index]
 
 print "Training data has",train.dim[1], "columns and",train.dim[0],"rows, test has",test.dim[0],"rows."
@@ -61,6 +64,7 @@ def start_save(csvfile, initialize = ['mse', 'r2', 'ntrees', 'max_depth', 'learn
     writer = csv.writer(output, lineterminator='\n')
     writer.writerow(initialize)
 
+@logger.timed()
 def split_fit_predict_gbm(ntrees, max_depth, learn_rate):
   """ Splits up training d and score on validation set. Test:
        split_fit_predict_gbm(50, 3, 0.1) """
@@ -132,6 +136,7 @@ def run_all_gbm(csvfile = saving_fp,
 # with open('output/gbmbest.pkl', 'rb') as input:
 #   best = pickle.load(input)
 
+logger.step('search')
 run_all_gbm()
 
 # Send email
@@ -2,6 +2,8 @@ from __future__ import division
 import numpy as np
 import pandas as pd
 import time, csv, sys, os
+import logger
+import tableio
 from annoy import AnnoyIndex
 from sklearn.metrics import mean_squared_error
 
@@ -25,6 +27,7 @@ K = int(my_args[6])
 
 test = False
 
+@logger.timed()
 def baseline_train(olddata, f, trees):
   """" olddata to train with using f number of features of the data and building an index with trees number of trees """
   t = AnnoyIndex(f)  # Length of item vector that will be indexed
@@ -56,6 +59,7 @@ def baseline_train(olddata, f, trees):
 #     pred.append(np.mean(preds))
 #   return(pred)
 
+@logger.timed()
 def baseline_predict(model, newdata, olddata, nbs, k):
   """ nbs is a vector with the same length as the vector of unique values of olddata['timeID'] where the it starts out high and then goes down low, e.g. to 3. nbs indicates how many neighbors from the old data to pull out. In this case, unique values of olddata['timeID'] seq from 2 to 253."""
   print "Predicting new data..."
@@ -165,6 +169,7 @@ def run_all_baseline_test(data, csvfile = "output/baselinetest.csv", csvfile_vec
     writer.writerow(tosave)
   print "Finished baseline test."
 
+logger.step('baseline')
 print "Loading in data..."
 if test:
   testfuncdata = pd.read_csv("/data/john/srilanka/testfuncsmalldata")
@@ -173,7 +178,7 @@ if test:
                         nbs = np.linspace(Neighbs, 10, num=len(np.unique(testfuncdata['timeID'])), dtype = 'int'), 
                         k = K)
 else:
-  data = pd.read_csv(load_data_fp)
+  data = tableio.readFrame(load_data_fp)
   # reset index to 0:len because annoy needs index like this.
   # data.reset_index([np.arange(len(data.index))], inplace = True)
   run_all_baseline(data, f = 3, trees = Trees, 
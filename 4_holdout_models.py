@@ -2,6 +2,8 @@ from __future__ import division
 import pandas as pd
 import numpy as np
 import csv, time, sys, pickle, h2o
+import logger
+import tableio
 
 my_args = sys.argv
 print "Running script:", sys.argv[0]
@@ -17,6 +19,7 @@ predictors = my_args[6:]
 
 # predictors = GWP_lag LST_lag NDVI_lag FPAR_lag LAI_lag GP_lag PSN_lag nino34_lag time_period EVI_lag
 
+logger.step('load')
 print "Loading in data..."
 h2o.init(min_mem_size=200, max_mem_size = 250)
 
@@ -46,7 +49,7 @@ h2o.init(min_mem_size=200, max_mem_size = 250)
 #     writer.writerow(tosave)
 #   return(h2o.as_list(dl.predict(holdout[predictors])))
 
-holdout = h2o.import_file(path = load_data_fp)
+holdout = tableio.importFrame(load_data_fp)
 print "Making 'time_period' and 'landuse' a factor..."
 holdout['time_period'] = holdout['time_period'].asfactor()
 assert holdout['time_period'].isfactor()
@@ -56,7 +59,7 @@ assert holdout['landuse'].isfactor()
 print holdout['landuse'].unique()
 holdout.describe()
 
-d = h2o.import_file(path = train_data_fp)
+d = tableio.importFrame(train_data_fp)
 print "Making 'time_period' and 'landuse' a factor..."
 d['time_period'] = d['time_period'].asfactor()
 assert d['time_period'].isfactor()
@@ -66,6 +69,7 @@ assert d['landuse'].isfactor()
 print d['landuse'].unique()
 d.describe()
 
+@logger.timed()
 def fit_predict_gbm(params, predictors, csvfile, saving_varimp_fp):
   ntrees, max_depth, learn_rate = params
   time1 = time.time()
@@ -153,6 +157,7 @@ def final_predict(best_params, predict_function,
   out = predict_function(best_params, predictors, csvfile, saving_varimp_fp)
   out.to_csv(csvfile_vector, header=True, index=False)
 
+logger.step('predict')
 gbm = pd.read_csv(training_res_fp, sep=',')
 # dl = pd.read_csv("output/dlres.csv", sep=',')
 # 
@@ -30,6 +30,14 @@ except ImportError:
     except ImportError:
         raise 'Python GDAL library not found, please install python-gdal'
 
+try:
+    import osgeo.ogr as ogr
+except ImportError:
+    try:
+        import ogr
+    except ImportError:
+        raise 'Python GDAL library not found, please install python-gdal'
+
 try:
     import pymodis
 except ImportError:
@@ -43,11 +51,84 @@ from gdalconst import *
 gdal.UseExceptions()
 import os, sys
 import glob
+import hashlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import subprocess
 from abc import ABCMeta, abstractmethod
 import logger
+import hdfcache
+import qa
+import stages
+import streamstats
+import colstore
+import datetime
+import json
+import shutil
 #from __future__ import division 
 
+#image whose methods the worker processes of Image._map() call (e.g. _storeDate of matrix())
+_image = None
+
+def _storeDate(args):
+    _image._storeDate(*args)
+
+def _mosaicDate(group):
+    _image._mosaicDate(group)
+
+def _convertVRT(vrt):
+    _image._convertVRT(vrt)
+
+def _storeWindow(window):
+    _image._storeWindow(window)
+
+def _columnScales(path, count):
+    #scale factors and no data value of raw integer columns (compact mode), written next to the matrix
+    if not os.path.isfile(path):
+        return [None]*count, None
+    with open(path) as f:
+        meta = json.load(f)
+    if len(meta['scale']) != count:
+        raise IOError('%s has %d scale factors but its matrix has %d columns' % (path, len(meta['scale']), count))
+    return meta['scale'], meta['nodata']
+
+def _columnNames(path, count):
+    #one name per line, as written by quality(); names may contain spaces (e.g. Pixel Reliability)
+    if os.path.isfile(path):
+        names = [n.strip() for n in open(path).read().splitlines() if n.strip()]
+        if len(names) != count:
+            names = open(path).read().split()
+        if len(names) == count:
+            return names
+        raise IOError('%s names %d columns but its matrix has %d' % (path, len(names), count))
+    if count == 1:
+        return [os.path.basename(path)[:-len('.txt')]]
+    raise IOError('No column names for the %d columns of %s.npy. Please add %s' % (count, path[:-len('.txt')], os.path.basename(path)))
+
+def _spanFields(image, *args, **kwargs):
+    #dataset and matrix sizes recorded with the timing of every Image stage (see logger.span)
+    matrices = [(name, getattr(image, name, None)) for name in ('DC', 'finalDC')]
+    return {'dataset': image.dataset, 'arrays': dict((name, logger.array(a)) for name, a in matrices if isinstance(a, np.ndarray))}
+
+_timed = logger.timed(fields = _spanFields)
+
+class _PixelSubset(object):
+
+    #rows of a full-raster matrix column that belong to the pixels in pixelIndex,
+    #selected lazily one block of intervals at a time as the column store reads them
+
+    def __init__(self, column, pixelIndex, fullPixels):
+        self.column = column
+        self.pixelIndex = pixelIndex
+        self.fullPixels = fullPixels
+        self.dtype = column.dtype
+        self.shape = (column.shape[0] // fullPixels*len(pixelIndex),)
+
+    def __getitem__(self, rows):
+        n = len(self.pixelIndex)
+        start, stop = rows.start // n, rows.stop // n
+        block = np.asarray(self.column[start*self.fullPixels:stop*self.fullPixels]).reshape((stop - start, self.fullPixels))
+        return block[:, self.pixelIndex].reshape(-1)
 
 class Image(object):
     
@@ -55,7 +136,7 @@ class Image(object):
     
     __metaclass__ = ABCMeta
        
-    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, scale, varNames, qualityBand):
+    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, scale, varNames, qualityBand, memmap = False, ingest = 'gdal', workers = 1, composite = 'first', qaRule = 'legacy', cache = None, downloadWorkers = 8, url = 'http://e4ftl01.cr.usgs.gov', legacyMatrix = False, gridLag = 150, update = None, window = None, compact = False, regionMask = None, resume = False, verifyStages = False, verifyCache = False):
         
         """
 		:param directory: path to the directory in which all images and matrices
@@ -73,7 +154,8 @@ class Image(object):
 			subset = '1 0 0 0 0 0 0 0 0 0 0 1'
 		
 		:param tiles: string of the MODIS tiles to be downloaded, e.g. 'h08v05'.  
-			Adjacent tiles should be written as ['h08v04', 'h08v05']
+			Adjacent tiles should be written as ['h08v04', 'h08v05'].  Any number of 
+			tiles can be mosaicked.
 		
 		:param today: the most recent date from which to download data
 		
@@ -118,6 +200,82 @@ class Image(object):
         
         :param qualityBand:  flag for the location of the quality dataset in the original HDF file
         
+        :param memmap:  if True, the band matrix, the 16-day matrix and the final matrix are 
+            written directly into memory-mapped .npy files and filled chunk by chunk instead
+            of being held in RAM.  The saved .npy files are identical in both modes.
+        
+        :param ingest:  how the HDF files are brought onto the referenceImage grid.  'gdal' 
+            mosaics, converts and clips the files with pyModis and gdalwarp.  'lookup' builds
+            a nearest-neighbour resampling index once (see lookup()) and gathers every date
+            straight from the HDF files without writing any intermediate GeoTIFFs.  'warp'
+            mosaics and warps each date in process with gdal.BuildVRT and gdal.Warp on
+            in-memory datasets (GDAL >= 2.1), without subprocesses or files on disk.
+        
+        :param workers:  number of processes that read, reproject and store the dates in
+            matrix().  With the 'lookup' and 'warp' ingest modes each worker runs the whole
+            chain for its dates and writes its slice into a shared band matrix; with 'gdal'
+            the mosaics of mosaic(), the reprojections of convert() and the gdalwarp calls
+            of clip() also run in parallel.
+        
+        :param composite:  how quality() combines the two 8-day images of a 16-day interval.
+            'first' keeps the first image, as the published matrices did, 'mean' averages
+            and 'max' takes the maximum of the images that pass the quality mask.
+        
+        :param qaRule:  masking rule applied to the QA band in quality(): 'legacy' (QA bit 0,
+            the original mask), 'modland' or 'strict'.  See qa.py for the bits each rule
+            tests for each product.
+        
+        :param cache:  directory of a local HDF cache shared across regions and runs.  If
+            given, download() fetches the tiles with up to downloadWorkers concurrent, 
+            resumable downloads, skips every file that is already complete in the cache 
+            and links the files into fullPath (see hdfcache.py).
+        
+        :param downloadWorkers:  maximum number of concurrent downloads into the cache
+        
+        :param verifyCache:  if True, the MD5 checksum of every file already in the cache
+            is recomputed and compared with its record before it is reused, instead of 
+            only its size.  New downloads are always checked against the archive checksum.
+        
+        :param url:  server of the MODIS archive
+        
+        :param legacyMatrix:  if True, finalMatrix() also writes the dense finalMatrix.npy,
+            columnNames.txt and coordinates.npz next to the column store
+        
+        :param gridLag:  size in pixels of the square blocks numbered by the autocorrelationGrid
+            column, which is used to split the data into training and testing sets
+        
+        :param update:  path of an existing column store (e.g. /data/SL/finalMatrix) to extend
+            incrementally.  prepare() then only downloads and processes the dates after the
+            last date recorded in the store, directory serves as a staging directory for
+            them, and finalMatrix() appends the new intervals to the store instead of
+            building a new one.
+        
+        :param window:  if given, e.g. 512, prepare() processes the referenceImage in windows 
+            of window by window pixels with windowMatrix() instead of matrix() and quality(),
+            so that only one window of the band matrix is held in memory at a time
+        
+        :param compact:  if True, the bands are kept as raw integers instead of scaled float64.
+            The band matrix is int32 and the 16-day matrix uses the product's rawType 
+            (int16, or int32 for the uint16 LST of MOD11A2); the scale factor and no data
+            value of every column are written to dataset.json and the column store 
+            applies the scaling when the column is read.  The mean composite is rounded 
+            to whole raw units.
+        
+        :param regionMask:  raster or shapefile (.shp) of the region of interest.  Only the
+            pixels of the referenceImage grid inside the region (non-zero, valid mask pixels, 
+            or pixels whose centre lies in a polygon) are kept, from matrix() onward, so 
+            every later stage only handles these pixels.  A raster that does not match the
+            referenceImage grid is resampled to it.  Their row-major positions on the 
+            referenceImage grid are kept in pixelIndex and stored with the column store.
+        
+        :param resume:  if True, prepare() resumes a run that failed: the stages recorded 
+            in fullPath/stages.json (see stages.py) up to the last one whose output files
+            are intact are skipped.  Every run records its completed stages, with the size
+            and modification time of their output files, and keeps the GeoTIFFs read by 
+            matrix() until quality() is recorded, so that any failed run can be resumed.
+        
+        :param verifyStages:  if True, the MD5 checksums of the stage outputs are recorded
+            as well and compared when resuming, instead of only their size and time.
         
 		"""
         
@@ -125,13 +283,11 @@ class Image(object):
         self.fullPath = directory + '/' + dataset ###how else to connect path? 
         self.username = username
         self.password = password
-        self.url = 'http://e4ftl01.cr.usgs.gov'
+        self.url = url
         self.path = 'MOLT'
         self.dataset = dataset
         self.subset = subset
         self.tiles = tiles
-        if len(self.tiles) > 2:
-             raise IOError("A maximum of two MODIS tiles can be included. Please remove extra tiles")
         self.today = today
         self.enddate = enddate
 
@@ -149,7 +305,30 @@ class Image(object):
         self.scale = scale
         self.varNames = varNames
         self.qualityBand = qualityBand
+        self.memmap = memmap
+        if ingest not in ('gdal', 'lookup', 'warp'):
+            raise IOError("Unknown ingest mode %s. Please use 'gdal', 'lookup' or 'warp'" % str(ingest))
+        self.ingest = ingest
+        self.workers = workers
+        if composite not in ('first', 'mean', 'max'):
+            raise IOError("Unknown composite %s. Please use 'first', 'mean' or 'max'" % str(composite))
+        self.composite = composite
+        qa.table(dataset, qaRule)  #fails early on an unknown rule
+        self.qaRule = qaRule
+        self.cache = cache
+        self.downloadWorkers = downloadWorkers
+        self.legacyMatrix = legacyMatrix
+        self.gridLag = gridLag
+        self.update = update
+        self.window = window
+        self.compact = compact
+        self.regionMask = regionMask
+        self.pixelIndex = self._regionPixels(regionMask) if regionMask else None
+        self.resume = resume
+        self.verifyStages = verifyStages
+        self.verifyCache = verifyCache
                            
+    @_timed
     def download(self):
         
         """
@@ -167,101 +346,130 @@ class Image(object):
         if not os.path.exists(self.fullPath):
             os.mkdir(self.fullPath)
             
-        dm = pymodis.downmodis.downModis(self.fullPath, self.password, self.username, self.url, self.tiles, self.path, self.dataset, 
-                                         self.today, self.enddate, jpg = False, debug = True, timeout = 30)
-        dm.connect()
-        self.filelist = dm.getListDays() 
-        self.observations = len(dm.getListDays())  
+        if self.cache:
+            hc = hdfcache.HDFCache(self.cache, self.url, self.path, self.dataset, self.tiles, self.username, self.password, workers = self.downloadWorkers, verify = self.verifyCache)
+            self.filelist = hc.listDays(self.today, self.enddate)
+        else:
+            dm = pymodis.downmodis.downModis(self.fullPath, self.password, self.username, self.url, self.tiles, self.path, self.dataset, 
+                                             self.today, self.enddate, jpg = False, debug = True, timeout = 30)
+            dm.connect()
+            self.filelist = dm.getListDays() 
+        self.observations = len(self.filelist)
         
         if self.dataset != 'MOD13Q1.005':
+             if self.observations % 2 != 0 and self.update:
+                 #the second image of the newest 16-day interval is not published yet
+                 logger.log('WARNING', 'The second image of the 16-day interval starting %s is not available yet, the interval is left for the next update' % str(self.filelist[0]))
+                 self.today = (datetime.datetime.strptime(str(self.filelist[0]), '%Y.%m.%d') - datetime.timedelta(days = 1)).strftime('%Y-%m-%d')
+                 return self.download()
              if self.observations % 2 != 0:
                  raise IOError("The total number of observations through time must be an even number. Please add or remove an observation before or after %s" % str(self.filelist[0]))
                      
-        dm.downloadsAllDay()
+        if self.cache:
+            hc.download(self.filelist, self.fullPath)
+        else:
+            dm.downloadsAllDay()
         logger.log('SUCCESS', 'Downloading is complete!  %d HDF files of %s data for tiles %s were downloaded for the following days:  %s' % (self.observations*len(self.tiles), str(self.dataset), str(self.tiles), str(self.filelist)))
         
+    @_timed
     def mosaic(self):
         
         """
-		If more than two tiles are input by the user, this function mosaics the tiles
-		together.		
+		If more than one tile is input by the user, this function mosaics the tiles
+		together.  The HDF files are grouped by acquisition date (see _hdfGroups()),
+		so any number of tiles can be mosaicked, and the mosaic of every date is 
+		built in its own worker process when workers > 1.
 		"""
         
         if len(self.tiles) > 1:
-            hdflist = sorted(glob.glob(self.fullPath + '/*.hdf'))
-            for i in range(0,len(hdflist),2):
-                ms = pymodis.convertmodis_gdal.createMosaicGDAL(hdfnames = [hdflist[i], hdflist[i+1]], subset = self.subset, outformat = 'GTiff')
-                ms.run(str(hdflist[i].split('.h')[0]) + 'mos.tif')
-                ms.write_vrt(output = str(hdflist[i].split('.h')[0]), separate = True)
+            self._map(_mosaicDate, self._hdfGroups())
             mosaicCount = len(glob.glob(self.fullPath + '/*mos.tif'))
             logger.log('SUCCESS', 'Mosaic complete!  MODIS tiles %s were successfully mosaicked into %d mosaic images.' % (str(self.tiles), mosaicCount)) 
+
+    @_timed
+    def _mosaicDate(self, group):
+        date, hdfs = group
+        #e.g. fullPath/MOD13Q1.A2014001
+        output = self.fullPath + '/' + os.path.basename(hdfs[0]).split('.h')[0]
+        ms = pymodis.convertmodis_gdal.createMosaicGDAL(hdfnames = hdfs, subset = self.subset, outformat = 'GTiff')
+        ms.run(output + 'mos.tif')
+        ms.write_vrt(output = output, separate = True)
                            
+    @_timed
     def convert(self):
         
         """
 		This function converts the HDF files into the file extension of the 
 		referenceImage.  It projects images into the projection of the referenceImage using the vrt files produced in the mosaic step.  
         If no vrt files were produced in the previous step, it converts the original hdf files.  
+        Like the mosaics, every date is converted in its own worker process when workers > 1.
 		
 		"""
         
         vrtlist = sorted(glob.glob(self.fullPath + '/*vrt'))
-        splitAt = len(self.fullPath) + 1
-        
-        if len(vrtlist)!=0:
-            for i in range(0,len(vrtlist)):
-                prefix = str(vrtlist[i].split(".vrt")[0])
-                prefix = prefix[:splitAt] + 'full' + prefix[splitAt:]
-                ct = pymodis.convertmodis_gdal.convertModisGDAL(hdfname = vrtlist[i], 
-                prefix = prefix, subset = self.subset, res = self.resolution, 
-                outformat = self.outformat, wkt = self.projection, resampl = 'NEAREST_NEIGHBOR', vrt = True)
-                ct.run()
-            mosdel = glob.glob(self.fullPath + '/*mos.tif')
-            for f in mosdel:
-                os.remove(f)
-            xmldel = glob.glob(self.fullPath + '/*mos.tif.xml') 
-            for f in xmldel:
-                os.remove(f)
-            vrtdel = glob.glob(self.fullPath + '/*.vrt')
-            for f in vrtdel:
-                os.remove(f)
-            tifCount = len(glob.glob(self.fullPath + '/*.tif'))
-            dataCount = self.subset.count('1')
-            logger.log('SUCCESS', 'Conversion complete!  The %d bands of %d mosaicked images were successfully converted to %d %s files.' % (dataCount, len(vrtlist), tifCount, str(self.outformat)))
-        
-        
+        hdflist = []
         if len(vrtlist)==0: 
-            
+            #a single tile is "mosaicked" on its own to get the vrt files of its bands
             hdflist = sorted(glob.glob(self.fullPath + '/*.hdf'))
-            for i in range(len(hdflist)):
-                ms = pymodis.convertmodis_gdal.createMosaicGDAL(hdfnames = [hdflist[i]], subset = self.subset, outformat = 'GTiff')
-                ms.run(str(hdflist[i].split('.h')[0]) + 'mos.tif')
-                ms.write_vrt(output = str(hdflist[i].split('.h')[0]), separate = True)
-
+            self._map(_mosaicDate, [(None, [hdf]) for hdf in hdflist])
             vrtlist = sorted(glob.glob(self.fullPath + '/*vrt'))
-            splitAt = len(self.fullPath) + 1
-        
-            for i in range(0,len(vrtlist)):
-                prefix = str(vrtlist[i].split(".vrt")[0])
-                prefix = prefix[:splitAt] + 'full' + prefix[splitAt:]
-                ct = pymodis.convertmodis_gdal.convertModisGDAL(hdfname = vrtlist[i], 
-                prefix = prefix, subset = self.subset, res = self.resolution, 
-                outformat = self.outformat, wkt = self.projection, resampl = 'NEAREST_NEIGHBOR', vrt = True)
-                ct.run()
-                
-            mosdel = glob.glob(self.fullPath + '/*mos.tif')
-            for f in mosdel:
-                os.remove(f)
-            xmldel = glob.glob(self.fullPath + '/*mos.tif.xml') 
-            for f in xmldel:
-                os.remove(f)
-            vrtdel = glob.glob(self.fullPath + '/*.vrt')
-            for f in vrtdel:
-                os.remove(f)
-            tifCount = len(glob.glob(self.fullPath + '/full*.tif'))
-            dataCount = self.subset.count('1')
+
+        #every date is reprojected in its own worker process when workers > 1
+        self._map(_convertVRT, vrtlist)
+
+        mosdel = glob.glob(self.fullPath + '/*mos.tif')
+        for f in mosdel:
+            os.remove(f)
+        xmldel = glob.glob(self.fullPath + '/*mos.tif.xml') 
+        for f in xmldel:
+            os.remove(f)
+        vrtdel = glob.glob(self.fullPath + '/*.vrt')
+        for f in vrtdel:
+            os.remove(f)
+        tifCount = len(glob.glob(self.fullPath + '/full*.tif'))
+        dataCount = self.subset.count('1')
+        if len(hdflist)==0:
+            logger.log('SUCCESS', 'Conversion complete!  The %d bands of %d mosaicked images were successfully converted to %d %s files.' % (dataCount, len(vrtlist), tifCount, str(self.outformat)))
+        else:
             logger.log('SUCCESS',  'Conversion complete!  The %d bands of %d HDF files were successfully converted to %d %s files.' % (dataCount, len(hdflist), tifCount, str(self.outformat)))
+
+    @_timed
+    def _convertVRT(self, vrt):
+        splitAt = len(self.fullPath) + 1
+        prefix = str(vrt.split(".vrt")[0])
+        prefix = prefix[:splitAt] + 'full' + prefix[splitAt:]
+        ct = pymodis.convertmodis_gdal.convertModisGDAL(hdfname = vrt, 
+        prefix = prefix, subset = self.subset, res = self.resolution, 
+        outformat = self.outformat, wkt = self.projection, resampl = 'NEAREST_NEIGHBOR', vrt = True)
+        ct.run()
+
+    def _map(self, function, items):
+
+        """
+        Calls function, the module-level wrapper of a method (e.g. _mosaicDate),
+        on every item, in a pool of workers processes when workers > 1.  The
+        pool is terminated if a worker fails.
+        """
+
+        global _image
+        _image = self
+        pool = None
+        try:
+            if self.workers > 1:
+                pool = multiprocessing.Pool(self.workers)
+                pool.map(function, items)
+                pool.close()
+                pool.join()
+                pool = None
+            else:
+                for item in items:
+                    function(item)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            _image = None
                             
+    @_timed
     def clip(self):
         
         """
@@ -274,10 +482,21 @@ class Image(object):
         dataNames = sorted(glob.glob(self.fullPath + '/full*.tif'))
         splitAt = len(self.fullPath) + 1
 
+        commands = []
         for i in range(len(dataNames)):
             x = dataNames[i]
             y = dataNames[i][:splitAt] + dataNames[i][splitAt+4:]
-            subprocess.call(['gdalwarp', '-r', 'near', '-cutline', self.extent, '-crop_to_cutline', x, y, '-dstnodata', '9999'])
+            if os.path.exists(y):
+                #left by an interrupted run, gdalwarp would warp into it
+                os.remove(y)
+            commands.append(['gdalwarp', '-r', 'near', '-cutline', self.extent, '-crop_to_cutline', x, y, '-dstnodata', '9999'])
+        if self.workers > 1:
+            pool = ThreadPool(self.workers)
+            pool.map(subprocess.call, commands)
+            pool.close()
+        else:
+            for c in commands:
+                subprocess.call(c)
           
         for n in dataNames:
             os.remove(n)
@@ -285,6 +504,147 @@ class Image(object):
         test = gdal.Open(dataNames[0]).ReadAsArray()
         logger.log('SUCCESS', 'Clipping complete!  %d %s files  were successfully clipped to the size of %s with dimensions %d rows by %d columns' % (len(dataNames), str(self.outformat), str(self.referenceImagePath), test.shape[0], test.shape[1]))
                           
+    @_timed
+    def lookup(self):
+        
+        """
+        This function replaces convert() and clip() when ingest = 'lookup'.  It 
+        builds a resampling index that holds, for every pixel of the referenceImage,
+        the position of the nearest-neighbour source pixel in the MODIS tiles of one
+        date.  The index only depends on the product resolution, the tiles and the
+        referenceImage, so it is cached in directory and reused for every date and
+        every run.
+        """
+        
+        groups = self._hdfGroups()
+        band = [int(s) for s in self.subset.split() if s.isdigit()].index(1)
+        sources = [gdal.Open(gdal.Open(h).GetSubDatasets()[band][0], GA_ReadOnly) for h in groups[0][1]]
+        gts = [src.GetGeoTransform() for src in sources]
+        sizes = [(src.RasterYSize, src.RasterXSize) for src in sources]
+        refgt = self.referenceImage.GetGeoTransform()
+        
+        key = hashlib.md5(repr((sorted(self.tiles), gts, sizes, refgt, self.projection, self.rows, self.columns))).hexdigest()
+        #in update mode the index of the full build is reused
+        cache = (os.path.dirname(self.update) if self.update else str(self.directory)) + '/lookup_' + key[:12] + '.npz'
+        if os.path.isfile(cache):
+            self.lookupIndex = np.load(cache)['index']
+            logger.log('SUCCESS', 'Resampling index for tiles %s loaded from %s' % (str(self.tiles), cache))
+            return
+        
+        srcSRS = osr.SpatialReference()
+        srcSRS.ImportFromWkt(sources[0].GetProjection())
+        refSRS = osr.SpatialReference()
+        refSRS.ImportFromWkt(self.projection)
+        for srs in (srcSRS, refSRS):
+            if hasattr(srs, 'SetAxisMappingStrategy'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        ct = osr.CoordinateTransformation(refSRS, srcSRS)
+        
+        #tiles are read as one flat array, tile after tile; -1 marks pixels no tile covers
+        index = np.empty(self.rows*self.columns, dtype = np.int32)
+        col = np.arange(self.columns) + 0.5
+        for r in range(self.rows):
+            x = refgt[0] + col*refgt[1] + (r + 0.5)*refgt[2]
+            y = refgt[3] + col*refgt[4] + (r + 0.5)*refgt[5]
+            pts = np.array(ct.TransformPoints(np.c_[x, y].tolist()))
+            rowIndex = np.empty(self.columns, dtype = np.int64)
+            rowIndex[:] = -1
+            offset = 0
+            for gt, (ny, nx) in zip(gts, sizes):
+                sc = np.floor((pts[:,0] - gt[0])/gt[1]).astype(np.int64)
+                sr = np.floor((pts[:,1] - gt[3])/gt[5]).astype(np.int64)
+                inside = (rowIndex == -1) & (sc >= 0) & (sc < nx) & (sr >= 0) & (sr < ny)
+                rowIndex[inside] = offset + sr[inside]*nx + sc[inside]
+                offset += ny*nx
+            index[r*self.columns:(r+1)*self.columns] = rowIndex
+        
+        np.savez(cache, index = index)
+        self.lookupIndex = index
+        logger.log('SUCCESS', 'Resampling index for tiles %s built with %d of %d pixels covered and cached in %s' % (str(self.tiles), (index >= 0).sum(), index.shape[0], cache))
+    
+    def _hdfGroups(self):
+        
+        """
+        Returns the downloaded HDF files grouped by acquisition date as a sorted 
+        list of (date, files) with the files of each date sorted by tile.  Every
+        date must have exactly one file for each tile.
+        """
+        
+        groups = {}
+        for h in glob.glob(self.fullPath + '/*.hdf'):
+            #e.g. MOD13Q1.A2014001.h25v08.005.2014018064023.hdf
+            groups.setdefault(os.path.basename(h).split('.')[1], []).append(h)
+        for d in sorted(groups):
+            found = sorted(os.path.basename(h).split('.')[2] for h in groups[d])
+            if found != sorted(self.tiles):
+                raise IOError("The HDF files of %s are for tiles %s but tiles %s were requested. Please download the missing tiles again or remove the extra files from %s" % (d, str(found), str(sorted(self.tiles)), self.fullPath))
+        return [(d, sorted(groups[d])) for d in sorted(groups)]
+    
+    def _lookupDate(self, hdfs, window = None):
+        
+        """
+        Gathers the selected bands of one date from its HDF files with the 
+        resampling index.  Pixels not covered by any tile are set to 9999.
+        With a window (xoff, yoff, xsize, ysize) of the referenceImage grid,
+        only the part of every tile that the window needs is read.
+        """
+        
+        if len(hdfs) != len(self.tiles):
+            raise IOError("Expected %d HDF files for %s but found %d" % (len(self.tiles), str(hdfs[0]), len(hdfs)))
+        xoff, yoff, xsize, ysize = window or (0, 0, self.columns, self.rows)
+        index = self.lookupIndex.reshape((self.rows, self.columns))[yoff:yoff + ysize, xoff:xoff + xsize].ravel()
+        subsetInt = [int(s) for s in self.subset.split() if s.isdigit()]
+        subdatasets = [gdal.Open(h).GetSubDatasets() for h in hdfs]
+        out = []
+        for b in range(len(subsetInt)):
+            if subsetInt[b] == 1:
+                #pixels no tile covers (index -1) keep the no data value
+                data = np.empty(index.shape[0], dtype = np.int32)
+                data[:] = 9999
+                offset = 0
+                for sd in subdatasets:
+                    src = gdal.Open(sd[b][0], GA_ReadOnly)
+                    nx = src.RasterXSize
+                    inside = (index >= offset) & (index < offset + src.RasterYSize*nx)
+                    if inside.any():
+                        sr, sc = np.divmod(index[inside] - offset, nx)
+                        r0, c0 = sr.min(), sc.min()
+                        tile = src.ReadAsArray(int(c0), int(r0), int(sc.max() - c0 + 1), int(sr.max() - r0 + 1))
+                        data[inside] = tile[sr - r0, sc - c0]
+                    offset += src.RasterYSize*nx
+                out.append(data.reshape((ysize, xsize)))
+        return out
+        
+    def _warpDate(self, hdfs, window = None):
+        
+        """
+        Mosaics, reprojects and clips the selected bands of one date to the 
+        referenceImage grid in memory.  The tiles of each band are joined in a
+        /vsimem/ VRT and warped with nearest-neighbour resampling into an 
+        in-memory dataset with the size, extent and projection of the 
+        referenceImage, or of a window (xoff, yoff, xsize, ysize) of it.
+        Pixels not covered by any tile are set to 9999.
+        """
+        
+        subsetInt = [int(s) for s in self.subset.split() if s.isdigit()]
+        subdatasets = [gdal.Open(h).GetSubDatasets() for h in hdfs]
+        xoff, yoff, xsize, ysize = window or (0, 0, self.columns, self.rows)
+        gt = self.referenceImage.GetGeoTransform()
+        bounds = (gt[0] + xoff*gt[1], gt[3] + (yoff + ysize)*gt[5], gt[0] + (xoff + xsize)*gt[1], gt[3] + yoff*gt[5])
+        out = []
+        for b in range(len(subsetInt)):
+            if subsetInt[b] == 1:
+                vrt = '/vsimem/%s_%d_%d_%d.vrt' % (os.path.basename(hdfs[0]), b, xoff, yoff)
+                gdal.BuildVRT(vrt, [sd[b][0] for sd in subdatasets])
+                ds = gdal.Warp('', vrt, format = 'MEM', dstSRS = self.projection, outputBounds = bounds,
+                               width = xsize, height = ysize, resampleAlg = 'near', 
+                               dstNodata = 9999, outputType = gdal.GDT_Int32)
+                out.append(ds.ReadAsArray())
+                ds = None
+                gdal.Unlink(vrt)
+        return out
+        
+    @_timed
     def matrix(self):
         
         """
@@ -295,60 +655,242 @@ class Image(object):
 		"""
         
         dataCount = self.subset.count('1')
-        dataNames = sorted(glob.glob(self.fullPath + '/*.tif'))
-        dataNames = dataNames[0:dataCount]
-        subsetInt = [int(s) for s in self.subset.split() if s.isdigit()] 
-                
-        DC = np.empty(shape = (self.rows*self.columns*self.observations,0))  
-        DCs = np.empty(shape = (self.rows*self.columns*self.observations, subsetInt.count(1)))  
-        
-        for i in range(dataCount):
-            name = str(dataNames[i])
-            dataList = sorted(glob.glob(self.fullPath + '/*' + name[-10:-4] + '.tif'))  
-            bandDC = np.empty((0, 1))      
-            for b in dataList:
-                data = gdal.Open(str(b), GA_ReadOnly).ReadAsArray()
-                vec = data.reshape((self.rows*self.columns, 1))
-                bandDC = np.append(bandDC, vec, axis = 0)  
-            DC = np.append(DC, bandDC, axis = 1) 
-            del vec, bandDC, data
-        
-        #apply fill values    
-        if self.dataset == 'MOD15A2.005' or self.dataset == 'MOD17A2.005':
-            DC[DC>self.fillValue] = 9999.0                
-        if self.dataset == 'MOD11A2.005':
-            DC[:,0][DC[:,0] == self.fillValue] = 9999.0 #this should have fixed it!
+        pixels = self._pixels()
+
+        #final matrix is allocated once and filled in place, one date at a time
+        self.DC = self._array(self.fullPath + '/' + self.dataset + '_DC.npy', (pixels*self.observations, dataCount), dtype = np.int32 if self.compact else float, shared = self.workers > 1)
+
+        dates = self._dates()
+        self._map(_storeDate, [(j, dates[j]) for j in range(len(dates))])
+
+        self._metadata()
+        logger.log('SUCCESS', 'The %s data was transformed into an array with dimensions %d rows by %d columns.  No data value set to 9999.  A metadata file with object attributes was created.  To access the matrix, simply call object.DC' % (str(self.outformat), self.DC.shape[0], self.DC.shape[1]))
+
+        #the GeoTIFFs are kept so that a failed quality() can be resumed, prepare() removes them after it
+
+    def _removeGeoTIFFs(self):
+        for t in sorted(glob.glob(self.fullPath + '/*.tif')):
+            os.remove(t)
+
+    def _regionPixels(self, regionMask):
+
+        """
+        Returns the row-major positions on the referenceImage grid of the pixels
+        inside regionMask, a shapefile or a raster.
+        """
+
+        gt = self.referenceImage.GetGeoTransform()
+        if regionMask.lower().endswith('.shp'):
+            source = ogr.Open(regionMask)
+            if source is None:
+                raise IOError('Could not open the region mask %s' % regionMask)
+            mask = gdal.GetDriverByName('MEM').Create('', self.columns, self.rows, 1, gdal.GDT_Byte)
+            mask.SetGeoTransform(gt)
+            mask.SetProjection(self.projection)
+            gdal.RasterizeLayer(mask, [1], source.GetLayer(0), burn_values = [1])
+            valid = mask.ReadAsArray() != 0
         else:
-            DC[DC == self.fillValue] = 9999.0 
-        
-        
-        #scale dataset
-        count = 0    
-        for i in range(len(subsetInt)):
-            if subsetInt[i] == 1:
-                DCs[:,count] = np.multiply(DC[:,count], self.scale[i])
-                count += 1
-        DCs[DC == 9999.0] = 9999.0
-        self.DC = DCs
-        del DC
-        
-        #metadata function        
+            mask = gdal.Open(regionMask)
+            if (mask.RasterXSize, mask.RasterYSize, mask.GetGeoTransform()) != (self.columns, self.rows, gt):
+                bounds = (gt[0], gt[3] + self.rows*gt[5], gt[0] + self.columns*gt[1], gt[3])
+                mask = gdal.Warp('', mask, format = 'MEM', dstSRS = self.projection, outputBounds = bounds,
+                                 width = self.columns, height = self.rows, resampleAlg = 'near', dstNodata = 0)
+            band = mask.GetRasterBand(1)
+            data = band.ReadAsArray()
+            valid = data != 0
+            if band.GetNoDataValue() is not None:
+                valid &= data != band.GetNoDataValue()
+        pixelIndex = np.flatnonzero(valid)
+        if pixelIndex.shape[0] == 0:
+            raise IOError('The region mask %s covers no pixel of %s' % (regionMask, self.referenceImagePath))
+        logger.log('SUCCESS', 'Region mask %s keeps %d of %d pixels of the referenceImage' % (regionMask, pixelIndex.shape[0], self.rows*self.columns))
+        return pixelIndex
+
+    def _pixels(self):
+        #number of pixels kept in the matrices, all of the referenceImage unless a regionMask is given
+        if self.pixelIndex is not None:
+            return self.pixelIndex.shape[0]
+        return self.rows*self.columns
+
+    def _metadata(self):
         with open(self.fullPath + '/' + 'metadata_' + self.dataset + '.txt', 'w') as f:
             f.write(' '.join(["self.%s = %s" % (k,v) for k,v in self.__dict__.iteritems()]))
-        
-        logger.log('SUCCESS', 'The %s data was transformed into an array with dimensions %d rows by %d columns.  No data value set to 9999.  A metadata file with object attributes was created.  To access the matrix, simply call object.DC' % (str(self.outformat), self.DC.shape[0], self.DC.shape[1]))
 
-        tif = sorted(glob.glob(self.fullPath + '/*.tif'))
-        for t in tif:
-            os.remove(t)
-    
+    @_timed
+    def windowMatrix(self):
+
+        """
+        Block-windowed replacement for matrix() and quality() for reference images
+        larger than memory.  The referenceImage grid is walked in windows of
+        window by window pixels; for every window and 16-day interval the images
+        are read for that window only (GeoTIFF windows, the part of the HDF tiles
+        the window needs, or a warp to the window's extent), scaled, masked and
+        composited, and written into the window's rows of the memory-mapped
+        16-day matrix.  The full band matrix is never built.  With workers > 1
+        the windows are processed in parallel.
+        """
+
+        columnNames, q, bands = self._qualityColumns()
+        pixels = self._pixels()
+        obs = self._periods()
+        self.finalDC = np.lib.format.open_memmap(str(self.directory) + '/' + self.dataset + '.npy', mode = 'w+', shape = (pixels*obs, len(bands)), dtype = self.rawType if self.compact else float)
+
+        windows = [(x, y, min(self.window, self.columns - x), min(self.window, self.rows - y))
+                   for y in range(0, self.rows, self.window) for x in range(0, self.columns, self.window)]
+        self._map(_storeWindow, windows)
+        self.finalDC.flush()
+
+        self._metadata()
+        logger.log('SUCCESS', 'The %s data was processed in %d windows of up to %d by %d pixels' % (self.dataset, len(windows), self.window, self.window))
+        self._qualityColumnNames(columnNames, q)
+
+    @_timed
+    def _storeWindow(self, window):
+
+        """
+        Reads, scales, masks and composites every interval of one window and
+        writes it into the window's rows of the 16-day matrix.  Windows outside
+        the regionMask are skipped.
+        """
+
+        columnNames, q, bands = self._qualityColumns()
+        subsetInt = [int(s) for s in self.subset.split() if s.isdigit()]
+        scale = [self.scale[i] for i in range(len(subsetInt)) if subsetInt[i] == 1]
+        xoff, yoff, xsize, ysize = window
+        rows = (np.arange(yoff, yoff + ysize).reshape((ysize, 1))*self.columns + np.arange(xoff, xoff + xsize)).ravel()
+        keep = slice(None)
+        if self.pixelIndex is not None:
+            #positions of the window's pixels among the pixels kept by the regionMask
+            position = np.minimum(np.searchsorted(self.pixelIndex, rows), self.pixelIndex.shape[0] - 1)
+            keep = self.pixelIndex[position] == rows
+            if not keep.any():
+                return
+            rows = position[keep]
+        pixels = self._pixels()
+        obs = self._periods()
+        step = self.observations // obs
+        dates = self._dates()
+        block = np.empty((1, step, rows.shape[0], len(columnNames)), dtype = np.int32 if self.compact else float)
+        for k in range(obs):
+            for s in range(step):
+                for i, data in enumerate(self._readDate(dates[k*step + s], window)):
+                    block[0, s, :, i] = self._fillScale(data.reshape(xsize*ysize)[keep], i, scale[i])
+            self.finalDC[k*pixels + rows] = self._qualityBlock(block, q, bands)[0]
+
+    def _dates(self):
+
+        """
+        Lists the inputs of every date in time order.  For the 'gdal' ingest mode
+        these are the clipped GeoTIFFs of each selected band, otherwise the HDF 
+        files of each tile.
+        """
+
+        if self.ingest == 'gdal':
+            dataCount = self.subset.count('1')
+            dataNames = sorted(glob.glob(self.fullPath + '/*.tif'))[0:dataCount]
+            bandLists = [sorted(glob.glob(self.fullPath + '/*' + str(n)[-10:-4] + '.tif')) for n in dataNames]
+            return zip(*bandLists)
+        return [hdfs for date, hdfs in self._hdfGroups()]
+
+    def _readDate(self, date, window = None):
+
+        """
+        Reads the selected bands of one date, as returned by _dates(), as arrays 
+        on the referenceImage grid, or on a window (xoff, yoff, xsize, ysize) of it.
+        """
+
+        if self.ingest == 'lookup':
+            return self._lookupDate(date, window)
+        if self.ingest == 'warp':
+            return self._warpDate(date, window)
+        if window is not None:
+            return [gdal.Open(str(t), GA_ReadOnly).ReadAsArray(*window) for t in date]
+        return [gdal.Open(str(t), GA_ReadOnly).ReadAsArray() for t in date]
+
+    @_timed
+    def _storeDate(self, j, date):
+
+        """
+        Reads date j and writes its bands into the rows of the band matrix
+        that belong to that date.
+        """
+
+        subsetInt = [int(s) for s in self.subset.split() if s.isdigit()]
+        scale = [self.scale[i] for i in range(len(subsetInt)) if subsetInt[i] == 1]
+        pixels = self._pixels()
+        for i, data in enumerate(self._readDate(date)):
+            data = data.reshape(self.rows*self.columns)
+            if self.pixelIndex is not None:
+                data = data[self.pixelIndex]
+            self.DC[j*pixels:(j+1)*pixels, i] = self._fillScale(data, i, scale[i])
+
+    def _fillScale(self, data, band, scale):
+
+        """
+        Sets the fill values of one band of one image to 9999.0 and applies the
+        band's scale factor to the remaining values.  band is the position of the
+        band among the selected datasets.  In compact mode the raw values are
+        returned unscaled.
+        """
+
+        data = data.astype(np.int32 if self.compact else float)
+        if self.dataset == 'MOD15A2.005' or self.dataset == 'MOD17A2.005':
+            data[data > self.fillValue] = 9999.0
+        if self.dataset == 'MOD11A2.005':
+            if band == 0:
+                data[data == self.fillValue] = 9999.0
+        else:
+            data[data == self.fillValue] = 9999.0
+        if self.compact:
+            #the scale factor goes to the column metadata and is applied when the column is read
+            return data
+        nv = data == 9999.0
+        data *= scale
+        data[nv] = 9999.0
+        return data
+
+    @_timed
     def quality(self):
                
         """
-        This function applies the MODIS quality mask to the dataset.  
-        Masked pixels are given a value of 9999.0.  
+        This function applies the MODIS quality mask (decoded with the lookup
+        table of qaRule, see qa.py) to the dataset and 
+        composites the 8-day images into 16-day intervals (see composite).  
+        Masked pixels are given a value of 9999.0.  Each band is reshaped to
+        (intervals, images per interval, pixels) and reduced in one operation,
+        a block of intervals at a time, into the preallocated output, so in 
+        memmap mode it is written straight to disk.
         """       
 
+        columnNames, q, bands = self._qualityColumns()
+        pixels = self._pixels()
+        obs = self._periods()
+        step = self.observations // obs
+        self.finalDC = self._array(str(self.directory) + '/' + self.dataset + '.npy', (pixels*obs, len(bands)), dtype = self.rawType if self.compact else float)
+
+        #intervals per block, about 2**25 values of every band
+        chunk = max(1, 2**25 // (step*pixels))
+        for k in range(0, obs, chunk):
+            n = min(chunk, obs - k)
+            block = self.DC[k*step*pixels:(k + n)*step*pixels].reshape((n, step, pixels, len(columnNames)))
+            self.finalDC[k*pixels:(k + n)*pixels] = self._qualityBlock(block, q, bands).reshape((n*pixels, len(bands)))
+        del block
+        self._save(str(self.directory) + '/' + self.dataset + '.npy', self.finalDC)
+
+        if self.memmap:
+            self.DC = None
+            os.remove(self.fullPath + '/' + self.dataset + '_DC.npy')
+
+        self._qualityColumnNames(columnNames, q)
+
+    def _qualityColumns(self):
+
+        """
+        Returns the names of the selected datasets, the position of the quality
+        band among them (None if it is not selected) and the positions of the
+        other bands.
+        """
+
         subsetInt = [int(s) for s in self.subset.split() if s.isdigit()]
         columnNames = []    
         for i in range(len(subsetInt)):
@@ -356,236 +898,392 @@ class Image(object):
                 columnNames.append(self.varNames[i])
 
         #qualityBand number of subset
-        q = columnNames.index('Quality') 
+        q = columnNames.index('Quality') if subsetInt[self.qualityBand] == 1 else None
+        bands = [b for b in range(len(columnNames)) if b != q]
+        return columnNames, q, bands
 
-        if subsetInt[self.qualityBand] == 1:
-            dataCount = self.subset.count('1')
-            QC = np.repeat(self.DC[:,q].reshape((self.DC.shape[0],1)), dataCount-1, axis = 1)
-            if self.dataset == 'MOD09A1.005' or self.dataset == 'MOD13Q1.005':
-                QC = np.uint16(QC)
-            else:
-                QC = np.uint8(QC)
+    def _qualityBlock(self, block, q, bands):
 
-            QCm = QC & 1  #flips DCm mask
-            DCm = np.delete(self.DC, q, 1)  #looks good
-            
-            DCm = np.ma.masked_where(QCm == 1, DCm)
-            DCm = np.ma.masked_where(DCm == 9999.0, DCm)      
-                        
-            if len(self.tiles) > 1:
-                obs = self.observations/len(self.tiles)
-            if len(self.tiles) == 1:
-                obs = self.observations/2
-            
-            outArray = np.empty(shape = (self.rows*self.columns*obs, 0))
-            for b in range(0, self.DC.shape[1]-1):
-                cfull = DCm[:,b].reshape((self.observations, self.rows, self.columns))
-                b16 = np.empty(shape = (self.rows*self.columns*obs, 0))
-                for band in range(0,cfull.shape[0],2):
-                    c16 = np.ma.mean(cfull[band:band+1,:,:], axis=0)
-                    c16f = np.ma.filled(c16, 9999.0).astype(float).reshape((self.rows*self.columns))
-                    b16 = np.append(b16, c16f)
-                outArray = np.append(outArray, b16.reshape((obs*self.rows*self.columns, 1)), axis = 1)
-                    
-            self.finalDC = outArray
-                    
-            np.save(str(self.directory) + '/' + self.dataset + '.npy', self.finalDC)
-            del outArray, QC, DCm
-
-            outfile = str(self.directory) + '/' + self.dataset + '.txt'
-            f = open(outfile, 'w')
-            for name in columnNames:
-                if name != 'Quality':
-                    f.write(name + '\n')
-            var = [a for a in columnNames if not a.startswith('Quality')]
+        """
+        Masks and composites a block of the band matrix with shape (intervals,
+        images per interval, pixels, selected datasets).
+        """
+
+        data = block[..., bands]
+        bad = data == 9999.0
+        if q is not None:
+            bad |= ~qa.usable(block[..., q], self.dataset, self.qaRule)[..., np.newaxis]
+        return self._composite(data, bad)
+
+    def _qualityColumnNames(self, columnNames, q):
+        outfile = str(self.directory) + '/' + self.dataset + '.txt'
+        f = open(outfile, 'w')
+        for name in columnNames:
+            if name != 'Quality':
+                f.write(name + ' \n')
+        f.close()
+        if self.compact:
+            subsetInt = [int(s) for s in self.subset.split() if s.isdigit()]
+            scale = [self.scale[i] for i in range(len(subsetInt)) if subsetInt[i] == 1]
+            with open(str(self.directory) + '/' + self.dataset + '.json', 'w') as f:
+                json.dump({'scale': [scale[b] for b in range(len(columnNames)) if b != q], 'nodata': 9999}, f)
+        elif os.path.isfile(str(self.directory) + '/' + self.dataset + '.json'):
+            os.remove(str(self.directory) + '/' + self.dataset + '.json')
+        var = [a for a in columnNames if not a.startswith('Quality')]
+        if q is not None:
             logger.log('SUCCESS', 'The final 16-day interval quality-masked matrix was created successfully.  This matrix has dimensions %d rows by %d columns.  Datasets included in the matrix are %s' % (self.finalDC.shape[0], self.finalDC.shape[1], var))
-     
-            
-        if subsetInt[self.qualityBand] != 1:
-            cleanDC = np.delete(self.DC, q, 1)
-            
-                                    
-            if len(self.tiles) > 1:
-                obs = self.observations/len(self.tiles)
-            if len(self.tiles) == 1:
-                obs = self.observations/2
-            
-            outArray = np.empty(shape = (self.rows*self.columns*obs, 0))
-            for b in range(cleanDC.shape[1]):
-                cfull = cleanDC[:,b].reshape((self.observations, self.rows, self.columns))
-                b16 = np.empty(shape=(self.rows*self.columns*obs))
-                for band in range(cfull.shape[0]):
-                    c16 = np.mean(cfull[band:band+1,:,:], axis=0)
-                    band16 = np.append(b16, c16, axis=0)
-                outArray = np.append(outArray, b16.reshape((obs*self.rows*self.columns, 1)), axis = 1)
-
-            np.save(self.directory + '/' + self.dataset + '.npy', self.finalDC)
-            del cleanDC, outArray
-                    
-            outfile = self.directory + '/' + self.dataset + '.txt'
-            f = open(outfile, 'w')
-            for name in columnNames:
-                if name != 'Quality':
-                    f.write(str(name) + ' \n')
-            var = [a for a in columnNames if not a.startswith('Quality')]
+        else:
             logger.log('SUCCESS', 'The final 16-day interval matrix was created successfully.  A quality mask was not applied, though remaining no data values are set at 9999.  This matrix has dimensions %d rows by %d columns.  Datasets included in the matrix are %s' % (self.finalDC.shape[0], self.finalDC.shape[1], var))
+
+    def _composite(self, data, bad):
+
+        """
+        Reduces data with shape (intervals, images per interval, pixels, bands)
+        to one value per interval, ignoring the images flagged in bad.  Intervals 
+        without any usable image are set to 9999.0.
+        """
+
+        if self.composite == 'first':
+            return np.where(bad[:, 0], 9999.0, data[:, 0])
+        good = (~bad).sum(axis = 1)
+        if self.composite == 'mean':
+            with np.errstate(invalid = 'ignore', divide = 'ignore'):
+                out = np.where(bad, 0.0, data).sum(axis = 1)/good
+        else:
+            out = np.where(bad, -np.inf, data).max(axis = 1)
+        if self.compact:
+            out = np.round(out)
+        out[good == 0] = 9999.0
+        return out
+
+    def _periods(self):
+        #number of 16-day intervals; two 8-day images make up one interval
+        return self.observations // 2
+
+    def _array(self, path, shape, dtype = float, shared = False):
+
+        """
+        Returns an uninitialized array for a matrix that will be saved to path.
+        In memmap mode the array is a memory-mapped .npy file at path.  A shared
+        array lives in shared memory so that forked worker processes can fill it.
+        """
+
+        if self.memmap:
+            return np.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = shape)
+        if shared:
+            size = int(np.prod(shape))*np.dtype(dtype).itemsize
+            return np.frombuffer(multiprocessing.RawArray('b', size), dtype = dtype).reshape(shape)
+        return np.empty(shape = shape, dtype = dtype)
+
+    def _save(self, path, array):
+        if self.memmap:
+            array.flush()
+        else:
+            np.save(path, array)
     
+    @_timed
     def qualityCheck(self):
+
+        """
+        Summarizes every column of the 16-day matrix with streamstats.py, in one
+        pass over the memory-mapped matrix: count, missing fraction (9999), 
+        minimum, maximum, mean, variance and histogram.  The statistics are
+        written to qualityCheck<dataset>.json and .csv and the summary to 
+        qualityCheck<dataset>.txt in fullPath.
+        """
+
         d = self.fullPath
         dataset = self.dataset
 
-        outfile = d + '/qualityCheck' + dataset + '.txt'
-        sys.stdout = open(outfile, 'w')
-
-        array = np.load(d + '.npy')
-        t = d + '.txt'
-        with open(t, 'r') as tfile:
-            text = tfile.read().split('\n')
-        text = text[0:-1]
-        nv = array.max()
-
-        #entire dataset
-        print 'Data for entire array of %s data:' % (dataset)
-        print '\t>>> included datasets: %s' % (str(text))
-        print '\t>>> shape:', array.shape
-        print '\t>>> max w nv:', array.max()
-        print '\t>>> max wo nv:', array[array<nv].max()
-        print '\t>>> min wo nv:', array[array<nv].min()
-        print '\t>>> mean wo nv:', array[array<nv].mean()
-
-        #each band
-        for b in range(array.shape[1]):
-            print 'Data for column %d, %s:'% (b, text[b])
-            print '\t>>> max w nv:', array[:,b].max()
-            print '\t>>> max wo nv:', array[:,b][array[:,b]<nv].max()
-            print '\t>>> min wo nv:', array[:,b][array[:,b]<nv].min()
-            print '\t>>> mean wo nv:', array[:,b][array[:,b]<nv].mean()
-
-        sys.stdout = sys.__stdout__
-        
-        logger.log('SUCCESS', 'See file qualityCheck%s.txt for detailed information about the final matrix.' % (self.dataset))
+        array = np.load(d + '.npy', mmap_mode = 'r')
+        array = array.reshape((array.shape[0], 1)) if len(array.shape) == 1 else array
+        text = _columnNames(d + '.txt', array.shape[1])
+        scale, nodata = _columnScales(d + '.json', array.shape[1])
+        stats = streamstats.arrayStats(array, text, nodata = 9999 if nodata is None else nodata, scale = scale)
+        streamstats.write(stats, d + '/qualityCheck' + dataset)
+        whole = streamstats.total(stats).result()
+
+        with open(d + '/qualityCheck' + dataset + '.txt', 'w') as out:
+            #entire dataset
+            out.write('Data for entire array of %s data:\n' % (dataset))
+            out.write('\t>>> included datasets: %s\n' % (str(text)))
+            out.write('\t>>> shape: %s\n' % (str(array.shape)))
+            for b, s in [(None, whole)] + list(enumerate([s.result() for s in stats])):
+                if b is not None:
+                    #each band
+                    out.write('Data for column %d, %s:\n' % (b, text[b]))
+                out.write('\t>>> missing: %d of %d (%.4f)\n' % (s['missing'], s['count'], s['missingFraction'] or 0))
+                out.write('\t>>> max wo nv: %s\n' % (s['max']))
+                out.write('\t>>> min wo nv: %s\n' % (s['min']))
+                out.write('\t>>> mean wo nv: %s\n' % (s['mean']))
+                out.write('\t>>> std wo nv: %s\n' % (s['std']))
+
+        logger.log('SUCCESS', 'See file qualityCheck%s.txt (and the statistics and histograms in qualityCheck%s.json and .csv) for detailed information about the final matrix.' % (self.dataset, self.dataset))
     
+    @_timed
     def prepare(self):
-        self.download()
-        self.mosaic()
-        self.convert()
-        self.clip()
-        self.matrix() 
-        self.quality()
-        self.qualityCheck()
-    
-    def finalMatrix(self):
 
-        if len(self.tiles) > 1:
-            obs = self.observations/len(self.tiles)
-        if len(self.tiles) == 1:
-            obs = self.observations/2
-        
-        #create latitude/longitude grid
-        xoff, a, b, yoff, d, e = self.referenceImage.GetGeoTransform()
+        """
+        Runs the stages from download() to qualityCheck().  Every completed stage
+        is recorded in fullPath/stages.json with its output files; with resume,
+        the stages up to the last one whose outputs are intact are skipped.
+        """
 
-        def pixel2coord(x,y):
-            xp = a*x+b*y+xoff
-            yp = d*x+e*y+yoff
-            return(xp,yp)
+        if self.update:
+            self._updateDates()
+        order = self._stageOrder()
+        if not os.path.exists(self.directory):
+            os.mkdir(self.directory)
+        if not os.path.exists(self.fullPath):
+            os.mkdir(self.fullPath)
+        self.stages = stages.StageManifest(self.fullPath + '/stages.json', self._stageOptions(), checksums = self.verifyStages)
+        done = -1
+        if self.resume:
+            done = self.stages.resumeAfter(order)
+            for name in order[:done + 1]:
+                for key, value in self.stages.stage(name)['state'].items():
+                    setattr(self, str(key), value)
+            if done >= 0:
+                self._reopenStage(order[done])
+                logger.log('SUCCESS', 'Resuming %s after the %s stage, skipping %s' % (self.dataset, order[done], ', '.join(order[:done + 1])))
+        else:
+            self.stages.reset()
 
-        arr = self.referenceImage.ReadAsArray()
-        lat = np.empty(shape = (arr.shape[0], arr.shape[1]))
-        lon = np.empty(shape = (arr.shape[0], arr.shape[1]))        
+        for name in order[done + 1:]:
+            getattr(self, name)()
+            if name == 'download' and self.observations == 0:
+                logger.log('SUCCESS', 'No new %s data after %s, nothing to process' % (self.dataset, self.enddate))
+                return
+            #the band matrix only outlives the process in memmap mode
+            self.stages.record(name, self._stageOutputs(name), self._stageState(name), persistent = name != 'matrix' or self.memmap)
+            if name in ('quality', 'windowMatrix'):
+                self._removeGeoTIFFs()
 
-        for row in range(arr.shape[0]):
-            for col in range(arr.shape[1]):
-                coor = pixel2coord(row,col)
-                lat[row,col] = coor[0]
-                lon[row,col] = coor[1]        
+    def _stageOrder(self):
+        order = ['download']
+        if self.ingest == 'gdal':
+            order += ['mosaic', 'convert', 'clip']
+        if self.ingest == 'lookup':
+            order += ['lookup']
+        order += ['windowMatrix'] if self.window else ['matrix', 'quality']
+        return order + ['qualityCheck']
 
-        grid_rep = np.repeat(lat.reshape((1, lat.shape[0], lat.shape[1])), obs, axis  = 0)
-        lat = grid_rep.reshape((grid_rep.shape[1]*grid_rep.shape[0]*grid_rep.shape[2], 1))
-                
-        grid_repl = np.repeat(lon.reshape((1, lon.shape[0], lon.shape[1])), obs, axis  = 0)
-        lon = grid_repl.reshape((grid_repl.shape[1]*grid_repl.shape[0]*grid_repl.shape[2], 1))
-       
-        np.save(str(self.directory) + '/' + 'latitude.npy', lat)
-        np.save(str(self.directory) + '/' + 'longitude.npy', lon)
+    def _stageOptions(self):
+        #options the stages depend on; stages recorded with other options are not resumed
+        return {'dataset': self.dataset, 'subset': self.subset, 'tiles': self.tiles, 'today': self.today, 'enddate': self.enddate,
+                'referenceImage': self.referenceImagePath, 'ingest': self.ingest, 'composite': self.composite, 'qaRule': self.qaRule,
+                'memmap': self.memmap, 'window': self.window, 'compact': self.compact, 'regionMask': self.regionMask}
+
+    def _stageOutputs(self, name):
+
+        """
+        Lists the files produced by stage name, which are recorded in the manifest.
+        """
+
+        d = self.fullPath
+        if name == 'download':
+            return glob.glob(d + '/*.hdf')
+        if name == 'mosaic':
+            return glob.glob(d + '/*mos.tif') + glob.glob(d + '/*.vrt')
+        if name == 'convert':
+            return glob.glob(d + '/full*.tif')
+        if name == 'clip':
+            return [t for t in glob.glob(d + '/*.tif') if not os.path.basename(t).startswith('full')]
+        if name == 'matrix':
+            return [d + '/' + self.dataset + '_DC.npy'] if self.memmap else []
+        if name in ('quality', 'windowMatrix'):
+            matrix = str(self.directory) + '/' + self.dataset
+            return [f for f in (matrix + '.npy', matrix + '.txt', matrix + '.json') if os.path.isfile(f)]
+        if name == 'qualityCheck':
+            return [d + '/qualityCheck' + self.dataset + ext for ext in ('.txt', '.json', '.csv')]
+        return []
+
+    def _stageState(self, name):
+        if name == 'download':
+            return {'observations': self.observations, 'filelist': self.filelist, 'today': self.today}
+        return {}
+
+    def _reopenStage(self, name):
+
+        """
+        Loads what the stage after the skipped stage name reads from memory.
+        """
+
+        if name == 'lookup':
+            #loads the cached resampling index
+            self.lookup()
+        if name == 'matrix':
+            self.DC = np.load(self.fullPath + '/' + self.dataset + '_DC.npy', mmap_mode = 'r+')
     
-        latfile = str(self.directory) + '/latitude.txt'
-        f = open(latfile, 'w')
-        f.write('latitude \n')
-        f.close()
-        lonfile = str(self.directory) + '/longitude.txt'
-        l = open(lonfile, 'w')
-        l.write('longitude \n' )
-        l.close()
+    def _updateDates(self):
+
+        """
+        Sets enddate to the day after the last date held by the store to update.
+        """
+
+        last = colstore.ColumnStore(self.update).manifest['provenance'].get('lastDate')
+        if last is None:
+            raise IOError("The column store %s does not record the last date it holds. Please rebuild it with finalMatrix()" % self.update)
+        self.enddate = (datetime.datetime.strptime(last, '%Y.%m.%d') + datetime.timedelta(days = 1)).strftime('%Y-%m-%d')
+        if self.enddate > self.today:
+            self.today = self.enddate
+        logger.log('SUCCESS', 'The column store %s holds %s data up to %s, only later dates will be processed' % (self.update, self.dataset, last))
+
+    @_timed
+    def finalMatrix(self):
 
-        logger.log('SUCCESS', 'Latitude and longitude arrays successfully created minimum latitude %d and minimum longitude %d' % (lat.min(), lon.min()))
+        """
+        Builds the final matrix from every product matrix (*.npy, with its column
+        names in the *.txt of the same name) in directory, including the ones
+        added by the user (e.g. GWP.npy and GWP.txt).  The matrix is written as a
+        column store in directory/finalMatrix (see colstore.py): one compressed
+        file per column, copied chunk by chunk from the memory-mapped matrices,
+        and a manifest with the names, dtypes, shape, nodata value and source of
+        the columns.  Latitude and longitude are stored once per pixel.  With a
+        regionMask only the pixels inside the region are stored, user matrices 
+        covering the whole referenceImage are subset to them, and their positions
+        are kept in the store's pixelIndex.
+        """
+
+        if self.update:
+            return self._appendMatrix()
+
+        obs = self._periods()
+        pixels = self._pixels()
+        
+        #latitude/longitude of the upper left corner of every pixel, stored once per pixel
+        xoff, a, b, yoff, d, e = self.referenceImage.GetGeoTransform()
+        if self.pixelIndex is not None:
+            row, col = np.divmod(self.pixelIndex, self.columns)
+        else:
+            row = np.arange(self.rows).reshape((self.rows, 1))
+            col = np.arange(self.columns).reshape((1, self.columns))
+        lon = (xoff + a*col + b*row).reshape(pixels)
+        lat = (yoff + d*col + e*row).reshape(pixels)
+
+        provenance = {'dataset': self.dataset, 'tiles': self.tiles, 'today': self.today, 'enddate': self.enddate,
+                      'referenceImage': self.referenceImagePath, 'composite': self.composite, 'qaRule': self.qaRule,
+                      'lastDate': max(self.filelist) if getattr(self, 'filelist', None) else None, 'compact': self.compact,
+                      'regionMask': self.regionMask}
+        store = colstore.ColumnStore.create(str(self.directory) + '/finalMatrix', self.rows, self.columns, obs, provenance = provenance, pixelIndex = self.pixelIndex)
+        store.add('latitude', lat, kind = 'pixel', provenance = 'referenceImage')
+        store.add('longitude', lon, kind = 'pixel', provenance = 'referenceImage')
+        if self.legacyMatrix:
+            np.savez(str(self.directory) + '/coordinates.npz', latitude = lat, longitude = lon, pixelIndex = store.pixelIndex)
+
+        logger.log('SUCCESS', 'Latitude and longitude grids successfully created with minimum latitude %d and minimum longitude %d' % (lat.min(), lon.min()))
         del lat, lon
                        
-        #time array
-        x = np.repeat(np.array(range(1,obs+1)), self.rows*self.columns)  
-        time = np.reshape(x, (self.rows*self.columns*obs,1))
-               
-        np.save(str(self.directory) + '/' + 'time.npy', time)
-        timefile = str(self.directory) + '/time.txt'
-        t = open(timefile, 'w')
-        t.write('timeID \n')
-        t.close()
-        logger.log('SUCCESS', 'Time ID created with maximum time value of %d and dimensions of %d rows by %d columns' % (time.max(), time.shape[0], time.shape[1]))
-        del x, time
-
-        #autocorrelation
-        lag = 150  #a changer?
-        grid_r = self.rows/lag
-        grid_c = self.columns/lag
-        rem_r = self.rows%lag
-        rem_c = self.columns%lag
-
-        grid_id = (grid_r + 1)*(grid_c + 1)  #max ID number
-        idlist = np.arange(1,grid_id + 1).reshape((grid_r + 1, grid_c +1))
-
-        grid = np.repeat(idlist, lag, axis = 0)
-        grid = np.repeat(grid, lag, axis = 1)
-        
-        grid_sized = grid[0:self.rows, 0:self.columns].reshape((1, self.rows, self.columns))
-        grid_rep = np.repeat(grid_sized, obs, axis  = 0)
-        grid_final = grid_rep.reshape((obs*self.rows*self.columns, 1))
-        
-        np.save(str(self.directory) + '/' + 'autocorrelationGrid.npy', grid_final)
-        autofile = str(self.directory) + '/autocorrelationGrid.txt'
-        a = open(autofile, 'w')
-        a.write('autocorrelationGrid' + ' ' + '\n')
-        a.close()
-        logger.log('SUCCESS', 'Autocorrelation grid created with pixel lag of %d and dimensions of %d rows by %d columns' % (lag, grid_final.shape[0], grid_final.shape[1]))
-        del idlist, grid_sized, grid
-        
-        
-        #append txt file
-        out = str(self.directory) + '/columnNames.txt'
-        columnNames = sorted(glob.glob(self.directory + '/*.txt'))
-        
-        with open(out, 'w') as outfile:
-            for fname in columnNames:
-                with open(fname) as infile:
-                    outfile.write(infile.read())
-                    
+        #timeID and autocorrelationGrid are functions of the row index, computed when they are read
+        store.addVirtual('timeID', 'time')
+        store.addVirtual('autocorrelationGrid', 'grid', lag = self.gridLag)
+        logger.log('SUCCESS', 'Time ID with maximum time value of %d and autocorrelation grid with pixel lag of %d added as virtual columns' % (obs, self.gridLag))
+        
+        #columns are copied one chunk of 16-day intervals at a time from the memory-mapped matrices
         matrixNames = sorted(glob.glob(self.directory + '/*.npy'))
-        matrix = np.empty(shape = (self.rows*self.columns*obs,0))  
+        matrixNames = [m for m in matrixNames if os.path.basename(m) not in ('finalMatrix.npy', 'time.npy', 'autocorrelationGrid.npy')]
+        parts = [('autocorrelationGrid.npy', ['autocorrelationGrid']), ('time.npy', ['timeID'])]
+        for m in matrixNames:
+            part = self._loadMatrix(m, obs)
+            partNames = _columnNames(m[:-len('.npy')] + '.txt', part.shape[1])
+            scale, nodata = _columnScales(m[:-len('.npy')] + '.json', part.shape[1])
+            for j, name in enumerate(partNames):
+                store.add(name, self._regionColumn(part[:, j]), provenance = os.path.basename(m), scale = scale[j], nodata = nodata)
+            parts.append((os.path.basename(m), partNames))
+            del part
+        names = [name for m, partNames in sorted(parts) for name in partNames]
 
-        for i in range(len(matrixNames)):
-            c = np.load(matrixNames[i])
-            if len(c.shape) ==1:
-                c = c.reshape((self.rows*self.columns*obs,1))
-            else:
-                c = c.reshape((self.rows*self.columns*obs, c.shape[1]))
-            matrix = np.append(matrix, c, axis=1)
-        
-        vn = open(out)
-        var = vn.read()
+        self.store = store
+        logger.log('SUCCESS', 'Final matrix created as a column store in %s with %d rows by %d columns.  To access the matrix, call object.store.  The matrix includes the following variables: %s' % (store.path, pixels*obs, len(names), ', '.join(names)))
+
+        if self.legacyMatrix:
+            self._legacyMatrix(store, names)
+
+    @_timed
+    def _appendMatrix(self):
+
+        """
+        Appends the intervals prepared in the staging directory by prepare() to the
+        column store self.update.  Every product prepared in the staging directory
+        has to add the same intervals: if one of them has no new dates yet, the
+        update is deferred and the store is left unchanged, and matrices with
+        another number of intervals stop the update.  Columns of the store
+        from outside the run (e.g. a user column such as GWP.npy that was not
+        extended) are filled with the nodata value.  The staging directory is
+        removed once the store is updated, so the next update starts clean.
+        """
+
+        if not getattr(self, 'filelist', None):
+            logger.log('SUCCESS', 'No new dates, the column store %s is unchanged' % self.update)
+            return
+        obs = self._periods()
+        store = colstore.ColumnStore(self.update)
+        if store.manifest['provenance'].get('compact', False) != self.compact:
+            raise IOError('The column store %s was built with compact = %s. Please update it with the same setting' % (self.update, str(store.manifest['provenance'].get('compact', False))))
+        if store.shape != (self.rows, self.columns):
+            raise IOError('The column store %s holds a %d by %d raster but the referenceImage is %d by %d' % ((self.update,) + store.shape + (self.rows, self.columns)))
+        if not np.array_equal(store.pixelIndex, self.pixelIndex if self.pixelIndex is not None else np.arange(self.rows*self.columns)):
+            raise IOError('The column store %s holds other pixels than the regionMask %s selects. Please update it with the regionMask it was built with (%s)' % (self.update, str(self.regionMask), str(store.manifest['provenance'].get('regionMask'))))
+
+        #products of the run (with a directory in the staging directory) that found no new dates
+        lagging = sorted(set(v['source'][:-len('.npy')] for v in store.manifest['variables'] if v['kind'] == 'data' and str(v.get('source')).endswith('.npy')
+                             and os.path.isdir(self.directory + '/' + v['source'][:-len('.npy')]) and not os.path.isfile(self.directory + '/' + v['source'])))
+        if lagging:
+            logger.log('WARNING', 'No new data for %s after %s, the update of the column store %s is deferred until every product has the new intervals' % (', '.join(lagging), self.enddate, self.update))
+            return
+
+        sources = {}
+        for m in sorted(glob.glob(self.directory + '/*.npy')):
+            part = self._loadMatrix(m, obs)
+            for j, name in enumerate(_columnNames(m[:-len('.npy')] + '.txt', part.shape[1])):
+                sources[name] = self._regionColumn(part[:, j])
+        missing = store.append(obs, sources, lastDate = max(self.filelist))
+        if missing:
+            logger.log('WARNING', 'No new data for %s in %s, the new intervals of these columns are set to %s' % (', '.join(missing), self.directory, str(store.manifest['fill'])))
+        del sources
+        
+        self.store = store
+        shutil.rmtree(self.directory)
+        logger.log('SUCCESS', '%d intervals up to %s appended to the column store %s, which now holds %d intervals' % (obs, max(self.filelist), store.path, store.periods))
+
+    def _loadMatrix(self, path, obs):
+
+        """
+        Memory-maps the matrix at path as one column per variable.  Matrices of
+        user variables may cover the whole referenceImage or, like the product
+        matrices, only the pixels of the regionMask.
+        """
+
+        part = np.load(path, mmap_mode = 'r')
+        if part.shape[0] not in (self._pixels()*obs, self.rows*self.columns*obs):
+            raise IOError('%s has %d rows, expected %d pixels by %d intervals' % (path, part.shape[0], self._pixels(), obs))
+        return part.reshape((part.shape[0], 1)) if len(part.shape) == 1 else part
+
+    def _regionColumn(self, column):
+        #a column over the whole referenceImage is subset to the pixels of the regionMask
+        if self.pixelIndex is not None and column.shape[0] != self._pixels()*self._periods():
+            return _PixelSubset(column, self.pixelIndex, self.rows*self.columns)
+        return column
+
+    @_timed
+    def _legacyMatrix(self, store, names):
+        obs = self._periods()
+        pixels = self._pixels()
+
+        with open(str(self.directory) + '/columnNames.txt', 'w') as outfile:
+            for name in names:
+                outfile.write(name + ' \n')
+                    
+        #columns are copied one chunk of the store at a time into the preallocated matrix
+        matrix = self._array(str(self.directory) + '/finalMatrix.npy', (pixels*obs, len(names)))
+        for j, name in enumerate(names):
+            for start, stop in store.manifest['chunks']:
+                matrix[start*pixels:stop*pixels, j] = store.column(name, start, stop)
         
         self.finalMatrix = matrix
                 
-        np.save(str(self.directory) + '/finalMatrix.npy', matrix)
-        logger.log('SUCCESS', 'Final matrix created as finalMatrix.npy in %s. Column names for the matrix can be foud in columnNames.txt.  To access matrix, call object.finalDC' % (str(self.directory))) 
-        logger.log('SUCCESS', 'Final matrix with size of %d rows by %d columns.  To access matrix, call object.finalMatrix.  The matrix includes the following variables: %s' % (matrix.shape[0], matrix.shape[1], str(var)))
+        self._save(str(self.directory) + '/finalMatrix.npy', matrix)
+        logger.log('SUCCESS', 'Final matrix created as finalMatrix.npy in %s. Column names for the matrix can be foud in columnNames.txt.  To access matrix, call object.finalMatrix' % (str(self.directory))) 
 
   
     @abstractmethod
@@ -594,332 +1292,64 @@ class Image(object):
         
 class MOD09A1(Image):
     
-    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage):
-        self.directory = directory 
-        self.fullPath = directory + '/' + dataset 
-        self.username = username
-        self.password = password
-        self.url = "http://e4ftl01.cr.usgs.gov"
-        self.path = 'MOLT'
-        self.dataset = dataset
-        self.subset = subset
-        self.tiles = tiles
-        if len(self.tiles) > 2:
-             raise IOError("A maximum of two MODIS tiles can be included. Please remove extra tiles")
-        self.today = today
-        self.enddate = enddate
-        
-        self.referenceImagePath = referenceImage
-        self.extent = self.fullPath + '/referenceExtent.shp' 
-        self.referenceImage = gdal.Open(referenceImage)
-        self.referenceImage = gdal.Open(referenceImage)
-        self.projection = self.referenceImage.GetProjection()
-        geotransform = self.referenceImage.GetGeoTransform()
-        self.resolution = geotransform[1]
-        self.rows = self.referenceImage.RasterYSize
-        self.columns = self.referenceImage.RasterXSize
-        self.outformat = self.referenceImage.GetDriver().ShortName
-        
-        self.scale = [.0001, .0001, .0001, .0001, .0001, .0001, .0001, 1, .01, .01, .01, 1, 1]
-        self.varNames = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'Quality 32', 'Solar Zenith', 'View Zenith', 'Relative Azimuth', 'Quality', 'DOY']
-        self.qualityBand = 11
+    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, **options):
+        scale = [.0001, .0001, .0001, .0001, .0001, .0001, .0001, 1, .01, .01, .01, 1, 1]
+        varNames = ['B1', 'B2', 'B3', 'B4', 'B5', 'B6', 'B7', 'Quality 32', 'Solar Zenith', 'View Zenith', 'Relative Azimuth', 'Quality', 'DOY']
+        Image.__init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, scale, varNames, 11, **options)
         self.fillValue = -28672
+        self.rawType = np.int16
     
     def imageType(self):
         return 'MOD09A1'
       
 class MOD13Q1(Image):
        
-    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage):
-        self.directory = directory 
-        self.fullPath = directory + '/' + dataset 
-        self.username = username
-        self.password = password
-        self.url = "http://e4ftl01.cr.usgs.gov"
-        self.path = 'MOLT'
-        self.dataset = dataset
-        self.subset = subset
-        self.tiles = tiles
-        if len(self.tiles) > 2:
-            raise IOError("A maximum of two MODIS tiles can be included. Please remove extra tiles")
-        self.today = today
-        self.enddate = enddate
-                
-        self.referenceImagePath = referenceImage
-        self.extent = self.fullPath + '/referenceExtent.shp' 
-        self.referenceImage = gdal.Open(referenceImage)
-        self.projection = self.referenceImage.GetProjection()
-        geotransform = self.referenceImage.GetGeoTransform()
-        self.resolution = geotransform[1]
-        self.rows = self.referenceImage.RasterYSize
-        self.columns = self.referenceImage.RasterXSize
-        self.outformat = self.referenceImage.GetDriver().ShortName
-        
-        self.scale = [.0001, .0001, 1, .0001, .0001, .0001, .0001, .01, .01, .1, 1, 1]
-        self.varNames = ['NDVI', 'EVI', 'Quality', 'Red', 'NIR', 'Blue', 'MIR', 'View Zenith', 'Sun Zenith', 'Azimuth', 'DOY', 'Pixel Reliability']
-        self.qualityBand = 2
-        self.fillValue = -3000         
+    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, **options):
+        scale = [.0001, .0001, 1, .0001, .0001, .0001, .0001, .01, .01, .1, 1, 1]
+        varNames = ['NDVI', 'EVI', 'Quality', 'Red', 'NIR', 'Blue', 'MIR', 'View Zenith', 'Sun Zenith', 'Azimuth', 'DOY', 'Pixel Reliability']
+        Image.__init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, scale, varNames, 2, **options)
+        self.fillValue = -3000
+        self.rawType = np.int16
          
-    def quality(self):
-        
-        subsetInt = [int(s) for s in self.subset.split() if s.isdigit()]
-
-        #varnames file
-        columnNames = []    
-        for i in range(len(subsetInt)):
-            if subsetInt[i] == 1:
-                columnNames.append(self.varNames[i])
-        
-        q = columnNames.index('Quality')
-        
-        if subsetInt[self.qualityBand] == 1:
-            dataCount = self.subset.count('1')
-            QC = np.repeat(self.DC[:,q].reshape((self.DC.shape[0],1)), dataCount-1, axis = 1)
-            QC = np.uint16(QC)  
-            QCm = QC & 1  
-            DCm = np.delete(self.DC, q, 1)
-            DCm = np.ma.masked_where(QCm == 1, DCm)
-            outArray = np.ma.filled(DCm, 9999.0) 
-            outArray.astype(float)
-            self.finalDC = outArray
-            
-            np.save(str(self.directory) + '/' + self.dataset + '.npy', self.finalDC)
-            outfile = str(self.directory) + '/' + self.dataset + '.txt'
-            f = open(outfile, 'w')
-            for name in columnNames:
-                if name != 'Quality':
-                    f.write(name +' ' + '\n')
-            f.close()
-            var = [a for a in columnNames if not a.startswith('Quality')]
-            logger.log('SUCCESS', 'The final 16-day interval quality-masked matrix was created successfully.  This matrix has dimensions %d rows by %d columns.  Datasets included in the matrix are %s' % (self.finalDC.shape[0], self.finalDC.shape[1], str(var)))
-                         
-        if subsetInt[self.qualityBand] != 1:
-            self.finalDC = np.delete(self.DC, q, 1)
-            np.save(str(self.directory) + '/' + str(self.dataset) + '.npy', self.finalDC)
-            outfile = str(self.directory) + '/' + str(self.dataset) + '.txt'
-            f = open(outfile, 'w')
-            for name in columnNames:
-                if name != 'Quality':
-                    f.write(name + ' ' + '\n')
-            f.close()
-            var = [a for a in columnNames if not a.startswith('Quality')]
-            logger.log('SUCCESS', 'The final 16-day interval matrix was created successfully.  A quality mask was not applied, though no data values are set at 9999.  This matrix has dimensions %d rows by %d columns.  Datasets included in the matrix are %s.  To access the final matrix, call object.finalDC' % (self.finalDC.shape[0], self.finalDC.shape[1], str(var)))
-                 
-    def finalMatrix(self):
-
-        #create latitude/longitude grid
-        xoff, a, b, yoff, d, e = self.referenceImage.GetGeoTransform()
-
-        def pixel2coord(x,y):
-            xp = a*x+b*y+xoff
-            yp = d*x+e*y+yoff
-            return(xp,yp)
-
-        arr = self.referenceImage.ReadAsArray()
-        lat = np.empty(shape = (arr.shape[0], arr.shape[1]))
-        lon = np.empty(shape = (arr.shape[0], arr.shape[1]))
-        
-        for row in range(arr.shape[0]):
-            for col in range(arr.shape[1]):
-                coor = pixel2coord(row,col)
-                lat[row,col] = coor[0]
-                lon[row,col] = coor[1]
-        
-        lat = np.repeat(lat.reshape((arr.shape[0]*arr.shape[1], 1)), self.observations)
-        lon = np.repeat(lon.reshape((arr.shape[0]*arr.shape[1], 1)), self.observations)
-        
-        np.save(str(self.directory) + '/' + 'latitude.npy', lat)
-        np.save(str(self.directory) + '/' + 'longitude.npy', lon)
-    
-        latfile = str(self.directory) + '/latitude.txt'
-        f = open(latfile, 'w')
-        f.write('latitude' + ' ' + '\n')
-        f.close()
-        lonfile = str(self.directory) + '/longitude.txt'
-        l = open(lonfile, 'w')
-        l.write('longitude' + ' ' +'\n')
-        l.close()
-
-         
-        logger.log('SUCCESS', 'Latitude and longitude arrays successfully created  with minimum latitude %d and minimum longitude %d' % (lat.min(), lon.min()))
-        del lat, lon
-       
-        #time
-        x = np.repeat(np.array(range(1,self.observations+1)), self.rows*self.columns)  
-        time = np.reshape(x, (self.rows*self.columns*self.observations,1))
-               
-        np.save(str(self.directory) + '/' + 'time.npy', time)
-        timefile = str(self.directory) + '/time.txt'
-        t = open(timefile, 'w')
-        t.write('timeID' + ' ' + '\n')
-        t.close()
-        logger.log('SUCCESS', 'Time ID created with maximum time value of %d and dimensions of %d rows by %d columns' % (time.max(), time.shape[0], time.shape[1]))
-        del x, time
-        
-        #autocorrelation
-        lag = 150  #a changer?
-        grid_r = self.rows/lag
-        grid_c = self.columns/lag
-        rem_r = self.rows%lag
-        rem_c = self.columns%lag
-
-        grid_id = (grid_r + 1)*(grid_c + 1)  #max ID number
-        idlist = np.arange(1,grid_id + 1).reshape((grid_r + 1, grid_c +1))
-
-        grid = np.repeat(idlist, lag, axis = 0)
-        grid = np.repeat(grid, lag, axis = 1)
-
-        grid_sized = grid[0:self.rows, 0:self.columns].reshape((1, self.rows, self.columns))
-        grid_rep = np.repeat(grid_sized, obs, axis  = 0)
-        grid_final = grid_rep.reshape((obs*self.rows*self.columns, 1))
-        
-        np.save(str(self.directory) + '/' + 'autocorrelationGrid.npy', grid_final)
-        autofile = str(self.directory) + '/autocorrelationGrid.txt'
-        a = open(autofile, 'w')
-        a.write('autocorrelationGrid' + ' ' + '\n')
-        a.close()
-        logger.log('SUCCESS', 'Autocorrelation grid created with pixel lag of %d and dimensions of %d rows by %d columns' % (lag, grid_final.shape[0], grid_final.shape[1]))
-        del idlist, grid_sized, grid
-        
-        
-        #append txt file
-        out = str(self.directory) + '/columnNames.txt'
-        columnNames = sorted(glob.glob(self.directory + '/*.txt'))
-        
-        with open(out, 'w') as outfile:
-            for fname in columnNames:
-                with open(fname) as infile:
-                    outfile.write(infile.read())
-                    
-        matrixNames = sorted(glob.glob(self.directory + '/*.npy'))
-        matrix = np.empty(shape = (self.rows*self.columns*self.observations,0))  #make sure inherits observations
-
-        for i in range(len(matrixNames)):
-            c = np.load(matrixNames[i])
-            if len(c.shape) ==1:
-                c = c.reshape((self.rows*self.columns*self.observations,1))
-            else:
-                c = c.reshape((self.rows*self.columns*self.observations, c.shape[1]))
-            matrix = np.append(matrix, c, axis=1)
-        
-        vn = open(out)
-        vn = vn.read()
-                
-        np.save(str(self.directory) + '/finalMatrix.npy', matrix)
-        logger.log('SUCCESS', 'Final matrix created as finalMatrix.npy in %s. Column names for the matrix can be foud in columnNames.txt.' % (self.directory)) 
-        logger.log('SUCCESS', 'Final matrix with size of %d rows by %d columns.  Matrix includes the following variables: %s' % (matrix.shape[0], matrix.shape[1], str(vn)))
+    def _periods(self):
+        #MOD13Q1 is already a 16-day product
+        return self.observations
         
     def imageType(self):
         return 'MOD13Q1'
         
 class MOD11A2(Image):
   
-    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage):
-        self.directory = directory 
-        self.fullPath = directory + '/' + dataset 
-        self.username = username
-        self.password = password
-        self.url = "http://e4ftl01.cr.usgs.gov"
-        self.path = 'MOLT'
-        self.dataset = dataset
-        self.subset = subset
-        self.tiles = tiles
-        if len(self.tiles) > 2:
-             raise IOError("A maximum of two MODIS tiles can be included. Please remove extra tiles")
-        self.today = today
-        self.enddate = enddate
-                
-        self.referenceImagePath = referenceImage
-        self.extent = self.fullPath + '/referenceExtent.shp' 
-        self.referenceImage = gdal.Open(referenceImage)
-        self.referenceImage = gdal.Open(referenceImage)
-        self.projection = self.referenceImage.GetProjection()
-        geotransform = self.referenceImage.GetGeoTransform()
-        self.resolution = geotransform[1]
-        self.rows = self.referenceImage.RasterYSize
-        self.columns = self.referenceImage.RasterXSize
-        self.outformat = self.referenceImage.GetDriver().ShortName
-        
-        self.scale = [.02, 1 ,.1, 1, .02, 1, .1, 1, .002, .002, 1, 1]  #plus -65 and .49 on LPDAAC?
-        self.varNames = ['LST', 'Quality', 'Day View Time', 'Day View Angle', 'LST NIght', 'QC Night', 'Night View Time', 'Night View Angle', 'Band 31', 'Band 32', 'Clear Sky Days', 'Clear Sky Nights']
-        self.qualityBand = 1 
-        self.fillValue = 0 
+    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, **options):
+        scale = [.02, 1 ,.1, 1, .02, 1, .1, 1, .002, .002, 1, 1]  #plus -65 and .49 on LPDAAC?
+        varNames = ['LST', 'Quality', 'Day View Time', 'Day View Angle', 'LST NIght', 'QC Night', 'Night View Time', 'Night View Angle', 'Band 31', 'Band 32', 'Clear Sky Days', 'Clear Sky Nights']
+        Image.__init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, scale, varNames, 1, **options)
+        self.fillValue = 0
+        self.rawType = np.int32  #LST is stored as uint16
            
     def imageType(self):
         return 'MOD11A2'
 
 class MOD15A2(Image):
    
-    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage):
-        self.directory = directory 
-        self.fullPath = directory + '/' + dataset 
-        self.username = username
-        self.password = password
-        self.url = "http://e4ftl01.cr.usgs.gov"
-        self.path = 'MOLT'
-        self.dataset = dataset
-        self.subset = subset
-        self.tiles = tiles
-        if len(self.tiles) > 2:
-             raise IOError("A maximum of two MODIS tiles can be included. Please remove extra tiles")
-        self.today = today
-        self.enddate = enddate
-                
-        self.referenceImagePath = referenceImage
-        self.extent = self.fullPath + '/referenceExtent.shp' 
-        self.referenceImage = gdal.Open(referenceImage)
-        self.referenceImage = gdal.Open(referenceImage)
-        self.projection = self.referenceImage.GetProjection()
-        geotransform = self.referenceImage.GetGeoTransform()
-        self.resolution = geotransform[1]
-        self.rows = self.referenceImage.RasterYSize
-        self.columns = self.referenceImage.RasterXSize
-        self.outformat = self.referenceImage.GetDriver().ShortName
-        
-        self.scale = [1, .01, .1, 1, .01, .1] ##
-        self.varNames = ['Quality', 'FPAR', 'LAI', 'Extra QC', 'FPAR SD', 'LAI SD']
-        self.qualityBand = 0 ###
+    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, **options):
+        scale = [1, .01, .1, 1, .01, .1] ##
+        varNames = ['Quality', 'FPAR', 'LAI', 'Extra QC', 'FPAR SD', 'LAI SD']
+        Image.__init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, scale, varNames, 0, **options)
         self.fillValue = 248
+        self.rawType = np.int16
     
     def imageType(self):
         return 'MOD15A2'
  
 class MOD17A2(Image):
     
-    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage):
-        self.directory = directory 
-        self.fullPath = directory + '/' + dataset 
-        self.username = username
-        self.password = password
-        self.url = "http://e4ftl01.cr.usgs.gov"
-        self.path = 'MOLT'
-        self.dataset = dataset
-        self.subset = subset
-        self.tiles = tiles
-        if len(self.tiles) > 2:
-             raise IOError("A maximum of two MODIS tiles can be included. Please remove extra tiles")
-        self.today = today
-        self.enddate = enddate
-        
-        
-        self.referenceImagePath = referenceImage
-        self.extent = self.fullPath + '/referenceExtent.shp' 
-        self.referenceImage = gdal.Open(referenceImage)
-        self.referenceImage = gdal.Open(referenceImage)
-        self.projection = self.referenceImage.GetProjection()
-        geotransform = self.referenceImage.GetGeoTransform()
-        self.resolution = geotransform[1]
-        self.rows = self.referenceImage.RasterYSize
-        self.columns = self.referenceImage.RasterXSize
-        self.outformat = self.referenceImage.GetDriver().ShortName     
-        
-        self.scale = [.0001, .0001, 1]
-        self.varNames = ['GP', 'PSN', 'Quality']
-        self.qualityBand = 2
-        self.fillValue = 30000 
+    def __init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, **options):
+        scale = [.0001, .0001, 1]
+        varNames = ['GP', 'PSN', 'Quality']
+        Image.__init__(self, directory, username, password, dataset, subset, tiles, today, enddate, referenceImage, scale, varNames, 2, **options)
+        self.fillValue = 30000
+        self.rawType = np.int16
       
     def imageType(self):
         return 'MOD17A2'
-
-
-
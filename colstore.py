@@ -0,0 +1,396 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Columnar Matrix Store
+
+Stores the final matrix as one compressed file per column next to a JSON
+manifest, instead of one dense float64 finalMatrix.npy plus columnNames.txt.
+Every column file is a zip archive (readable with np.load) holding one member
+per chunk of 16-day intervals, so columns are written chunk by chunk from the
+memory-mapped product matrices and read back lazily: a stage that only needs
+NDVI and LST reads those two files and nothing else.
+
+The manifest records the raster shape, the number of intervals, the chunk
+boundaries, the nodata value and, for every column, its name, file, dtype,
+kind and source.  Columns are of kind 'data' (one value per pixel and
+interval, time-major like the band matrices), 'pixel' (one value per pixel,
+e.g. latitude, expanded over the intervals when read) or 'virtual'.  A store
+built with a region mask holds only the pixels inside the region; their
+positions on the full raster are kept in pixelIndex.npy.  Virtual
+columns (timeID and autocorrelationGrid) have no file: they are functions of
+the row index and the raster shape, generated chunk by chunk when read from
+the parameters recorded in the manifest (e.g. the grid lag), in the smallest
+integer type that holds them.
+
+New intervals are appended to a store without rewriting it (see append()):
+the chunks of every update go into a new file per column, e.g.
+EVI.chunk00012.npz, listed in the manifest under the column.  The files are
+recorded as pending before they are written and the update only takes effect
+when the manifest is replaced, so a store opened after an interrupted append
+is unchanged and the files of the failed append are removed.
+
+Data columns may hold raw integers with a scale factor and a no data value
+(see the compact option of agpredict.Image).  They are scaled to float64 when
+read, unless the raw values are asked for.
+"""
+
+import datetime
+import glob
+import io
+import json
+import os
+import re
+import zipfile
+import numpy as np
+
+MANIFEST = 'manifest.json'
+
+
+class ColumnStore(object):
+
+    """Chunked, compressed column files described by a JSON manifest"""
+
+    def __init__(self, path, gridLag = None):
+
+        """
+        :param path: directory of an existing store, e.g. directory/finalMatrix
+
+        :param gridLag: size in pixels of the blocks of the autocorrelationGrid column.
+            Overrides the lag recorded when the store was built.
+        """
+
+        self.path = path
+        self.gridLag = gridLag
+        if not os.path.isfile(os.path.join(path, MANIFEST)):
+            raise IOError('No column store manifest in %s' % str(path))
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        if 'pending' in self.manifest:
+            #an append was interrupted before its update was recorded
+            self._rollback()
+
+    @classmethod
+    def create(cls, path, rows, columns, periods, fill = 9999.0, chunkPeriods = None, provenance = None, pixelIndex = None):
+
+        """
+        Creates an empty store for a raster of rows by columns pixels and periods
+        16-day intervals, replacing the column files of an earlier build.  By
+        default a chunk holds as many intervals as fit in about 4 million values.
+        pixelIndex lists the row-major positions of the pixels the store holds
+        if they are only part of the raster.
+        """
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for old in glob.glob(os.path.join(path, '*.npz')) + glob.glob(os.path.join(path, 'pixelIndex.npy')):
+            os.remove(old)
+        pixels = rows*columns
+        if pixelIndex is not None:
+            np.save(os.path.join(path, 'pixelIndex.npy'), pixelIndex)
+            pixels = len(pixelIndex)
+        if chunkPeriods is None:
+            chunkPeriods = max(1, 2**22 // pixels)
+        manifest = {'version': 1,
+                    'shape': [rows, columns],
+                    'pixels': pixels,
+                    'masked': pixelIndex is not None,
+                    'periods': periods,
+                    'chunks': [[p, min(p + chunkPeriods, periods)] for p in range(0, periods, chunkPeriods)],
+                    'fill': fill,
+                    'created': datetime.datetime.now().isoformat(),
+                    'provenance': provenance or {},
+                    'variables': []}
+        _dump(os.path.join(path, MANIFEST), manifest)
+        return cls(path)
+
+    @property
+    def shape(self):
+        return tuple(self.manifest['shape'])
+
+    @property
+    def pixels(self):
+        return self.manifest['pixels']
+
+    @property
+    def periods(self):
+        return self.manifest['periods']
+
+    @property
+    def pixelIndex(self):
+
+        """
+        Row-major positions on the full raster of the pixels the store holds.
+        """
+
+        if self.manifest.get('masked'):
+            return np.load(os.path.join(self.path, 'pixelIndex.npy'))
+        return np.arange(self.pixels)
+
+    def names(self, kind = None):
+
+        """
+        Returns the column names in the order they were added, optionally only
+        those of one kind ('data', 'pixel' or 'virtual') or tuple of kinds.
+        """
+
+        kinds = (kind,) if isinstance(kind, str) else kind
+        return [v['name'] for v in self.manifest['variables'] if kinds is None or v['kind'] in kinds]
+
+    def variable(self, name):
+        for v in self.manifest['variables']:
+            if v['name'] == name:
+                return v
+        raise KeyError('No column %s in the store %s. Available columns are %s' % (name, self.path, self.names()))
+
+    def save(self):
+        _dump(os.path.join(self.path, MANIFEST), self.manifest)
+
+    def add(self, name, source, kind = 'data', dtype = None, provenance = None, scale = None, nodata = None):
+
+        """
+        Writes one column.  source has one value per pixel and interval (kind
+        'data') or per pixel (kind 'pixel') and may be a memory-mapped array or
+        a strided view of one; only one chunk of it is held in memory at a time.
+        Raw integer columns are given with their scale factor and no data value.
+        """
+
+        if name in self.names():
+            raise IOError('Column %s is already in the store %s' % (name, self.path))
+        dtype = np.dtype(dtype or source.dtype)
+        entry = {'name': name,
+                 'file': _fileName(name, [v['file'] for v in self.manifest['variables']]),
+                 'kind': kind,
+                 'dtype': dtype.str,
+                 'source': provenance}
+        if scale is not None:
+            entry['scale'] = scale
+            entry['nodata'] = nodata
+        target = os.path.join(self.path, entry['file'])
+        if os.path.isfile(target):
+            os.remove(target)
+        if kind == 'pixel':
+            _writeMember(target, 'pixel', np.asarray(source).reshape(self.pixels).astype(dtype))
+        else:
+            if source.shape[0] != self.pixels*self.periods:
+                raise IOError('Column %s has %d values, the store holds %d pixels by %d intervals' % (name, source.shape[0], self.pixels, self.periods))
+            for i, (start, stop) in enumerate(self.manifest['chunks']):
+                _writeMember(target, 'chunk%05d' % i, np.asarray(source[start*self.pixels:stop*self.pixels]).reshape(-1).astype(dtype))
+        self.manifest['variables'].append(entry)
+        self.save()
+
+    def addVirtual(self, name, function, **parameters):
+
+        """
+        Records a column computed from the row index by one of the VIRTUAL
+        functions ('time' or 'grid') with the given parameters.
+        """
+
+        if name in self.names():
+            raise IOError('Column %s is already in the store %s' % (name, self.path))
+        if function not in VIRTUAL:
+            raise IOError('Unknown virtual column function %s. Available functions are %s' % (function, sorted(VIRTUAL)))
+        self.manifest['variables'].append({'name': name, 'file': None, 'kind': 'virtual', 'function': function, 'parameters': parameters,
+                                           'dtype': _smallestInt(VIRTUAL_MAX[function](self, self.periods, **parameters)).str})
+        self.save()
+
+    def append(self, periods, sources, **provenance):
+
+        """
+        Appends periods intervals to the store as new chunks.  sources maps column
+        names to arrays with one value per pixel and new interval; 'data' columns
+        without a source get the nodata value and virtual columns extend by
+        themselves.  provenance (e.g. lastDate) updates the provenance record.
+        Returns the names of the columns that were filled with nodata.  The
+        chunks are written into a new file per column (see _partName), so the
+        existing files are never rewritten, and the update is recorded by
+        replacing the manifest: a failed append leaves the store as it was and
+        can be run again.
+        """
+
+        first, last = self.manifest['chunks'][0]
+        start = self.periods
+        chunks = [[p, min(p + last - first, start + periods)] for p in range(start, start + periods, last - first)]
+        unknown = [name for name in sources if name not in self.names()]
+        if unknown:
+            raise IOError('Columns %s are not in the store %s' % (', '.join(sorted(unknown)), self.path))
+        for name in sources:
+            if sources[name].shape[0] != self.pixels*periods:
+                raise IOError('Column %s has %d new values, the store expects %d pixels by %d intervals' % (name, sources[name].shape[0], self.pixels, periods))
+        if 'pending' in self.manifest:
+            self._rollback()
+        firstChunk = len(self.manifest['chunks'])
+        data = [v for v in self.manifest['variables'] if v['kind'] == 'data']
+        parts = dict((v['name'], _partName(v['file'], firstChunk)) for v in data)
+        self.manifest['pending'] = {'files': sorted(parts.values())}
+        self.save()
+
+        missing = []
+        for v in data:
+            if v['name'] not in sources:
+                missing.append(v['name'])
+            part = os.path.join(self.path, parts[v['name']])
+            if os.path.isfile(part):
+                os.remove(part)
+            for i, (a, b) in enumerate(chunks, firstChunk):
+                if v['name'] in sources:
+                    values = np.asarray(sources[v['name']][(a - start)*self.pixels:(b - start)*self.pixels]).reshape(-1)
+                else:
+                    values = np.empty((b - a)*self.pixels)
+                    values[:] = v.get('nodata', self.manifest['fill'])
+                _writeMember(part, 'chunk%05d' % i, values.astype(np.dtype(v['dtype'])))
+
+        #the update takes effect with the new manifest
+        for v in data:
+            v.setdefault('parts', []).append([firstChunk, parts[v['name']]])
+        self.manifest['chunks'] += chunks
+        self.manifest['periods'] += periods
+        self.manifest['provenance'].update(provenance)
+        self.manifest.setdefault('updates', []).append({'date': datetime.datetime.now().isoformat(), 'start': start, 'stop': start + periods})
+        del self.manifest['pending']
+        self.save()
+        return missing
+
+    def _rollback(self):
+
+        """
+        Removes the files of an append that was not recorded.
+        """
+
+        for name in self.manifest['pending']['files']:
+            path = os.path.join(self.path, name)
+            if os.path.isfile(path):
+                os.remove(path)
+        del self.manifest['pending']
+        self.save()
+
+    def pixel(self, name):
+
+        """
+        Returns the per pixel values of a 'pixel' column.
+        """
+
+        v = self.variable(name)
+        if v['kind'] != 'pixel':
+            raise IOError('Column %s holds one value per pixel and interval, use column()' % name)
+        with np.load(os.path.join(self.path, v['file'])) as f:
+            return f['pixel']
+
+    def column(self, name, start = 0, stop = None, raw = False):
+
+        """
+        Returns the values of one column for the intervals start to stop (all by
+        default) as a 1-D array, reading only the chunks that overlap them.
+        Raw integer columns are scaled to float64, with the no data value set to
+        the store's fill value, unless raw is True.
+        """
+
+        stop = self.periods if stop is None else stop
+        v = self.variable(name)
+        if v['kind'] == 'virtual':
+            parameters = dict(v['parameters'])
+            if v['function'] == 'grid' and self.gridLag is not None:
+                parameters['lag'] = self.gridLag
+            out = np.empty((stop - start)*self.pixels, dtype = _smallestInt(VIRTUAL_MAX[v['function']](self, stop, **parameters)))
+            for a, b in self.manifest['chunks']:
+                lo, hi = max(a, start), min(b, stop)
+                if lo < hi:
+                    out[(lo - start)*self.pixels:(hi - start)*self.pixels] = VIRTUAL[v['function']](self, lo, hi, **parameters)
+            return out
+        out = np.empty((stop - start)*self.pixels, dtype = np.dtype(v['dtype']))
+        if v['kind'] == 'pixel':
+            values = self.pixel(name)
+            for k in range(stop - start):
+                out[k*self.pixels:(k + 1)*self.pixels] = values
+            return out
+        files = {}
+        try:
+            for i, (a, b) in enumerate(self.manifest['chunks']):
+                lo, hi = max(a, start), min(b, stop)
+                if lo < hi:
+                    name = _chunkFile(v, i)
+                    if name not in files:
+                        files[name] = np.load(os.path.join(self.path, name))
+                    out[(lo - start)*self.pixels:(hi - start)*self.pixels] = files[name]['chunk%05d' % i][(lo - a)*self.pixels:(hi - a)*self.pixels]
+        finally:
+            for f in files.values():
+                f.close()
+        if raw or v.get('scale') is None:
+            return out
+        nv = out == v['nodata']
+        out = out.astype(float)
+        out *= v['scale']
+        out[nv] = self.manifest['fill']
+        return out
+
+    def read(self, names = None, start = 0, stop = None, dtype = float):
+
+        """
+        Returns the columns names (all 'data' and 'virtual' columns by default) for the
+        intervals start to stop as one 2-D array with a row per pixel and
+        interval, filled one column at a time.  Raw integer columns are scaled.
+        """
+
+        names = self.names(('data', 'virtual')) if names is None else names
+        stop = self.periods if stop is None else stop
+        out = np.empty(((stop - start)*self.pixels, len(names)), dtype = dtype)
+        for j, name in enumerate(names):
+            out[:, j] = self.column(name, start, stop)
+        return out
+
+
+def _time(store, start, stop):
+    #timeID: 1 for every pixel of the first interval, 2 for the second, ...
+    return np.repeat(np.arange(start + 1, stop + 1), store.pixels)
+
+def _grid(store, start, stop, lag):
+    #autocorrelationGrid: id of the lag by lag pixel block of every pixel, numbered row by row from 1
+    rows, columns = store.shape
+    r = np.arange(rows).reshape((rows, 1)) // lag
+    c = np.arange(columns).reshape((1, columns)) // lag
+    ids = (r*(columns // lag + 1) + c + 1).reshape(rows*columns)
+    if store.manifest.get('masked'):
+        ids = ids[store.pixelIndex]
+    return np.tile(ids, stop - start)
+
+VIRTUAL = {'time': _time, 'grid': _grid}
+
+#largest value of the virtual columns up to interval stop
+VIRTUAL_MAX = {'time': lambda store, stop: stop,
+               'grid': lambda store, stop, lag: (store.shape[0] // lag + 1)*(store.shape[1] // lag + 1)}
+
+def _smallestInt(maximum):
+    for dtype in (np.int8, np.int16, np.int32):
+        if maximum <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+def _fileName(name, taken):
+    base = re.sub(r'[^A-Za-z0-9_.-]', '_', name)
+    fileName, n = base + '.npz', 1
+    while fileName in taken:
+        fileName, n = '%s_%d.npz' % (base, n), n + 1
+    return fileName
+
+def _partName(fileName, firstChunk):
+    #file of the chunks appended to a column from chunk firstChunk on, e.g. EVI.chunk00012.npz
+    return '%s.chunk%05d.npz' % (fileName[:-len('.npz')], firstChunk)
+
+def _chunkFile(v, i):
+    #file of column v that holds chunk i: the column file or the file of a later append
+    fileName = v['file']
+    for firstChunk, part in v.get('parts', []):
+        if i >= firstChunk:
+            fileName = part
+    return fileName
+
+def _writeMember(path, member, array):
+    buf = io.BytesIO()
+    np.lib.format.write_array(buf, np.ascontiguousarray(array))
+    with zipfile.ZipFile(path, 'a', zipfile.ZIP_DEFLATED, allowZip64 = True) as z:
+        z.writestr(member + '.npy', buf.getvalue())
+
+def _dump(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+    os.rename(path + '.tmp', path)
@@ -0,0 +1,346 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+MODIS HDF Download Cache
+
+Downloads MODIS HDF tiles with a bounded number of concurrent connections and
+keeps them in a local cache that can be shared across regions and runs.  Each
+file is stored under cacheDir/dataset/tile/date/ next to a small JSON record
+of its size and MD5 checksum, so files that are already complete are never
+fetched again and interrupted downloads resume from their partial file.
+
+Every download is checked against the size and checksum of the file in the
+metadata the archive publishes next to it (name.hdf.xml, whose checksum is
+the POSIX cksum CRC at LP DAAC), so a truncated or corrupted file is
+downloaded again instead of being cached, even when the server sends no
+Content-Length.
+"""
+
+try:
+    import urllib2 as request
+except ImportError:
+    import urllib.request as request
+
+import datetime
+import hashlib
+import json
+import os
+import re
+import subprocess
+import time
+import xml.etree.ElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
+import logger
+
+
+class HDFCache(object):
+
+    """Concurrent, resumable download of MODIS tiles into a shared cache"""
+
+    def __init__(self, cacheDir, url, path, dataset, tiles, username = None, password = None, workers = 8, retries = 3, timeout = 30, verify = False):
+
+        """
+        :param cacheDir: root directory of the cache
+
+        :param url: server holding the MODIS archive, e.g. http://e4ftl01.cr.usgs.gov.  A
+            local HTTP server with the same directory layout can be used for testing.
+
+        :param path: archive directory of the platform, e.g. MOLT
+
+        :param dataset: full name of the MODIS dataset, e.g. MOD13Q1.005
+
+        :param tiles: list of MODIS tiles, e.g. ['h25v08', 'h26v08']
+
+        :param username: username for NASA's EarthData Login
+
+        :param password: password for NASA's EarthData Login
+
+        :param workers: maximum number of concurrent downloads
+
+        :param retries: number of attempts per file before giving up
+
+        :param timeout: socket timeout in seconds
+
+        :param verify: if True, the MD5 checksum of every cached file is recomputed and
+            compared with its record before the file is reused.  Otherwise cached files
+            are checked against their recorded size.  New downloads are always checked
+            against the checksum published by the archive.
+        """
+
+        self.cacheDir = cacheDir
+        self.url = url.rstrip('/') + '/' + path + '/' + dataset + '/'
+        self.dataset = dataset
+        self.product = dataset.split('.')[0]
+        self.tiles = tiles
+        self.workers = workers
+        self.retries = retries
+        self.timeout = timeout
+        self.verify = verify
+
+        handlers = [request.HTTPCookieProcessor()]
+        if username is not None:
+            passwords = request.HTTPPasswordMgrWithDefaultRealm()
+            passwords.add_password(None, 'https://urs.earthdata.nasa.gov', username, password)
+            passwords.add_password(None, self.url, username, password)
+            handlers.append(request.HTTPBasicAuthHandler(passwords))
+        self.opener = request.build_opener(*handlers)
+
+    def _links(self, url):
+        listing = self.opener.open(url, timeout = self.timeout).read()
+        if not isinstance(listing, str):
+            listing = listing.decode('utf-8', 'replace')
+        return re.findall(r'href="([^"]+)"', listing)
+
+    def listDays(self, today, enddate):
+
+        """
+        Returns the archive dates between enddate and today, newest first, in the
+        'YYYY.MM.DD' format of the archive directories.
+        """
+
+        first = _parseDate(enddate)
+        last = _parseDate(today)
+        days = []
+        for link in self._links(self.url):
+            m = re.match(r'^(\d{4})\.(\d{2})\.(\d{2})/?$', link)
+            if m and first <= datetime.date(*[int(g) for g in m.groups()]) <= last:
+                days.append(link.rstrip('/'))
+        return sorted(set(days), reverse = True)
+
+    def listFiles(self, day):
+
+        """
+        Returns the HDF file names of the selected tiles for one archive date.
+        """
+
+        names = []
+        for link in self._links(self.url + day + '/'):
+            name = link.split('/')[-1]
+            for tile in self.tiles:
+                if re.match(r'^%s\.A\d{7}\.%s\..+\.hdf$' % (re.escape(self.product), tile), name):
+                    names.append(name)
+        return sorted(set(names))
+
+    def cachePath(self, day, name):
+        tile = name.split('.')[2]
+        return os.path.join(self.cacheDir, self.dataset, tile, day, name)
+
+    def cached(self, day, name):
+
+        """
+        Returns True if the file is complete in the cache, checked against the size
+        (and, with verify, the checksum) recorded when it was downloaded.
+        """
+
+        target = self.cachePath(day, name)
+        if not (os.path.isfile(target) and os.path.isfile(target + '.json')):
+            return False
+        with open(target + '.json') as f:
+            record = json.load(f)
+        if os.path.getsize(target) != record['size']:
+            return False
+        if self.verify:
+            return _md5(target) == record['md5']
+        return True
+
+    def fetch(self, day, name):
+
+        """
+        Downloads one file into the cache unless it is already there.  A partial
+        file left by an interrupted run is resumed with an HTTP range request.
+        Returns the cache path of the file.
+        """
+
+        target = self.cachePath(day, name)
+        if self.cached(day, name):
+            return target
+        if not os.path.isdir(os.path.dirname(target)):
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError:
+                if not os.path.isdir(os.path.dirname(target)):
+                    raise
+
+        part = target + '.part'
+        reference = False
+        for attempt in range(1, self.retries + 1):
+            try:
+                if reference is False:
+                    reference = self.reference(day, name)
+                #a partial file that is already complete only needs to be checked
+                if reference is None or not os.path.isfile(part) or os.path.getsize(part) < reference['size']:
+                    self._get(self.url + day + '/' + name, part)
+                self._check(part, name, reference)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    raise IOError('Download of %s failed after %d attempts: %s' % (name, attempt, str(e)))
+                logger.log('WARNING', 'Download of %s failed (%s), retrying' % (name, str(e)))
+                time.sleep(2**attempt)
+
+        os.rename(part, target)
+        record = {'url': self.url + day + '/' + name, 'size': os.path.getsize(target), 'md5': _md5(target)}
+        if reference is not None:
+            record.update(reference)
+        with open(target + '.json', 'w') as f:
+            json.dump(record, f)
+        return target
+
+    def reference(self, day, name):
+
+        """
+        Returns the size, checksum type and checksum of the file in the archive,
+        read from the metadata file name.xml next to it, or None if the archive
+        has no metadata for it.
+        """
+
+        try:
+            response = self.opener.open(self.url + day + '/' + name + '.xml', timeout = self.timeout)
+        except request.HTTPError as e:
+            if e.code == 404:
+                logger.log('WARNING', 'The archive has no metadata for %s, it is only checked against its Content-Length' % name)
+                return None
+            raise
+        metadata = ElementTree.fromstring(response.read())
+        containers = metadata.findall('.//DataFileContainer') or [metadata]
+        container = containers[0]
+        for c in containers:
+            if c.findtext('DistributedFileName', '').strip() == name:
+                container = c
+        size = container.findtext('FileSize')
+        if size is None:
+            return None
+        return {'size': int(size),
+                'checksumType': container.findtext('ChecksumType', '').strip().upper() or None,
+                'checksum': container.findtext('Checksum', '').strip() or None}
+
+    def _check(self, part, name, reference):
+
+        """
+        Raises an IOError, after removing the partial file, if it does not match
+        the size and checksum of the archive.
+        """
+
+        if reference is None:
+            return
+        size = os.path.getsize(part)
+        error = None
+        if size != reference['size']:
+            error = 'size %d instead of %d bytes' % (size, reference['size'])
+        elif reference['checksumType'] in _checksums and reference['checksum'] is not None:
+            checksum = _checksums[reference['checksumType']](part)
+            if checksum != reference['checksum'].lower():
+                error = '%s checksum %s instead of %s' % (reference['checksumType'], checksum, reference['checksum'])
+        elif reference['checksumType'] is not None:
+            logger.log('WARNING', 'Unknown checksum type %s of %s, only its size was checked' % (reference['checksumType'], name))
+        if error is not None:
+            if size >= reference['size']:
+                #a corrupted or overlong file cannot be resumed
+                os.remove(part)
+            raise IOError('%s does not match the archive: %s' % (name, error))
+
+    def _get(self, url, part):
+        done = os.path.getsize(part) if os.path.isfile(part) else 0
+        req = request.Request(url)
+        if done:
+            req.add_header('Range', 'bytes=%d-' % done)
+        try:
+            response = self.opener.open(req, timeout = self.timeout)
+        except request.HTTPError as e:
+            if done and e.code == 416:
+                #the range starts at the end of the file: the partial file is already complete
+                return
+            raise
+        if done and response.getcode() != 206:
+            #the server ignored the range request and sends the whole file
+            done = 0
+        length = response.info().get('Content-Length')
+        with open(part, 'ab' if done else 'wb') as out:
+            while True:
+                chunk = response.read(1 << 20)
+                if not chunk:
+                    break
+                out.write(chunk)
+        if length is not None and os.path.getsize(part) != done + int(length):
+            raise IOError('incomplete download, %d of %d bytes' % (os.path.getsize(part), done + int(length)))
+
+    def download(self, days, destination):
+
+        """
+        Downloads all tiles of the given archive dates (see listDays) into the
+        cache and links them into destination.  Returns the paths of the cached
+        files.
+        """
+
+        pool = ThreadPool(self.workers)
+        names = pool.map(self.listFiles, days)
+        files = [(d, n) for d, dayNames in zip(days, names) for n in dayNames]
+        reused = len([dn for dn in files if self.cached(*dn)])
+        paths = pool.map(lambda dn: self.fetch(*dn), files)
+        pool.close()
+        pool.join()
+
+        for path in paths:
+            link = os.path.join(destination, os.path.basename(path))
+            if not os.path.exists(link):
+                try:
+                    os.link(path, link)
+                except OSError:
+                    os.symlink(os.path.abspath(path), link)
+        logger.log('SUCCESS', '%d HDF files of %s for %d dates are in the cache %s, %d of them were already there' % (len(paths), self.dataset, len(days), self.cacheDir, reused))
+        return paths
+
+
+def _parseDate(date):
+    for fmt in ('%Y-%m-%d', '%Y.%m.%d'):
+        try:
+            return datetime.datetime.strptime(date, fmt).date()
+        except ValueError:
+            pass
+    raise IOError('Dates must be given as YYYY-MM-DD, not %s' % str(date))
+
+def _md5(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _crcTable():
+    table = []
+    for i in range(256):
+        c = i << 24
+        for _ in range(8):
+            c = ((c << 1) ^ 0x04C11DB7) if c & 0x80000000 else (c << 1)
+        table.append(c & 0xFFFFFFFF)
+    return table
+
+_CRC = _crcTable()
+
+def _cksum(path):
+
+    """
+    Returns the POSIX cksum CRC of the file as a string, the checksum of the
+    LP DAAC metadata.  The cksum command is used where available, being much
+    faster than the loop over the bytes in Python.
+    """
+
+    try:
+        return subprocess.check_output(['cksum', path]).split()[0].decode('ascii')
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    crc = 0
+    length = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            length += len(chunk)
+            for b in bytearray(chunk):
+                crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC[(crc >> 24) ^ b]
+    while length:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC[(crc >> 24) ^ (length & 0xFF)]
+        length >>= 8
+    return str(~crc & 0xFFFFFFFF)
+
+#checksums of the archive metadata, by ChecksumType
+_checksums = {'CKSUM': _cksum, 'MD5': _md5}
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Per-Pixel Lag Features
+
+Computes lagged predictors on the pixel-major matrix viewed as a
+(pixels, intervals, variables) array, so every lag stays within its pixel:
+the first intervals of a pixel have no lag (NaN) instead of the last values
+of the previous pixel, and a lag is the value of the previous 16-day
+interval even where the row of that interval is dropped later (e.g. for
+missing landuse).  For every variable the engine computes, one block of
+pixels at a time and straight into the columns of its output:
+
+    X_lag, X_lag2, ...   the value 1, 2, ... intervals before
+    X_rollW              the mean of the W intervals before, ignoring the
+                         no data value and NaN (NaN for the first W intervals)
+    X_sdiffS             the seasonal difference of the lag, X_lag minus the
+                         value S intervals before it (S = 23 is one year)
+
+The lag 1 of the predictors replaces their column (renamed X_lag by the
+pre-processing scripts) after the other features are computed from the
+original values.
+"""
+
+import numpy as np
+
+
+def lagName(variable, lag):
+    return variable + '_lag' if lag == 1 else '%s_lag%d' % (variable, lag)
+
+def names(variables, lags = (1,), rolling = (), seasonal = (), replace = ()):
+
+    """
+    Returns the names of the columns features() computes, in its order.
+    """
+
+    out = []
+    for v in variables:
+        out += [lagName(v, k) for k in lags if not (k == 1 and v in replace)]
+        out += ['%s_roll%d' % (v, w) for w in rolling]
+        out += ['%s_sdiff%d' % (v, s) for s in seasonal]
+    return out
+
+def features(cube, columns, variables, lags = (1,), rolling = (), seasonal = (), replace = (), nodata = 9999, out = None, pixels = None):
+
+    """
+    Returns the names and the pixel-major matrix of the lag features of
+    variables (names in columns, the variables of cube).  cube is a float
+    (pixels, intervals, variables) array, e.g. the pixel-major matrix
+    reshaped without a copy; the columns of the variables in replace are
+    replaced in place by their lag 1 and get no separate X_lag column.  The
+    features are computed pixels pixels at a time (by default as many as fit
+    in about 4 million values per variable) into out, which is allocated if
+    not given.
+    """
+
+    n, intervals = cube.shape[0], cube.shape[1]
+    featureNames = names(variables, lags, rolling, seasonal, replace)
+    if out is None:
+        out = np.empty((n*intervals, len(featureNames)))
+    view = out.reshape((n, intervals, len(featureNames)))
+    pixels = pixels or max(1, 2**22 // intervals)
+    for p in range(0, n, pixels):
+        q = min(n, p + pixels)
+        j = 0
+        for v in variables:
+            x = cube[p:q, :, columns.index(v)]
+            for k in lags:
+                if not (k == 1 and v in replace):
+                    _shift(x, k, view[p:q, :, j])
+                    j += 1
+            if not rolling and not seasonal:
+                continue
+            valid = ~np.isnan(x) & (x != nodata)
+            for w in rolling:
+                _rollingMean(x, valid, w, view[p:q, :, j])
+                j += 1
+            for s in seasonal:
+                _seasonalDifference(x, valid, s, view[p:q, :, j])
+                j += 1
+        for v in replace:
+            x = cube[p:q, :, columns.index(v)]
+            x[:, 1:] = x[:, :-1].copy()
+            x[:, 0] = np.nan
+    return featureNames, out
+
+def _shift(x, k, out):
+    #value k intervals before
+    out[:, :k] = np.nan
+    if k < x.shape[1]:
+        out[:, k:] = x[:, :-k]
+
+def _rollingMean(x, valid, w, out):
+    #mean of the valid values of the w intervals before, from cumulative sums along time
+    sums = np.zeros((x.shape[0], x.shape[1] + 1))
+    np.cumsum(np.where(valid, x, 0), axis = 1, out = sums[:, 1:])
+    counts = np.zeros((x.shape[0], x.shape[1] + 1), dtype = np.int32)
+    np.cumsum(valid, axis = 1, out = counts[:, 1:])
+    out[:, :w] = np.nan
+    if w < x.shape[1]:
+        c = counts[:, w:-1] - counts[:, :-w - 1]
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            out[:, w:] = np.where(c > 0, (sums[:, w:-1] - sums[:, :-w - 1])/c, np.nan)
+
+def _seasonalDifference(x, valid, s, out):
+    #lag 1 minus the value s intervals before it
+    out[:, :s + 1] = np.nan
+    if s + 1 < x.shape[1]:
+        out[:, s + 1:] = np.where(valid[:, s:-1] & valid[:, :-s - 1], x[:, s:-1] - x[:, :-s - 1], np.nan)
@@ -1,7 +1,21 @@
 import sys, time
+import atexit, contextlib, datetime, functools, json, os, socket, threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 logfile = None
 
+#JSONL file of timing events, shared by every process of a run; AGPREDICT_EVENTS sets it for child scripts
+eventfile = os.environ.get('AGPREDICT_EVENTS')
+
 def log(category, message, console = True):
     global logfile
 
@@ -15,6 +29,9 @@ def log(category, message, console = True):
         sys.stderr.write(logtext)
     if logfile:
         logfile.write(logtext)
+        logfile.flush()
+    if eventfile:
+        event({'event': 'log', 'category': category, 'message': message})
 
 def init_logfile(filename):
     global logfile
@@ -42,3 +59,160 @@ def close_logfile():
         logfile.close()
         logfile = None
 
+def init_eventfile(filename):
+    global eventfile
+
+    #worker processes and the scripts started from this one write to the same file
+    eventfile = os.path.abspath(filename)
+    os.environ['AGPREDICT_EVENTS'] = eventfile
+
+def close_eventfile():
+    global eventfile
+
+    eventfile = None
+    os.environ.pop('AGPREDICT_EVENTS', None)
+
+def event(record):
+
+    """
+    Appends one JSON record to the event file.  The line is written with a
+    single write to a file opened for appending, under an exclusive lock, so
+    records of processes sharing the file never interleave.
+    """
+
+    if not eventfile:
+        return
+    record = dict(record, time = datetime.datetime.now().isoformat(), pid = os.getpid(), host = socket.gethostname())
+    line = json.dumps(record, sort_keys = True, default = str) + '\n'
+    fd = os.open(eventfile, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+def _usage():
+    #CPU seconds and peak resident memory in MB of this process and of its finished child processes
+    if resource is None:
+        return time.clock(), 0.0, 0.0, 0.0
+    unit = 1024.0*1024.0 if sys.platform == 'darwin' else 1024.0
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime, own.ru_maxrss/unit, children.ru_maxrss/unit
+
+def array(a):
+    return {'shape': list(a.shape), 'dtype': str(a.dtype), 'bytes': int(a.nbytes)}
+
+class Span(object):
+
+    """Timing of one stage, see span()"""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = dict(fields)
+        self.arrays = {}
+
+    def array(self, name, a):
+        #records the shape, dtype and size of an array the stage produced
+        self.arrays[name] = array(a)
+
+_spans = threading.local()
+
+def _stack():
+    if not hasattr(_spans, 'stack'):
+        _spans.stack = []
+    return _spans.stack
+
+@contextlib.contextmanager
+def span(name, **fields):
+
+    """
+    Times the enclosed block and appends a 'span' record to the event file
+    with its wall time, the CPU time of this process and of the child
+    processes it waited for, the peak resident memory of both (the process
+    peak so far, which the block raised if maxrssMB exceeds maxrssStartMB),
+    the arrays recorded with Span.array, the given fields, the enclosing span
+    and whether the block raised.  Without an event file nothing is recorded.
+    """
+
+    s = Span(name, fields)
+    if not eventfile:
+        yield s
+        return
+    parent = _stack()[-1].name if _stack() else None
+    _stack().append(s)
+    start = time.time()
+    cpu, childCpu, maxrss, childMaxrss = _usage()
+    status = 'ok'
+    try:
+        yield s
+    except BaseException as e:
+        status = 'error: %s' % repr(e)
+        raise
+    finally:
+        _stack().pop()
+        end = _usage()
+        record = dict(s.fields, event = 'span', name = name, parent = parent, status = status,
+                      start = datetime.datetime.fromtimestamp(start).isoformat(), wall = time.time() - start,
+                      cpu = end[0] - cpu, childCpu = end[1] - childCpu, maxrssStartMB = maxrss,
+                      maxrssMB = end[2], childMaxrssMB = end[3])
+        if s.arrays:
+            record['arrays'] = s.arrays
+        event(record)
+
+def timed(name = None, fields = None):
+
+    """
+    Decorator recording every call of a function as a span named after the
+    function.  fields, if given, is called with the arguments of the call once
+    it returns and gives the extra fields of the record (e.g. array sizes).
+    """
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name or f.__name__) as s:
+                result = f(*args, **kwargs)
+                if fields and eventfile:
+                    s.fields.update(fields(*args, **kwargs))
+                return result
+        return wrapper
+    return decorator
+
+_step = []
+_hooked = []
+
+def step(name, **fields):
+
+    """
+    For scripts that run top to bottom: ends the span of the previous step,
+    if any, and starts a span for the next one, recorded with the script name.  The last step ends when the
+    script exits, with an error status if it exits with an exception.
+    """
+
+    if not _hooked:
+        _hooked.append(True)
+        atexit.register(_endStep)
+        hook = sys.excepthook
+        def excepthook(kind, value, tb):
+            _endStep(value)
+            hook(kind, value, tb)
+        sys.excepthook = excepthook
+    _endStep()
+    context = span(name, **dict(fields, script = os.path.basename(sys.argv[0])))
+    context.__enter__()
+    _step.append(context)
+
+def _endStep(error = None):
+    while _step:
+        context = _step.pop()
+        if error is None:
+            context.__exit__(None, None, None)
+        else:
+            try:
+                context.__exit__(type(error), error, None)
+            except BaseException:
+                pass
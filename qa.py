@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+MODIS Quality Assessment Decoding
+
+Decodes the QA bit fields of the MODIS products with one lookup table per
+product and masking rule.  A table has an entry for every possible QA word
+(65536 for the 16-bit words of MOD09A1 and MOD13Q1, 256 for the 8-bit words
+of MOD11A2, MOD15A2 and MOD17A2) holding the quality class of that word, so
+a whole QA column is decoded with a single gather: table[words].
+
+Quality classes are UNUSABLE (0), DEGRADED (1) and GOOD (2).  Pixels of class
+UNUSABLE are masked.  Available rules:
+
+    legacy   QA bit 0 clear is GOOD, set is UNUSABLE (the original mask)
+    modland  the MODLAND summary bits (cloud state for MOD09A1)
+    strict   MODLAND plus the product specific cloud, snow, shadow,
+             retrieval and error flags
+"""
+
+import numpy as np
+
+UNUSABLE = 0
+DEGRADED = 1
+GOOD = 2
+
+#width of the QA word of each product
+BITS = {'MOD09A1': 16, 'MOD13Q1': 16, 'MOD11A2': 8, 'MOD15A2': 8, 'MOD17A2': 8}
+
+def _field(words, start, count):
+    return (words >> start) & ((1 << count) - 1)
+
+def _classes(good, degraded):
+    return np.where(good, GOOD, np.where(degraded, DEGRADED, UNUSABLE))
+
+def _legacy(w):
+    return _classes(_field(w, 0, 1) == 0, False)
+
+def _mod13Modland(w):
+    modland = _field(w, 0, 2)
+    return _classes(modland == 0, modland == 1)
+
+def _mod13Strict(w):
+    modland = _field(w, 0, 2)
+    usefulness = _field(w, 2, 4)
+    clear = (_field(w, 8, 1) == 0) & (_field(w, 10, 1) == 0) & (_field(w, 14, 1) == 0) & (_field(w, 15, 1) == 0)
+    land = _field(w, 11, 3) == 1
+    usable = (modland <= 1) & (usefulness <= 2) & clear & land
+    return _classes(usable & (modland == 0) & (usefulness <= 1), usable)
+
+def _mod11Modland(w):
+    modland = _field(w, 0, 2)
+    return _classes(modland == 0, modland == 1)
+
+def _mod11Strict(w):
+    modland = _field(w, 0, 2)
+    lstError = _field(w, 6, 2)
+    return _classes(modland == 0, (modland == 1) & (_field(w, 2, 2) == 0) & (lstError <= 1))
+
+def _fparModland(w):
+    scf = _field(w, 5, 3)
+    return _classes((_field(w, 0, 1) == 0) & (scf != 4), scf != 4)
+
+def _fparStrict(w):
+    scf = _field(w, 5, 3)
+    cloud = _field(w, 3, 2)
+    usable = (scf <= 1) & ((cloud == 0) | (cloud == 3)) & (_field(w, 2, 1) == 0)
+    return _classes(usable & (_field(w, 0, 1) == 0), usable)
+
+def _mod09Modland(w):
+    cloud = _field(w, 0, 2)
+    shadow = _field(w, 2, 1)
+    return _classes(((cloud == 0) | (cloud == 3)) & (shadow == 0), (cloud == 2) & (shadow == 0))
+
+def _mod09Strict(w):
+    cloud = _field(w, 0, 2)
+    clear = ((cloud == 0) | (cloud == 3)) & (_field(w, 2, 1) == 0) & (_field(w, 8, 2) == 0) & (_field(w, 10, 1) == 0)
+    snow = (_field(w, 12, 1) == 1) | (_field(w, 15, 1) == 1)
+    return _classes(clear & ~snow & (_field(w, 13, 1) == 0) & (_field(w, 6, 2) != 3), False)
+
+RULES = {'MOD09A1': {'legacy': _legacy, 'modland': _mod09Modland, 'strict': _mod09Strict},
+         'MOD13Q1': {'legacy': _legacy, 'modland': _mod13Modland, 'strict': _mod13Strict},
+         'MOD11A2': {'legacy': _legacy, 'modland': _mod11Modland, 'strict': _mod11Strict},
+         'MOD15A2': {'legacy': _legacy, 'modland': _fparModland, 'strict': _fparStrict},
+         'MOD17A2': {'legacy': _legacy, 'modland': _fparModland, 'strict': _fparStrict}}
+
+_tables = {}
+
+def table(product, rule = 'legacy'):
+
+    """
+    Returns the lookup table of quality classes for every QA word of product
+    (e.g. 'MOD13Q1' or 'MOD13Q1.005') under rule.
+    """
+
+    product = product.split('.')[0]
+    if product not in RULES or rule not in RULES[product]:
+        raise IOError("No QA rule %s for %s. Available rules are %s" % (str(rule), product, sorted(RULES.get(product, {}))))
+    if (product, rule) not in _tables:
+        words = np.arange(2**BITS[product], dtype = np.uint32)
+        _tables[(product, rule)] = RULES[product][rule](words).astype(np.uint8)
+    return _tables[(product, rule)]
+
+def classify(qc, product, rule = 'legacy'):
+
+    """
+    Returns the quality class of every value of the QA array qc.  qc may hold the
+    QA words as floats, as in the band matrix; they are cast to the width of the
+    product's QA word first.
+    """
+
+    dtype = np.uint16 if BITS[product.split('.')[0]] == 16 else np.uint8
+    return table(product, rule)[qc.astype(dtype)]
+
+def usable(qc, product, rule = 'legacy'):
+    return classify(qc, product, rule) != UNUSABLE
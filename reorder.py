@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Pixel-Major Reordering
+
+The band matrices and the column store are time-major: row t*pixels + p
+holds pixel p at 16-day interval t, with the same pixels in the same order
+in every interval.  The modeling data is pixel-major, sorted by uniq_id and
+then timeID.  Instead of sorting, the rows are reordered with the transpose
+(intervals, pixels, variables) -> (pixels, intervals, variables), copied one
+block of pixels at a time into the output, which may be a memory-mapped
+array for inputs larger than memory.  The pixel and the interval of every
+pixel-major row follow from its index, so uniq_id and time_period are
+computed as integers for the rows that are kept instead of being sorted
+along as float columns.  pixelBlock reads the rows of one block of pixels
+from a memory-mapped matrix, e.g. for the --block mode of 1_pre_process.py,
+and compactRows drops rows without a copy of the matrix.
+"""
+
+import numpy as np
+
+
+def isTimeMajor(timeID, intervals):
+
+    """
+    Returns True if the timeID column numbers the intervals 1, 2, ... in
+    blocks of equal length, i.e. the matrix is time-major.
+    """
+
+    if timeID.shape[0] % intervals != 0:
+        return False
+    t = np.asarray(timeID).reshape((intervals, timeID.shape[0] // intervals))
+    return bool((t == np.arange(1, intervals + 1).reshape((intervals, 1))).all())
+
+def pixelMajor(dat, intervals, out = None, pixels = None):
+
+    """
+    Returns the rows of the time-major matrix dat (or vector) in pixel-major
+    order.  The rows are copied pixels pixels at a time (by default as many
+    as fit in about 32 million values) into out, which is allocated if not
+    given and may be memory-mapped.
+    """
+
+    width = 1 if len(dat.shape) == 1 else dat.shape[1]
+    n = dat.shape[0] // intervals
+    if out is None:
+        out = np.empty(dat.shape, dtype = dat.dtype)
+    pixels = pixels or max(1, 2**25 // (intervals*width))
+    for p in range(0, n, pixels):
+        q = min(n, p + pixels)
+        pixelBlock(dat, intervals, p, q, out[p*intervals:q*intervals])
+    return out
+
+def pixelBlock(dat, intervals, first, last, out = None):
+
+    """
+    Returns the rows of pixels first to last - 1 of the time-major matrix dat
+    (or vector) in pixel-major order.  Only those rows are read, so dat may
+    be a memory-mapped matrix larger than memory.
+    """
+
+    width = 1 if len(dat.shape) == 1 else dat.shape[1]
+    n = dat.shape[0] // intervals
+    if out is None:
+        out = np.empty(((last - first)*intervals,) + dat.shape[1:], dtype = dat.dtype)
+    out.reshape((last - first, intervals, width))[:] = dat.reshape((intervals, n, width))[:, first:last].transpose((1, 0, 2))
+    return out
+
+def pixelPositions(rows, intervals):
+    #position in the pixel order of the pixel of every pixel-major row
+    return np.asarray(rows) // intervals
+
+def timeIndex(rows, intervals):
+    #interval (0 for the first) of every pixel-major row
+    return np.asarray(rows) % intervals
+
+def timePeriods(rows, intervals, periods = 23):
+    #period of the year, 1 to 23, of every pixel-major row
+    return (timeIndex(rows, intervals) % periods + 1).astype(np.int8)
+
+def compactRows(dat, rows, block = None):
+
+    """
+    Returns the rows (increasing positions) of dat as a view of its first
+    rows, moved there in place a block at a time instead of being copied to
+    a new array.  Every row moves towards the front, so no row is
+    overwritten before it is moved.
+    """
+
+    width = 1 if len(dat.shape) == 1 else dat.shape[1]
+    block = block or max(1, 2**22 // max(1, width))
+    for start in range(0, len(rows), block):
+        stop = min(len(rows), start + block)
+        dat[start:stop] = dat[rows[start:stop]]
+    return dat[:len(rows)]
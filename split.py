@@ -0,0 +1,127 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Grid Block Training Split
+
+Assigns whole autocorrelation grids to the training data so that about a
+proportion of the rows are training rows.  The rows of every grid are
+counted once, the grids are visited in a seeded random order and a grid is
+taken whenever it fits in the rows still needed, then the remaining grid
+that brings the training rows closest to the target is added if it
+improves the split.  If that misses the proportion, e.g. for a few large
+grids, the subset of the grids closest to it is solved for instead (on
+counts rounded to at most 65536 units).  The split is found in one attempt,
+the same for the same seed, and the training mask of the rows is a
+vectorized lookup of their grid in the chosen grids.
+"""
+
+import numpy as np
+import logger
+
+
+def gridCounts(grid):
+
+    """
+    Returns the grids, their number of rows and the position in the grids of
+    the grid of every row.  Integer grids are counted with np.bincount,
+    without sorting the rows.
+    """
+
+    grid = np.asarray(grid)
+    if grid.dtype.kind == 'f' and len(grid) and (grid == np.round(grid)).all():
+        grid = grid.astype(np.int64)
+    if grid.dtype.kind in 'iu' and len(grid) and grid.min() >= 0 and grid.max() < 4*len(grid):
+        counts = np.bincount(grid)
+        grids = np.flatnonzero(counts)
+        position = np.zeros(len(counts), dtype = np.int64)
+        position[grids] = np.arange(len(grids))
+        return grids, counts[grids], position[grid]
+    grids, inverse, counts = np.unique(grid, return_inverse = True, return_counts = True)
+    return grids, counts, inverse
+
+def chooseGrids(counts, prop = 0.8, seed = 0):
+
+    """
+    Returns True for the grids of the training data, whose counts add up as
+    closely as the greedy choice gets to prop of the total.
+    """
+
+    target = prop*counts.sum()
+    order = np.random.RandomState(seed).permutation(len(counts))
+    chosen = np.zeros(len(counts), dtype = bool)
+    total = 0
+    for i in order:
+        if total + counts[i] <= target:
+            chosen[i] = True
+            total += counts[i]
+    rest = np.flatnonzero(~chosen)
+    if len(rest):
+        i = rest[np.argmin(np.abs(total + counts[rest] - target))]
+        if abs(total + counts[i] - target) < target - total:
+            chosen[i] = True
+    return chosen
+
+def subsetSum(counts, prop = 0.8, seed = 0, units = 2**16):
+
+    """
+    Returns True for the grids whose counts add up closest to prop of the
+    total, solved by dynamic programming over the grids in a seeded random
+    order, or None if the table of reachable sums would be too large.
+    """
+
+    scale = max(1.0, counts.sum()/float(units))
+    weights = np.round(counts/scale).astype(np.int64)
+    target = int(round(prop*counts.sum()/scale))
+    size = int(weights.sum()) + 1
+    if len(counts)*size > 2**26:
+        return None
+    order = np.random.RandomState(seed).permutation(len(counts))
+    reachable = [np.zeros(size, dtype = bool)]
+    reachable[0][0] = True
+    for i in order:
+        r = reachable[-1].copy()
+        if weights[i]:
+            r[weights[i]:] |= reachable[-1][:-weights[i]]
+        reachable.append(r)
+    sums = np.flatnonzero(reachable[-1])
+    total = sums[np.argmin(np.abs(sums - target))]
+    chosen = np.zeros(len(counts), dtype = bool)
+    for k in range(len(order), 0, -1):
+        if not reachable[k - 1][total]:
+            chosen[order[k - 1]] = True
+            total -= weights[order[k - 1]]
+    return chosen
+
+def trainingMask(grid, trainingGrids):
+    #True for the rows of other data whose grid is a training grid
+    return np.isin(np.asarray(grid), trainingGrids)
+
+def chooseTraining(counts, prop = 0.8, seed = 0, tolerance = 0.01):
+
+    """
+    Returns True for the training grids, given the number of rows of every
+    grid: the greedy choice, or the subset sum if that misses prop by more
+    than tolerance.  A warning is logged if the split still misses it.
+    """
+
+    chosen = chooseGrids(counts, prop, seed)
+    if abs(counts[chosen].sum()/float(counts.sum()) - prop) > tolerance:
+        solved = subsetSum(counts, prop, seed)
+        if solved is not None:
+            chosen = solved
+    achieved = counts[chosen].sum()/float(counts.sum())
+    if abs(achieved - prop) > tolerance:
+        logger.log('WARNING', 'The %d grids put %.3f of the rows in the training data instead of %.2f' % (len(counts), achieved, prop))
+    return chosen
+
+def split(grid, prop = 0.8, seed = 0, tolerance = 0.01):
+
+    """
+    Returns the training mask of the rows with the autocorrelation grids in
+    grid and the training grids.
+    """
+
+    grids, counts, position = gridCounts(grid)
+    chosen = chooseTraining(counts, prop, seed, tolerance)
+    return chosen[position], grids[chosen]
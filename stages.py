@@ -0,0 +1,139 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Stage Manifest
+
+Records the stages of agpredict.Image.prepare() that completed in a JSON
+file next to the files of the product.  For every stage the manifest holds
+the files it produced (path, size and modification time, and the MD5
+checksum if checksums are on) and the attributes the later stages need, e.g.
+the observations and filelist found by download().  A resumed run finds the
+last stage whose files are still intact, restores the attributes of the
+stages up to it and carries on with the next stage.  Only checksummed runs
+read the outputs, so recording a stage of many large files stays cheap.
+
+The manifest also records the options the stages depend on (dataset, tiles,
+dates, ingest mode, ...); a manifest written with other options is discarded.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import logger
+
+
+class StageManifest(object):
+
+    """Completed stages of a product, their output files and state"""
+
+    def __init__(self, path, options, checksums = False):
+
+        """
+        :param path: JSON file of the manifest, e.g. directory/MOD13Q1.005/stages.json
+
+        :param options: JSON serializable dict of the options the stages depend on
+
+        :param checksums: if True, the MD5 checksums of the outputs are recorded and
+            compared as well as their size and modification time
+        """
+
+        self.path = path
+        self.checksums = checksums
+        self.options = json.loads(json.dumps(options))
+        self.manifest = {'options': self.options, 'stages': []}
+        if os.path.isfile(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest['options'] == self.options:
+                self.manifest = manifest
+            else:
+                logger.log('WARNING', 'The stages recorded in %s were run with other options and are ignored' % path)
+
+    def names(self):
+        return [s['name'] for s in self.manifest['stages']]
+
+    def stage(self, name):
+        for s in self.manifest['stages']:
+            if s['name'] == name:
+                return s
+        return None
+
+    def reset(self):
+
+        """
+        Forgets every recorded stage, for a run that starts over.
+        """
+
+        self.manifest = {'options': self.options, 'stages': []}
+        self._dump()
+
+    def record(self, name, outputs, state = None, persistent = True):
+
+        """
+        Records that stage name completed, producing the files in outputs, and
+        the attributes in state (a JSON serializable dict) that later stages need.
+        A stage whose output is not persistent (e.g. an array held in memory)
+        is recorded but cannot be resumed after.  A stage recorded again replaces
+        its earlier record and the records of the stages after it.
+        """
+
+        stages = self.names()
+        if name in stages:
+            del self.manifest['stages'][stages.index(name):]
+        files = []
+        for p in sorted(outputs):
+            f = {'path': p, 'size': os.path.getsize(p), 'mtime': os.path.getmtime(p)}
+            if self.checksums:
+                f['md5'] = _md5(p)
+            files.append(f)
+        self.manifest['stages'].append({'name': name, 'completed': datetime.datetime.now().isoformat(),
+                                        'outputs': files, 'state': state or {}, 'persistent': persistent})
+        self._dump()
+
+    def intact(self, name):
+
+        """
+        Returns True if stage name is recorded and all its files still exist
+        with the recorded size and modification time, and checksum if both the
+        record and this manifest have checksums.
+        """
+
+        s = self.stage(name)
+        if s is None or not s['persistent']:
+            return False
+        for f in s['outputs']:
+            if not os.path.isfile(f['path']) or os.path.getsize(f['path']) != f['size'] or os.path.getmtime(f['path']) != f.get('mtime'):
+                return False
+            if self.checksums and 'md5' in f and _md5(f['path']) != f['md5']:
+                return False
+        return True
+
+    def resumeAfter(self, order):
+
+        """
+        Returns the position in order (the stages of a run, in the order they
+        run) of the last stage that completed with its files intact, or -1 if
+        the run has to start from the first stage.  Stages whose files were
+        consumed by a later stage (e.g. the mosaics removed by convert()) do not
+        need to be intact.
+        """
+
+        for k in range(len(order) - 1, -1, -1):
+            if all(self.stage(name) is not None for name in order[:k + 1]) and self.intact(order[k]):
+                return k
+        return -1
+
+    def _dump(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent = 1, sort_keys = True)
+        os.rename(self.path + '.tmp', self.path)
+
+
+def _md5(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Streaming Column Statistics
+
+Computes per column statistics of a matrix in one pass over blocks of rows,
+so a memory-mapped .npy (or a column store, column by column) is summarized
+without loading it and without full-size temporary copies.  For every column
+it keeps the number of values, the number of missing values (the no data
+value or NaN), the minimum, maximum, mean and variance of the valid values
+(merged block by block with the pairwise update of Chan et al.) and a
+histogram.  The histogram starts on the range of the first block and doubles
+the width of its bins whenever a later block falls outside it, merging pairs
+of bins, so its counts are exact for the final bins.
+
+    python streamstats.py matrix.npy [columnNames.txt]
+
+writes matrix.stats.json and matrix.stats.csv next to the matrix.
+"""
+
+import csv
+import json
+import os
+import sys
+import numpy as np
+
+BINS = 64
+
+
+class ColumnStats(object):
+
+    """Running statistics of one column"""
+
+    def __init__(self, name, nodata = None, scale = None, bins = BINS):
+        self.name = name
+        self.nodata = nodata
+        self.scale = scale
+        self.bins = bins
+        self.count = 0
+        self.missing = 0
+        self.valid = 0
+        self.min = None
+        self.max = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.low = None
+        self.width = None
+        self.counts = np.zeros(bins, dtype = np.int64)
+
+    def update(self, values):
+
+        """
+        Adds a block of values.  Missing values are counted and skipped; raw
+        values are scaled after the no data test.
+        """
+
+        values = np.asarray(values).reshape(-1)
+        self.count += values.shape[0]
+        bad = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(values.shape[0], dtype = bool)
+        if self.nodata is not None:
+            bad |= values == self.nodata
+        if bad.any():
+            self.missing += int(bad.sum())
+            values = values[~bad]
+        if values.shape[0] == 0:
+            return
+        values = values.astype(float)
+        if self.scale is not None:
+            values *= self.scale
+
+        n, lo, hi = values.shape[0], values.min(), values.max()
+        mean = values.mean()
+        m2 = ((values - mean)**2).sum()
+        total = self.valid + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta**2*self.valid*n/total
+        self.mean += delta*n/total
+        self.valid = total
+        self.min = lo if self.min is None else min(self.min, lo)
+        self.max = hi if self.max is None else max(self.max, hi)
+        self._histogram(values, lo, hi)
+
+    def _histogram(self, values, lo, hi):
+        if self.low is None:
+            self.low = lo
+            self.width = (hi - lo)/self.bins if hi > lo else 1.0
+        #widen the range, merging pairs of bins, until the block fits
+        while lo < self.low:
+            self.counts = np.r_[np.zeros(self.bins, dtype = np.int64), self.counts].reshape((self.bins, 2)).sum(axis = 1)
+            self.low -= self.width*self.bins
+            self.width *= 2
+        while hi >= self.low + self.width*self.bins:
+            self.counts = np.r_[self.counts, np.zeros(self.bins, dtype = np.int64)].reshape((self.bins, 2)).sum(axis = 1)
+            self.width *= 2
+        index = np.minimum(((values - self.low)/self.width).astype(np.int64), self.bins - 1)
+        self.counts += np.bincount(index, minlength = self.bins)
+
+    def merge(self, other):
+
+        """
+        Adds the statistics of other, e.g. of another column for the summary of
+        a whole matrix.  The histograms are not merged.
+        """
+
+        self.count += other.count
+        self.missing += other.missing
+        if other.valid == 0:
+            return self
+        total = self.valid + other.valid
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta**2*self.valid*other.valid/total
+        self.mean += delta*other.valid/total
+        self.valid = total
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def result(self):
+        variance = self.m2/self.valid if self.valid else None
+        out = {'name': self.name, 'count': self.count, 'missing': self.missing,
+               'missingFraction': self.missing/float(self.count) if self.count else None,
+               'valid': self.valid, 'min': _number(self.min), 'max': _number(self.max),
+               'mean': self.mean if self.valid else None, 'variance': variance,
+               'std': variance**0.5 if variance is not None else None}
+        if self.low is not None:
+            out['histogram'] = {'edges': [float(self.low + self.width*i) for i in range(self.bins + 1)],
+                                'counts': [int(c) for c in self.counts]}
+        return out
+
+
+def arrayStats(array, names = None, nodata = None, scale = None, rows = None, bins = BINS):
+
+    """
+    Returns the ColumnStats of every column of a 1 or 2 dimensional array,
+    e.g. a memory-mapped .npy, computed in one pass over blocks of rows (by
+    default about 4 million values).  scale is a list with the scale factor
+    of every column, or None, for raw integer columns.
+    """
+
+    if len(array.shape) == 1:
+        array = array.reshape((array.shape[0], 1))
+    columns = array.shape[1]
+    names = names or ['column%d' % j for j in range(columns)]
+    scale = scale or [None]*columns
+    stats = [ColumnStats(names[j], nodata, scale[j], bins) for j in range(columns)]
+    rows = rows or max(1, 2**22 // columns)
+    for start in range(0, array.shape[0], rows):
+        block = np.asarray(array[start:start + rows])
+        for j in range(columns):
+            stats[j].update(block[:, j])
+    return stats
+
+def storeStats(store, names = None, bins = BINS):
+
+    """
+    Returns the ColumnStats of columns of a colstore.ColumnStore (by default
+    its data columns), read one chunk at a time.
+    """
+
+    stats = []
+    for name in names or store.names('data'):
+        s = ColumnStats(name, store.manifest['fill'], None, bins)
+        for start, stop in store.manifest['chunks']:
+            s.update(store.column(name, start, stop))
+        stats.append(s)
+    return stats
+
+def total(stats, name = 'all'):
+    #statistics of all the columns together
+    out = ColumnStats(name)
+    for s in stats:
+        out.merge(s)
+    return out
+
+def write(stats, prefix):
+
+    """
+    Writes the statistics to prefix.json (with the histograms) and prefix.csv
+    (one row per column).
+    """
+
+    results = [s.result() for s in stats]
+    with open(prefix + '.json', 'w') as f:
+        json.dump(results, f, indent = 1, sort_keys = True)
+    fields = ['name', 'count', 'valid', 'missing', 'missingFraction', 'min', 'max', 'mean', 'variance', 'std']
+    with open(prefix + '.csv', 'w') as f:
+        writer = csv.writer(f, lineterminator = '\n')
+        writer.writerow(fields)
+        for r in results:
+            writer.writerow([r[k] for k in fields])
+    return results
+
+def _number(x):
+    return None if x is None else float(x)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1]
+    array = np.load(path, mmap_mode = 'r')
+    names = open(sys.argv[2]).read().split() if len(sys.argv) > 2 else None
+    write(arrayStats(array, names, nodata = 9999), os.path.splitext(path)[0] + '.stats')
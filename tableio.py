@@ -0,0 +1,154 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Table Interchange
+
+Reads and writes the tables the numbered scripts pass to each other, with
+pandas or H2O.  The format follows the extension of the path:
+
+    .parquet    typed, compressed columns in row groups (needs pyarrow), which
+                H2O imports in parallel without parsing text
+    .feather    typed columns (needs pyarrow), fastest for the scripts that
+                only use pandas, e.g. 2_baseline_process.py and 4_baseline.py
+    otherwise   CSV with a header, as before
+
+so passing data.parquet instead of data.csv between the scripts avoids
+formatting and parsing the table as text at every stage.  FrameWriter
+appends a table block by block, e.g. for the --block mode of
+1_pre_process.py.
+"""
+
+import os
+import pandas as pd
+import logger
+
+#rows per row group of a Parquet file
+ROW_GROUP = 2**20
+
+
+def tableFormat(path):
+    extension = os.path.splitext(path.rstrip('/'))[1].lower()
+    return {'.parquet': 'parquet', '.pq': 'parquet', '.feather': 'feather'}.get(extension, 'csv')
+
+def writeFrame(df, path, header = True):
+
+    """
+    Writes the pandas DataFrame df to path without its index.  header = False
+    leaves out the column names of a CSV file.
+    """
+
+    kind = tableFormat(path)
+    if kind == 'parquet':
+        df.to_parquet(path, engine = 'pyarrow', compression = 'snappy', index = False, row_group_size = ROW_GROUP)
+    elif kind == 'feather':
+        #feather stores no index, so it has to be the default one
+        df.reset_index(drop = True).to_feather(path)
+    else:
+        df.to_csv(path, header = header, index = False)
+
+class FrameWriter(object):
+
+    """Writes a table to a CSV or Parquet file one block of rows at a time"""
+
+    def __init__(self, path):
+        self.path = path
+        self.kind = tableFormat(path)
+        if self.kind == 'feather':
+            raise IOError('A Feather file cannot be written block by block. Please write %s as .parquet or .csv' % path)
+        self.writer = None
+        self.started = False
+        self.rows = 0
+
+    def write(self, df):
+
+        """
+        Appends the rows of the pandas DataFrame df, which has the columns and
+        dtypes of the first block.
+        """
+
+        if self.kind == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(df, preserve_index = False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema, compression = 'snappy')
+            self.writer.write_table(table, row_group_size = ROW_GROUP)
+        else:
+            df.to_csv(self.path, mode = 'a' if self.started else 'w', header = not self.started, index = False)
+        self.started = True
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+def readFrame(path, columns = None):
+    #pandas DataFrame of the table at path, only the given columns if any
+    kind = tableFormat(path)
+    if kind == 'parquet':
+        return pd.read_parquet(path, engine = 'pyarrow', columns = columns)
+    if kind == 'feather':
+        df = pd.read_feather(path)
+        return df[columns] if columns else df
+    return pd.read_csv(path, usecols = columns)
+
+def importFrame(path):
+
+    """
+    Returns the table at path as an H2OFrame.  CSV and Parquet files are
+    imported by the H2O cluster; H2O cannot read Feather, so a Feather file
+    is read with pandas and uploaded.
+    """
+
+    import h2o
+    if tableFormat(path) == 'feather':
+        return h2o.H2OFrame(readFrame(path))
+    return h2o.import_file(path = path)
+
+def exportFrame(frame, path):
+
+    """
+    Writes the H2OFrame frame to path.  When the cluster cannot export
+    Parquet itself (older versions of H2O have no format argument), the frame
+    is exported as CSV next to path and converted ROW_GROUP rows at a time,
+    so the frame is never copied into the memory of this process.  Feather
+    cannot be written in blocks, so it has to be exported as .csv or .parquet.
+    """
+
+    import h2o
+    kind = tableFormat(path)
+    if kind == 'feather':
+        raise IOError('An H2OFrame cannot be exported as Feather without copying it into memory. Please write %s as .csv or .parquet' % path)
+    if kind == 'csv':
+        h2o.export_file(frame = frame, path = path, force = True)
+        return
+    try:
+        h2o.export_file(frame = frame, path = path, force = True, format = 'parquet')
+        return
+    except Exception as e:
+        logger.log('WARNING', 'H2O could not export Parquet (%s), converting a CSV export instead' % e)
+    csv = path + '.csv'
+    h2o.export_file(frame = frame, path = csv, force = True)
+    #numeric columns as float so that a missing value in a later block does not change the schema
+    dtypes = dict((c, float if t in ('int', 'real') else object) for c, t in frame.types.items())
+    writer = FrameWriter(path)
+    try:
+        for df in pd.read_csv(csv, dtype = dtypes, chunksize = ROW_GROUP):
+            writer.write(df)
+    finally:
+        writer.close()
+        os.remove(csv)
+
+def falseRows(column):
+
+    """
+    Returns the rows of the boolean column of an H2OFrame (e.g. 'training')
+    that are False: H2O parses True and False of a CSV file as a factor, but
+    imports the boolean column of a Parquet file as 0 and 1.
+    """
+
+    if column.isfactor()[0]:
+        return column != 'True'
+    return column == 0
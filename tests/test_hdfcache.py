@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Tests of hdfcache.py against a local HTTP server with the directory layout of
+the MODIS archive: resumed, retried and cached downloads.
+
+    python -m unittest discover tests
+"""
+
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+try:
+    import SimpleHTTPServer as server
+    import SocketServer as socketserver
+except ImportError:
+    import http.server as server
+    import socketserver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import hdfcache
+
+DATASET = 'MOD13Q1.005'
+DAY = '2016.01.01'
+NAME = 'MOD13Q1.A2016001.h25v08.005.2016029083317.hdf'
+
+METADATA = """<?xml version="1.0" encoding="UTF-8"?>
+<GranuleMetaDataFile>
+  <GranuleURMetaData>
+    <DataFiles>
+      <DataFileContainer>
+        <DistributedFileName>%s</DistributedFileName>
+        <FileSize>%d</FileSize>
+        <ChecksumType>CKSUM</ChecksumType>
+        <Checksum>%s</Checksum>
+      </DataFileContainer>
+    </DataFiles>
+  </GranuleURMetaData>
+</GranuleMetaDataFile>
+"""
+
+
+class ArchiveHandler(server.SimpleHTTPRequestHandler):
+
+    """Serves the archive directory with range requests and injected failures"""
+
+    #paths requested, with their Range header
+    requests = []
+    #number of responses of an HDF file still to cut short without a Content-Length
+    truncate = 0
+
+    def translate_path(self, path):
+        return os.path.join(self.server.root, path.lstrip('/').split('?')[0])
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        ArchiveHandler.requests.append((self.path, self.headers.get('Range')))
+        if os.path.isdir(path) or not path.endswith('.hdf'):
+            return server.SimpleHTTPRequestHandler.do_GET(self)
+        with open(path, 'rb') as f:
+            data = f.read()
+        start = 0
+        if self.headers.get('Range'):
+            start = int(self.headers.get('Range').split('=')[1].rstrip('-'))
+        if start >= len(data):
+            self.send_error(416)
+            return
+        if ArchiveHandler.truncate:
+            ArchiveHandler.truncate -= 1
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(data[:len(data)//2])
+            self.close_connection = True
+            return
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+class HDFCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.root, 'cache')
+        archive = os.path.join(self.root, 'archive', 'MOLT', DATASET, DAY)
+        os.makedirs(archive)
+        self.data = os.urandom(3*2**20 + 12345)
+        self.hdf = os.path.join(archive, NAME)
+        with open(self.hdf, 'wb') as f:
+            f.write(self.data)
+        with open(self.hdf + '.xml', 'w') as f:
+            f.write(METADATA % (NAME, len(self.data), hdfcache._cksum(self.hdf)))
+
+        socketserver.TCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), ArchiveHandler)
+        self.server.root = os.path.join(self.root, 'archive')
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        ArchiveHandler.requests = []
+        ArchiveHandler.truncate = 0
+
+        self.sleep = hdfcache.time.sleep
+        hdfcache.time.sleep = lambda seconds: None
+
+    def tearDown(self):
+        hdfcache.time.sleep = self.sleep
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def cache(self, **kwargs):
+        url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        return hdfcache.HDFCache(self.cacheDir, url, 'MOLT', DATASET, ['h25v08'], **kwargs)
+
+    def hdfRequests(self):
+        return [r for r in ArchiveHandler.requests if r[0].endswith('.hdf')]
+
+    def assertComplete(self, path):
+        with open(path, 'rb') as f:
+            self.assertEqual(hashlib.md5(f.read()).hexdigest(), hashlib.md5(self.data).hexdigest())
+
+    def test_cksum(self):
+        #the Python CRC is the one of the cksum command
+        checksum = hdfcache._cksum(self.hdf)
+        check_output = hdfcache.subprocess.check_output
+        def missing(*args):
+            raise OSError('no cksum')
+        hdfcache.subprocess.check_output = missing
+        try:
+            self.assertEqual(hdfcache._cksum(self.hdf), checksum)
+        finally:
+            hdfcache.subprocess.check_output = check_output
+
+    def test_download_and_skip_cached(self):
+        hc = self.cache()
+        self.assertEqual(hc.listDays('2016-01-01', '2016-01-01'), [DAY])
+        destination = os.path.join(self.root, 'run')
+        os.makedirs(destination)
+        paths = hc.download([DAY], destination)
+        self.assertEqual(paths, [hc.cachePath(DAY, NAME)])
+        self.assertComplete(paths[0])
+        self.assertComplete(os.path.join(destination, NAME))
+        self.assertEqual(len(self.hdfRequests()), 1)
+
+        #a second run fetches nothing, with or without verify
+        ArchiveHandler.requests = []
+        self.assertEqual(self.cache().download([DAY], destination), paths)
+        self.assertEqual(self.cache(verify = True).download([DAY], destination), paths)
+        self.assertEqual(self.hdfRequests(), [])
+
+    def test_resume(self):
+        hc = self.cache()
+        target = hc.cachePath(DAY, NAME)
+        os.makedirs(os.path.dirname(target))
+        with open(target + '.part', 'wb') as f:
+            f.write(self.data[:2**20])
+        hc.fetch(DAY, NAME)
+        self.assertEqual(self.hdfRequests(), [('/MOLT/%s/%s/%s' % (DATASET, DAY, NAME), 'bytes=%d-' % 2**20)])
+        self.assertComplete(target)
+        self.assertFalse(os.path.exists(target + '.part'))
+
+    def test_complete_part_without_metadata(self):
+        #a download that was complete but not renamed, from an archive without metadata
+        os.remove(self.hdf + '.xml')
+        hc = self.cache(retries = 2)
+        target = hc.cachePath(DAY, NAME)
+        os.makedirs(os.path.dirname(target))
+        with open(target + '.part', 'wb') as f:
+            f.write(self.data)
+        hc.fetch(DAY, NAME)
+        self.assertEqual(self.hdfRequests(), [('/MOLT/%s/%s/%s' % (DATASET, DAY, NAME), 'bytes=%d-' % len(self.data))])
+        self.assertComplete(target)
+        self.assertTrue(hc.cached(DAY, NAME))
+
+    def test_retry_truncated(self):
+        #the first response is cut short and has no Content-Length, the metadata catches it
+        ArchiveHandler.truncate = 1
+        target = self.cache(retries = 3).fetch(DAY, NAME)
+        self.assertComplete(target)
+        self.assertEqual(len(self.hdfRequests()), 2)
+
+    def test_corrupted(self):
+        with open(self.hdf, 'r+b') as f:
+            f.seek(100)
+            f.write(b'corrupted')
+        hc = self.cache(retries = 2)
+        self.assertRaises(IOError, hc.fetch, DAY, NAME)
+        self.assertFalse(hc.cached(DAY, NAME))
+        self.assertEqual(len(self.hdfRequests()), 2)
+
+    def test_verify_cached(self):
+        hc = self.cache(verify = True)
+        target = hc.fetch(DAY, NAME)
+        with open(target, 'r+b') as f:
+            f.write(b'corrupted')
+        self.assertTrue(self.cache().cached(DAY, NAME))
+        self.assertFalse(hc.cached(DAY, NAME))
+
+
+if __name__ == '__main__':
+    unittest.main()
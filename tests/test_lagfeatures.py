@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Tests of lagfeatures.py: every lag stays within its pixel and matches a
+loop over the intervals of every pixel.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import lagfeatures
+
+
+class LagFeaturesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pixels, self.intervals = 6, 30
+        rs = np.random.RandomState(0)
+        self.cube = rs.rand(self.pixels, self.intervals, 3)
+        self.cube[rs.rand(self.pixels, self.intervals) < .1, 1] = 9999
+        self.columns = ['EVI', 'LST', 'timeID']
+
+    def test_first_intervals_are_nan(self):
+        for pixels in (None, 1, 4):
+            names, out = lagfeatures.features(self.cube, self.columns, ['EVI', 'LST'], lags = (1, 2, 3), pixels = pixels)
+            self.assertEqual(names, lagfeatures.names(['EVI', 'LST'], (1, 2, 3)))
+            view = out.reshape((self.pixels, self.intervals, len(names)))
+            for j, name in enumerate(names):
+                k = int(name.split('_lag')[1] or 1)
+                #the first k intervals of every pixel have no lag, not the values of the previous pixel
+                self.assertTrue(np.isnan(view[:, :k, j]).all())
+                variable = self.cube[:, :, self.columns.index(name.split('_lag')[0])]
+                np.testing.assert_array_equal(view[:, k:, j], variable[:, :-k])
+
+    def test_rolling_and_seasonal(self):
+        names, out = lagfeatures.features(self.cube, self.columns, ['LST'], lags = (), rolling = (3,), seasonal = (23,), pixels = 4)
+        self.assertEqual(names, ['LST_roll3', 'LST_sdiff23'])
+        view = out.reshape((self.pixels, self.intervals, 2))
+        x = self.cube[:, :, 1]
+        for p in range(self.pixels):
+            for t in range(self.intervals):
+                window = [v for v in x[p, max(0, t - 3):t] if v != 9999]
+                if t < 3 or not window:
+                    self.assertTrue(np.isnan(view[p, t, 0]))
+                else:
+                    self.assertAlmostEqual(view[p, t, 0], np.mean(window))
+                if t < 24 or 9999 in (x[p, t - 1], x[p, t - 24]):
+                    self.assertTrue(np.isnan(view[p, t, 1]))
+                else:
+                    self.assertAlmostEqual(view[p, t, 1], x[p, t - 1] - x[p, t - 24])
+
+    def test_replace(self):
+        cube = self.cube.copy()
+        names, out = lagfeatures.features(cube, self.columns, ['EVI', 'LST'], lags = (1, 2), replace = ['LST'])
+        self.assertEqual(names, ['EVI_lag', 'EVI_lag2', 'LST_lag2'])
+        #the column of LST is replaced in place by its lag 1
+        self.assertTrue(np.isnan(cube[:, 0, 1]).all())
+        np.testing.assert_array_equal(cube[:, 1:, 1], self.cube[:, :-1, 1])
+        np.testing.assert_array_equal(cube[:, :, 0], self.cube[:, :, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the matrices of agpredict.Image: the 16-day matrix of
+quality() is the one of the original in-memory code, and the memory-mapped
+.npy files are identical to the ones written from RAM.  They need the GDAL
+and pyModis modules agpredict imports, and are skipped without them.
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import colstore
+try:
+    import agpredict
+except Exception:
+    #agpredict raises a string when GDAL or pyModis are missing
+    agpredict = None
+
+#bands, position of the quality band and raw type of the products, as set by their constructors
+PRODUCTS = {'MOD11A2.005': (['LST', 'Quality', 'Day View Time', 'Day View Angle', 'LST NIght', 'QC Night', 'Night View Time',
+                             'Night View Angle', 'Band 31', 'Band 32', 'Clear Sky Days', 'Clear Sky Nights'], 1, np.int32),
+            'MOD13Q1.005': (['NDVI', 'EVI', 'Quality', 'Red', 'NIR', 'Blue', 'MIR', 'View Zenith', 'Sun Zenith', 'Azimuth',
+                             'DOY', 'Pixel Reliability'], 2, np.int16)}
+
+
+def baselineQuality(DC, subset, varNames, qualityBand, dataset, tiles, observations, rows, columns):
+
+    """
+    16-day matrix of the original in-memory Image.quality() (quality band
+    selected): the first 8-day image of every interval, masked where QA bit 0
+    is set or the value is 9999.
+    """
+
+    subsetInt = [int(s) for s in subset.split() if s.isdigit()]
+    columnNames = [varNames[i] for i in range(len(subsetInt)) if subsetInt[i] == 1]
+    q = columnNames.index('Quality')
+    QC = np.repeat(DC[:, q].reshape((DC.shape[0], 1)), subset.count('1') - 1, axis = 1)
+    QC = np.uint16(QC) if dataset in ('MOD09A1.005', 'MOD13Q1.005') else np.uint8(QC)
+    DCm = np.delete(DC, q, 1)
+    DCm = np.ma.masked_where((QC & 1) == 1, DCm)
+    DCm = np.ma.masked_where(DCm == 9999.0, DCm)
+    obs = observations//len(tiles) if len(tiles) > 1 else observations//2
+    outArray = np.empty(shape = (rows*columns*obs, 0))
+    for b in range(DC.shape[1] - 1):
+        cfull = DCm[:, b].reshape((observations, rows, columns))
+        b16 = np.empty(shape = (rows*columns*obs, 0))
+        for band in range(0, cfull.shape[0], 2):
+            c16 = np.ma.mean(cfull[band:band + 1, :, :], axis = 0)
+            b16 = np.append(b16, np.ma.filled(c16, 9999.0).astype(float).reshape((rows*columns)))
+        outArray = np.append(outArray, b16.reshape((obs*rows*columns, 1)), axis = 1)
+    return outArray
+
+def baselineQualityMOD13Q1(DC, subset, varNames):
+    #MOD13Q1.quality() of the original code: a 16-day product, only masked
+    subsetInt = [int(s) for s in subset.split() if s.isdigit()]
+    columnNames = [varNames[i] for i in range(len(subsetInt)) if subsetInt[i] == 1]
+    q = columnNames.index('Quality')
+    QC = np.uint16(np.repeat(DC[:, q].reshape((DC.shape[0], 1)), subset.count('1') - 1, axis = 1))
+    DCm = np.ma.masked_where((QC & 1) == 1, np.delete(DC, q, 1))
+    return np.ma.filled(DCm, 9999.0)
+
+
+@unittest.skipIf(agpredict is None, 'agpredict needs GDAL and pyModis')
+class MatrixTest(unittest.TestCase):
+
+    rows, columns = 5, 4
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def image(self, cls, dataset, subset, observations, memmap):
+
+        """
+        Returns an Image of cls with the attributes quality() uses, without the
+        download and referenceImage of Image.__init__.
+        """
+
+        image = cls.__new__(cls)
+        image.directory = os.path.join(self.root, 'memmap' if memmap else 'ram')
+        image.dataset = dataset
+        image.fullPath = image.directory + '/' + dataset
+        os.makedirs(image.fullPath)
+        image.subset = subset
+        image.tiles = ['h25v08']
+        image.observations = observations
+        image.rows, image.columns = self.rows, self.columns
+        image.pixelIndex = None
+        image.memmap = memmap
+        image.compact = False
+        image.composite = 'first'
+        image.qaRule = 'legacy'
+        image.varNames, image.qualityBand, image.rawType = PRODUCTS[dataset]
+        image.scale = [1]*len(image.varNames)
+        return image
+
+    def bandMatrix(self, image, seed):
+        #band matrix of observations 8-day images, with QA words and nodata values
+        rs = np.random.RandomState(seed)
+        columnNames, q, bands = image._qualityColumns()
+        DC = np.round(rs.rand(self.rows*self.columns*image.observations, len(columnNames))*1000, 1)
+        DC[:, q] = rs.randint(0, 256, DC.shape[0])
+        DC[rs.rand(DC.shape[0]) < .1, bands[0]] = 9999.0
+        return DC
+
+    def quality(self, cls, dataset, subset, observations):
+
+        """
+        Runs quality() in RAM and in memmap mode and returns the band matrix and
+        the bytes of the two .npy files.
+        """
+
+        files = []
+        for memmap in (False, True):
+            image = self.image(cls, dataset, subset, observations, memmap)
+            DC = self.bandMatrix(image, 0)
+            image.DC = image._array(image.fullPath + '/' + dataset + '_DC.npy', DC.shape)
+            image.DC[:] = DC
+            image.quality()
+            with open(image.directory + '/' + dataset + '.npy', 'rb') as f:
+                files.append(f.read())
+        return DC, image, files
+
+    def assertSavedAs(self, content, array):
+        path = os.path.join(self.root, 'expected.npy')
+        np.save(path, array)
+        with open(path, 'rb') as f:
+            self.assertEqual(content, f.read())
+
+    def test_quality(self):
+        DC, image, (ram, memmap) = self.quality(agpredict.MOD11A2, 'MOD11A2.005', '1 1 0 0 0 0 0 0 0 0 0 0', 6)
+        self.assertEqual(ram, memmap)
+        self.assertSavedAs(memmap, baselineQuality(DC, image.subset, image.varNames, image.qualityBand, image.dataset,
+                                                   image.tiles, image.observations, self.rows, self.columns))
+        self.assertFalse(os.path.exists(image.fullPath + '/MOD11A2.005_DC.npy'))
+        with open(image.directory + '/MOD11A2.005.txt') as f:
+            self.assertEqual(f.read(), 'LST \n')
+
+    def test_quality_MOD13Q1(self):
+        DC, image, (ram, memmap) = self.quality(agpredict.MOD13Q1, 'MOD13Q1.005', '1 1 1 0 0 0 0 0 0 0 0 1', 3)
+        self.assertEqual(ram, memmap)
+        self.assertSavedAs(memmap, baselineQualityMOD13Q1(DC, image.subset, image.varNames))
+
+    def test_legacyMatrix(self):
+        files = []
+        for memmap in (False, True):
+            image = self.image(agpredict.MOD13Q1, 'MOD13Q1.005', '1 1 1 0 0 0 0 0 0 0 0 1', 7, memmap)
+            store = colstore.ColumnStore.create(image.directory + '/finalMatrix', self.rows, self.columns, 7, chunkPeriods = 3)
+            rs = np.random.RandomState(1)
+            for name in ('EVI', 'NDVI'):
+                store.add(name, rs.rand(self.rows*self.columns*7))
+            store.addVirtual('timeID', 'time')
+            names = ['EVI', 'NDVI', 'timeID']
+            image._legacyMatrix(store, names)
+            with open(image.directory + '/finalMatrix.npy', 'rb') as f:
+                files.append(f.read())
+        self.assertEqual(files[0], files[1])
+        self.assertSavedAs(files[1], np.column_stack([store.column(name).astype(float) for name in names]))
+        with open(image.directory + '/columnNames.txt') as f:
+            self.assertEqual(f.read().split(), names)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Tests of reorder.py: the transpose gives the order of the lexsort by uniq_id
+and timeID that the pre-processing scripts used before.
+
+    python -m unittest discover tests
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import reorder
+
+
+class ReorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pixels, self.intervals = 7, 5
+        rs = np.random.RandomState(0)
+        #time-major matrix with timeID and uniq_id columns, as built by 0_matrix_construction.py
+        self.dat = np.c_[rs.rand(self.pixels*self.intervals, 3),
+                         np.repeat(np.arange(1, self.intervals + 1), self.pixels),
+                         np.tile(np.arange(1, self.pixels + 1), self.intervals)]
+
+    def lexsorted(self):
+        return self.dat[np.lexsort((self.dat[:, 3], self.dat[:, 4]))]
+
+    def test_isTimeMajor(self):
+        self.assertTrue(reorder.isTimeMajor(self.dat[:, 3], self.intervals))
+        self.assertFalse(reorder.isTimeMajor(self.lexsorted()[:, 3], self.intervals))
+        self.assertFalse(reorder.isTimeMajor(self.dat[:-1, 3], self.intervals))
+
+    def test_pixelMajor(self):
+        for pixels in (None, 1, 3, 100):
+            np.testing.assert_array_equal(reorder.pixelMajor(self.dat, self.intervals, pixels = pixels), self.lexsorted())
+        #a vector, and a memory-mapped output
+        np.testing.assert_array_equal(reorder.pixelMajor(self.dat[:, 0], self.intervals), self.lexsorted()[:, 0])
+        directory = tempfile.mkdtemp()
+        try:
+            out = np.lib.format.open_memmap(os.path.join(directory, 'out.npy'), mode = 'w+', shape = self.dat.shape)
+            self.assertIs(reorder.pixelMajor(self.dat, self.intervals, out = out, pixels = 2), out)
+            np.testing.assert_array_equal(out, self.lexsorted())
+            del out
+        finally:
+            shutil.rmtree(directory)
+
+    def test_pixelBlock(self):
+        np.testing.assert_array_equal(reorder.pixelBlock(self.dat, self.intervals, 2, 5),
+                                      self.lexsorted()[2*self.intervals:5*self.intervals])
+
+    def test_positions(self):
+        rows = np.array([0, 4, 5, 12, 34])
+        np.testing.assert_array_equal(reorder.pixelPositions(rows, self.intervals), self.lexsorted()[rows, 4] - 1)
+        np.testing.assert_array_equal(reorder.timeIndex(rows, self.intervals), self.lexsorted()[rows, 3] - 1)
+        np.testing.assert_array_equal(reorder.timePeriods(np.arange(50), 50), np.arange(50) % 23 + 1)
+
+    def test_compactRows(self):
+        rows = np.array([1, 2, 6, 7, 8, 20, 34])
+        expected = self.dat[rows]
+        for block in (None, 1, 2, 100):
+            dat = self.dat.copy()
+            np.testing.assert_array_equal(reorder.compactRows(dat, rows, block), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# -*- coding: utf-8 -*-
+"""
+Tests of split.py: the training grids are the same for the same seed and
+hold about the asked proportion of the rows.
+
+    python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import split
+
+
+class SplitTest(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        #rows of 200 grids of very different sizes, in no order
+        self.grid = rs.permutation(np.repeat(np.arange(1, 201), rs.randint(1, 500, 200)))
+
+    def test_gridCounts(self):
+        grids, counts, position = split.gridCounts(self.grid)
+        expected, expectedCounts = np.unique(self.grid, return_counts = True)
+        np.testing.assert_array_equal(grids, expected)
+        np.testing.assert_array_equal(counts, expectedCounts)
+        np.testing.assert_array_equal(grids[position], self.grid)
+        #float and non-integer grids are counted the same way
+        for grid in (self.grid.astype(float), self.grid*1000 + .5):
+            g, c, p = split.gridCounts(grid)
+            np.testing.assert_array_equal(c, expectedCounts)
+            np.testing.assert_array_equal(g[p], grid)
+
+    def test_same_seed_same_grids(self):
+        grids, counts, position = split.gridCounts(self.grid)
+        chosen = split.chooseTraining(counts, 0.8, seed = 3)
+        np.testing.assert_array_equal(split.chooseTraining(counts, 0.8, seed = 3), chosen)
+        self.assertFalse(np.array_equal(split.chooseTraining(counts, 0.8, seed = 4), chosen))
+
+    def test_within_tolerance(self):
+        grids, counts, position = split.gridCounts(self.grid)
+        for prop in (0.5, 0.8):
+            for seed in range(5):
+                chosen = split.chooseTraining(counts, prop, seed = seed, tolerance = 0.01)
+                self.assertLessEqual(abs(counts[chosen].sum()/float(counts.sum()) - prop), 0.01)
+
+    def test_few_large_grids(self):
+        #the greedy choice misses 0.8 of 10, 10, 10, 70, the subset sum does not
+        counts = np.array([10, 10, 10, 70])
+        for seed in range(5):
+            chosen = split.chooseTraining(counts, 0.8, seed = seed)
+            self.assertEqual(counts[chosen].sum(), 80)
+
+    def test_split(self):
+        training, trainingGrids = split.split(self.grid, 0.8, seed = 1)
+        self.assertEqual(training.dtype, bool)
+        #whole grids are in the training data, and the mask of other rows is the same lookup
+        self.assertEqual(set(self.grid[training]), set(trainingGrids))
+        self.assertFalse(set(self.grid[~training]) & set(trainingGrids))
+        np.testing.assert_array_equal(split.trainingMask(self.grid, trainingGrids), training)
+
+
+if __name__ == '__main__':
+    unittest.main()